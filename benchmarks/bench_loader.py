@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# time and peak memory of loading a large topology with and without
+# streaming, run from the repository root: python -m benchmarks.bench_loader
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from nhelper import Topology
+from benchmarks.synthetic import write_topology
+
+def measure_load(path, stream):
+    """Loads the topology and measures it.
+    Input:
+      path - string, path to the topology json file
+      stream - boolean, passed to Topology
+    Output: tuple (seconds, peak traced memory in bytes)
+    """
+    tracemalloc.start()
+    start = time.perf_counter()
+    topology = Topology(path, stream=stream)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    del topology
+    return elapsed, peak
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'topology.json')
+        write_topology(path, count)
+        size = os.path.getsize(path)
+        for stream in False, True:
+            elapsed, peak = measure_load(path, stream)
+            print('Topology({} nodes, {:.1f} MB, stream={}): {:.3f}s, '
+                  'peak {:.1f} MB'.format(count, size / 2 ** 20, stream,
+                                          elapsed, peak / 2 ** 20))
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# memory of 100k interfaces: the slotted nhelper.Interface against
+# the dict-based model it replaced,
+# run from the repository root: python -m benchmarks.bench_memory
+import tracemalloc
+
+from nhelper import Interface, Router, autocomplete_interface
+
+class LegacyInterface(object):
+    """Interface model before __slots__: every attribute in __dict__
+    and a json cache per instance"""
+    def __init__(self, name, device=None):
+        self.name = autocomplete_interface(name)
+        self.up = True
+        self.type = None
+        self.ip_address = None
+        self.ospf = False
+        self.ospf_area = None
+        self.ospf_not_passive = False
+        self.eigrp = False
+        self.eigrp_not_passive = False
+        self.routing = None
+        self.device = device
+        self.crypto_map = None
+        self.switchport = False
+        self.dot1q = None
+        self.other_end = None
+        self.line = None
+        self.json = {}
+        self.parent = None
+        self.children = []
+        self.vlan = None
+
+def measure(model, count=100000):
+    """Creates count interfaces of the model on one device.
+    Output: int, traced bytes per interface
+    """
+    device = Router('R1')
+    names = ['Ethernet{}/{}'.format(number // 48, number % 48)
+             for number in range(count)]
+    tracemalloc.start()
+    interfaces = [model(name, device=device) for name in names]
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del interfaces
+    return size / count
+
+if __name__ == '__main__':
+    legacy = measure(LegacyInterface)
+    slotted = measure(Interface)
+    print('100k interfaces: legacy {:.1f} MB, slotted {:.1f} MB '
+          '({:.0f} vs {:.0f} bytes per interface)'
+          .format(legacy * 1e5 / 2 ** 20, slotted * 1e5 / 2 ** 20,
+                  legacy, slotted))
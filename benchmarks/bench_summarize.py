@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# benchmark of nhelper.summarize_subnets on random prefixes
+# run from the repository root: python -m benchmarks.bench_summarize
+import random
+import time
+
+from nhelper import PREFIX_MASKS, Subnet, summarize_subnets
+
+def random_subnets(count, seed=0):
+    """Generates count random networks from /22 to /30 inside 10.0.0.0/8
+    Input:
+      count - int, number of networks
+      seed - int, seed of the random generator
+    Output: list of Subnet instances
+    """
+    generator = random.Random(seed)
+    subnets = []
+    for _ in range(count):
+        prefixlen = generator.randint(22, 30)
+        address = 0x0A000000 | generator.getrandbits(24)
+        subnets.append(Subnet.from_int(address & PREFIX_MASKS[prefixlen],
+                                       prefixlen))
+    return subnets
+
+def measure(function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+if __name__ == '__main__':
+    subnets = random_subnets(100000)
+    for smart in False, True:
+        elapsed, result = measure(summarize_subnets, subnets,
+                                  'slash', smart)
+        print('summarize_subnets(100000, smart={}): {:.3f}s, {} prefixes'
+              .format(smart, elapsed, len(result)))
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# runs the benchmarks of benchmarks/suite.py, saves the results as
+# a baseline and compares later runs with it. From the repository root:
+#   python -m benchmarks.run --save benchmarks/baseline.json
+#   python -m benchmarks.run --compare benchmarks/baseline.json
+# The process exits with status 1 if any benchmark got slower than
+# the baseline by more than --threshold.
+import argparse
+import inspect
+import itertools
+import json
+import sys
+import time
+
+from benchmarks import suite
+
+def parameter_sets(benchmark):
+    """Returns all combinations of params of the asv-style class"""
+    params = getattr(benchmark, 'params', None)
+    if params is None:
+        return [()]
+    names = getattr(benchmark, 'param_names', [])
+    if len(names) > 1:
+        return list(itertools.product(*params))
+    return [(param,) for param in params]
+
+def measure(function, repeat=3, min_time=0.2):
+    """Runs the function until it took at least min_time seconds,
+    repeat times.
+    Output: float, the best time of one call in seconds
+    """
+    best = None
+    for _ in range(repeat):
+        calls = 0
+        start = time.perf_counter()
+        while True:
+            function()
+            calls += 1
+            elapsed = time.perf_counter() - start
+            if elapsed >= min_time:
+                break
+        if best is None or elapsed / calls < best:
+            best = elapsed / calls
+    return best
+
+def run(pattern='', repeat=3, min_time=0.2):
+    """Runs all benchmarks whose name contains pattern.
+    Output: dict, benchmark name -> seconds
+    """
+    results = {}
+    for class_name, benchmark in inspect.getmembers(suite, inspect.isclass):
+        if benchmark.__module__ != suite.__name__:
+            continue
+        methods = [name for name in dir(benchmark)
+                   if name.startswith('time_')]
+        for params in parameter_sets(benchmark):
+            for method in methods:
+                name = '{}.{}({})'.format(class_name, method,
+                                          ', '.join(map(repr, params)))
+                if pattern not in name:
+                    continue
+                instance = benchmark()
+                if hasattr(instance, 'setup'):
+                    instance.setup(*params)
+                try:
+                    function = getattr(instance, method)
+                    results[name] = measure(lambda: function(*params),
+                                            repeat, min_time)
+                finally:
+                    if hasattr(instance, 'teardown'):
+                        instance.teardown(*params)
+                print('{:70} {:10.6f}s'.format(name, results[name]))
+                sys.stdout.flush()
+    return results
+
+def compare(results, baseline, threshold):
+    """Prints the ratio of every result to the baseline.
+    Output: list of names of benchmarks slower than threshold
+    """
+    regressions = []
+    for name, seconds in sorted(results.items()):
+        if name not in baseline:
+            continue
+        ratio = seconds / baseline[name]
+        mark = ''
+        if ratio > threshold:
+            regressions.append(name)
+            mark = '  REGRESSION'
+        print('{:70} {:6.2f}x{}'.format(name, ratio, mark))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='nhelper benchmarks')
+    parser.add_argument('--filter', default='',
+                        help='run only benchmarks containing this text')
+    parser.add_argument('--save', help='write the results as JSON')
+    parser.add_argument('--compare', help='baseline JSON to compare with')
+    parser.add_argument('--threshold', type=float, default=1.3,
+                        help='slowdown ratio reported as a regression')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--min-time', type=float, default=0.2)
+    args = parser.parse_args(argv)
+    results = run(args.filter, args.repeat, args.min_time)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.threshold):
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# benchmarks of nhelper hot paths in the asv style: every class has
+# params, setup and time_* methods. Run them from the repository root
+# with python -m benchmarks.run, see benchmarks/run.py
+import atexit
+import os
+import random
+import shutil
+import tempfile
+
+import nhelper
+from nhelper import (IPAddress, Topology, convert_mask, int_to_ipv4,
+                     load_ip_address_description, parse_cache,
+                     PREFIX_MASKS)
+from benchmarks.synthetic import write_topology
+
+# number of nodes of synthetic topologies
+TOPOLOGY_SIZES = [10, 100, 1000, 10000]
+
+directory = tempfile.mkdtemp(prefix='nhelper-bench-')
+atexit.register(shutil.rmtree, directory, True)
+
+def topology_path(count):
+    """Returns the path to the synthetic topology of count nodes,
+    the file is generated once per run"""
+    path = os.path.join(directory, 'topology{}.json'.format(count))
+    if not os.path.exists(path):
+        write_topology(path, count)
+    return path
+
+def random_addresses(count, seed=0):
+    """Returns count random ipv4 addresses with random masks as strings"""
+    generator = random.Random(seed)
+    return ['{}/{}'.format(int_to_ipv4(generator.getrandbits(32)),
+                           generator.randint(8, 30))
+            for _ in range(count)]
+
+
+class ConvertMask(object):
+    params = ['decimal', 'slash', 'binary', 'wildcard']
+    param_names = ['view']
+
+    def setup(self, view):
+        masks = [int_to_ipv4(mask) for mask in PREFIX_MASKS]
+        self.masks = masks * 100
+
+    def time_convert_mask(self, view):
+        for mask in self.masks:
+            convert_mask(mask, view)
+
+
+class IPAddressConstruction(object):
+    params = [True, False]
+    param_names = ['cached']
+
+    def setup(self, cached):
+        self.addresses = random_addresses(1000) * 10
+        parse_cache.clear()
+
+    def time_ip_address(self, cached):
+        if cached:
+            for address in self.addresses:
+                IPAddress(address)
+        else:
+            for address in self.addresses:
+                IPAddress.parse(address)
+
+
+class Description(object):
+
+    def setup(self):
+        if not nhelper.ipv4[0]:
+            load_ip_address_description()
+        self.addresses = [IPAddress(address.split('/')[0])
+                          for address in random_addresses(10000)]
+
+    def time_get_description(self):
+        for address in self.addresses:
+            address.get_description()
+
+
+class TopologyLoad(object):
+    params = [TOPOLOGY_SIZES, [False, True]]
+    param_names = ['nodes', 'stream']
+
+    def setup(self, nodes, stream):
+        self.path = topology_path(nodes)
+
+    def time_topology_init(self, nodes, stream):
+        Topology(self.path, stream=stream, seed='bench')
+
+
+class BuildConfig(object):
+    params = TOPOLOGY_SIZES
+    param_names = ['nodes']
+
+    def setup(self, nodes):
+        self.topology = Topology(topology_path(nodes), seed='bench')
+
+    def time_build_config(self, nodes):
+        for node in self.topology.nodes:
+            node.build_config()
+
+
+class CreateConfigs(object):
+    params = [TOPOLOGY_SIZES, [None, 4]]
+    param_names = ['nodes', 'workers']
+
+    def setup(self, nodes, workers):
+        self.topology = Topology(topology_path(nodes), seed='bench')
+        self.output = os.path.join(directory, 'configs')
+
+    def teardown(self, nodes, workers):
+        shutil.rmtree(self.output, ignore_errors=True)
+
+    def time_create_configs(self, nodes, workers):
+        self.topology.create_configs(self.output, workers=workers)
+
+
+class CreateConfigsIncremental(object):
+    params = TOPOLOGY_SIZES
+    param_names = ['nodes']
+
+    def setup(self, nodes):
+        self.topology = Topology(topology_path(nodes), seed='bench')
+        self.output = os.path.join(directory, 'configs')
+        self.topology.create_configs(self.output)
+
+    def teardown(self, nodes):
+        shutil.rmtree(self.output, ignore_errors=True)
+
+    def time_create_configs_unchanged(self, nodes):
+        self.topology.create_configs(self.output, incremental=True)
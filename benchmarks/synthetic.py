@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# synthetic topologies in the format of topology.json for benchmarks
+import json
+import random
+
+from nhelper import int_to_ipv4
+
+def interface_json(name, ip=None, ospf=False, vlan=None):
+    """Returns the json of one interface like in topology.json"""
+    interface = {"dot1q": None, "eigrp_enabled": False,
+                 "eigrp_not_passive": False, "ip": ip, "name": name,
+                 "ospf_area": 0 if ospf else None, "ospf_enabled": ospf,
+                 "ospf_not_passive": ospf, "switchport": vlan is not None,
+                 "up": True}
+    if vlan is not None:
+        interface["vlan"] = vlan
+    return interface
+
+def generate_topology(count, seed=0):
+    """Generates a chain of count nodes, every tenth node is a switch
+    with access ports, other nodes are routers with a loopback.
+    Neighbours are connected with /30 networks from 172.16.0.0/12.
+    Input:
+      count - int, number of nodes
+      seed - int, seed of the random generator
+    Output: dict, topology json
+    """
+    generator = random.Random(seed)
+    nodes = []
+    links = []
+    for index in range(count):
+        name = 'SW{}'.format(index) if index % 10 == 9 \
+            else 'R{}'.format(index)
+        # the link to the previous node uses the second address of the
+        # network, the link to the next node uses the first one
+        previous = 0xAC100000 + 4 * (index - 1) + 2
+        following = 0xAC100000 + 4 * index + 1
+        if name.startswith('SW'):
+            interfaces = [interface_json('Ethernet0/0', vlan='trunk'),
+                          interface_json('Ethernet0/1', vlan='trunk')]
+            interfaces.extend(interface_json('Ethernet{}/{}'
+                                             .format(slot // 4, slot % 4),
+                                             vlan=generator.randint(10, 99))
+                              for slot in range(4, 12))
+            nodes.append({"eigrp": False, "eigrp_as": None,
+                          "interfaces": interfaces, "ipv4_routing": False,
+                          "name": name, "ospf": False,
+                          "ospf_process": None, "type": "switch"})
+        else:
+            ospf = generator.random() < 0.5
+            interfaces = [interface_json('Loopback0',
+                                         int_to_ipv4(0x0A000000 + index) +
+                                         '/32', ospf)]
+            if index:
+                interfaces.append(interface_json(
+                    'Ethernet0/0', int_to_ipv4(previous) + '/30', ospf))
+            if index < count - 1:
+                interfaces.append(interface_json(
+                    'Ethernet0/1', int_to_ipv4(following) + '/30', ospf))
+            nodes.append({"eigrp": False, "eigrp_as": None,
+                          "interfaces": interfaces, "ipv4_routing": True,
+                          "name": name, "ospf": ospf,
+                          "ospf_process": 1 if ospf else None,
+                          "type": "router"})
+        if index:
+            links.append({"dst_int": "Ethernet0/0", "dst_node": name,
+                          "src_int": "Ethernet0/1",
+                          "src_node": nodes[index - 1]["name"]})
+    options = {"domain_name": "example.com", "ntp_server": "10.255.0.1",
+               "syslog_server": "10.255.0.2",
+               "users": [{"password": "cisco", "username": "admin"}]}
+    return {"options": options, "topology": {"links": links,
+                                             "nodes": nodes}}
+
+def write_topology(path, count, seed=0):
+    """Writes generate_topology(count, seed) into the file"""
+    with open(path, 'w') as f:
+        json.dump(generate_topology(count, seed), f, indent=4,
+                  sort_keys=True)
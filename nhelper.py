@@ -3,12 +3,23 @@
 
 # this module contains some basic helper functions
 # like network division, netmask recalculation
+import bisect
+import cProfile
+import hashlib
+import heapq
+import hmac
+import io
 import re
 import random
 import json
 import os
+import pstats
 import string
 import shutil
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 ipv4 = [{}, {}]
 ipv6 = [{}, {}]
@@ -21,17 +32,69 @@ class_info = {'A': ['255.0.0.0', 'Class A'],
               'D': ['', 'Multicast'],
               'E': ['', 'Experimental'],}
 
+ALL_ONES_IPV4 = 2 ** 32 - 1
+# PREFIX_MASKS[n] is the netmask of /n as integer
+PREFIX_MASKS = tuple(ALL_ONES_IPV4 ^ (ALL_ONES_IPV4 >> n) for n in range(33))
+# class of ip address by its first four bits, built from ip_to_class
+CLASS_BY_FIRST_BITS = tuple(ip_to_class[key] for n in range(16)
+                            for key in ip_to_class
+                            if '{0:04b}'.format(n).startswith(key))
+CLASSFUL_PREFIXLEN = {'A': 8, 'B': 16, 'C': 24}
+ALL_ONES_IPV6 = 2 ** 128 - 1
+PREFIX_MASKS_IPV6 = tuple(ALL_ONES_IPV6 ^ (ALL_ONES_IPV6 >> n)
+                          for n in range(129))
+ADDRESS_BITS = {'ipv4': 32, 'ipv6': 128}
+PREFIX_MASKS_BY_VERSION = {'ipv4': PREFIX_MASKS, 'ipv6': PREFIX_MASKS_IPV6}
+
 IPV4_RE = re.compile(r'((\d+\.){3}\d+)(\/\d+| +(\d+\.){3}\d+| *- *(\d+\.){3}\d+)?')
+IPV6_RE = re.compile(r'([0-9a-fA-F:.]+)(\/\d+)?$')
 
 INTERFACES = ['FastEthernet', 'GigabitEthernet', 'Ethernet', 'Loopback',
               'Serial', 'Vlan', 'Tunnel', 'Portchannel']
 TEMPLATES_DIR = "templates"
+# written by Topology.create_configs next to the configs
+MANIFEST_FILE = ".manifest.json"
+# longest list of vlans in one "switchport trunk allowed vlan" line,
+# the rest goes to "switchport trunk allowed vlan add" lines,
+# so lines fit in 80 columns
+TRUNK_VLANS_LENGTH = 45
+
+PASSWORD_CHARACTERS = string.ascii_letters + string.digits
 
 def generate_random_password(length=20):
-    return ''.join(random.SystemRandom().choice(string.ascii_letters + string.digits)
+    return ''.join(random.SystemRandom().choice(PASSWORD_CHARACTERS)
                    for _ in range(length))
 
+def derive_number(key, *identifiers):
+    """Derives a 256-bit number from the secret key and identifiers
+    with HMAC-SHA256, the same input always gives the same number.
+    Input:
+      key - bytes, secret key
+      identifiers - strings, like 'user', 'admin'
+    Output: int
+    """
+    message = '\x00'.join(identifiers).encode('utf-8')
+    digest = hmac.new(key, message, hashlib.sha256).digest()
+    return int.from_bytes(digest, 'big')
+
+def derive_password(key, *identifiers, length=20):
+    """Derives a password from the secret key and identifiers,
+    see derive_number.
+    Output: string of length letters and digits
+    """
+    number = derive_number(key, *identifiers)
+    characters = []
+    for _ in range(length):
+        number, index = divmod(number, len(PASSWORD_CHARACTERS))
+        characters.append(PASSWORD_CHARACTERS[index])
+    return ''.join(characters)
+
+@lru_cache(maxsize=4096)
 def autocomplete_interface(full_name):
+    """Expands the abbreviated interface type, like 'gi0/1' into
+    'GigabitEthernet0/1'. Results are memoized, because the same names
+    are completed for every device.
+    """
     match = re.search('^([a-zA-Z]+)([0-9\/].*)$', full_name)
     for interface in INTERFACES:
         if interface.lower().startswith(match.group(1).lower()):
@@ -39,21 +102,176 @@ def autocomplete_interface(full_name):
                                                 number = match.group(2))
 
 def load_ip_address_description():
-    def helper(filename, hashmap):
+    def helper(filename, hashmap, trie):
         for line in filename:
             array = line.split('\t')
             if re.match('((\d+\.){3}\d+)', array[0].strip()):
+                key, description = array[0].strip(), array[1].strip()
                 if '/' in array[0] or '-' in array[0] \
                     or array[0].count('.') > 3:
-                    hashmap[1][array[0].strip()] = array[1].strip()
+                    hashmap[1][key] = description
+                    for prefix, prefixlen in parse_description_key(key):
+                        trie.insert(prefix, prefixlen, description)
+                else:
+                    hashmap[0][key] = description
+            elif ':' in array[0] and len(array) > 1:
+                key, description = array[0].strip(), array[1].strip()
+                try:
+                    address = IPAddress(key, version='ipv6')
+                except IPAddress.WrongIPError:
+                    continue
+                if address.prefixlen is None:
+                    hashmap[0][address.ip] = description
                 else:
-                    hashmap[0][array[0].strip()] = array[1].strip()
+                    hashmap[1][key] = description
+                    network = address.get_network()
+                    trie.insert(network.ip_int, network.prefixlen,
+                                description)
             else:
                 pass
 
     with open('ipv4.txt', 'r') as f4, open('ipv6.txt', 'r') as f6:
-        helper(f4, ipv4)
-        helper(f6, ipv6)
+        helper(f4, ipv4, ipv4_networks)
+        helper(f6, ipv6, ipv6_networks)
+
+def parse_description_key(key):
+    """Converts network or range of addresses from ipv4.txt into prefixes.
+    Input:
+      key - string, like 10.0.0.0/8, 10.0.0.0 255.0.0.0
+            or 10.0.0.0 - 10.0.0.5
+    Output: list of tuples (network as integer, prefix length),
+      empty if key can not be parsed
+    """
+    try:
+        if '-' in key:
+            first, last = key.split('-')
+            return list(range_to_prefixes(ipv4_to_int(first.strip()),
+                                          ipv4_to_int(last.strip())))
+        network = IPAddress(key).get_network()
+    except (ValueError, IPAddress.WrongIPError):
+        return []
+    if network is None:
+        return []
+    return [(network.ip_int, network.prefixlen)]
+
+def ipv4_to_int(ip):
+    """Converts ipv4 address in the decimal form into integer.
+    Input:
+      ip - string, like '192.168.1.1'
+    Output:
+      int, ip address as a 32-bit number
+    Raises ValueError if ip is not a valid ipv4 address
+    """
+    octets = ip.split('.')
+    if len(octets) != 4:
+        raise ValueError('%s is not a valid ipv4 address' % ip)
+    result = 0
+    for octet in octets:
+        if not octet.isdigit() or int(octet) > 255:
+            raise ValueError('%s is not a valid ipv4 address' % ip)
+        result = result << 8 | int(octet)
+    return result
+
+def int_to_ipv4(number):
+    """Converts 32-bit number into ipv4 address in the decimal form.
+    Input:
+      number - int
+    Output:
+      string, like '192.168.1.1'
+    """
+    return '%d.%d.%d.%d' % (number >> 24, number >> 16 & 255,
+                            number >> 8 & 255, number & 255)
+
+def ipv6_to_int(ip):
+    """Converts ipv6 address into integer.
+    Input:
+      ip - string, full or compressed with '::', the last 32 bits can be
+           written in the ipv4 decimal form, like '::ffff:192.168.1.1'
+    Output:
+      int, ip address as a 128-bit number
+    Raises ValueError if ip is not a valid ipv6 address
+    """
+    if '.' in ip:
+        head, _, tail = ip.rpartition(':')
+        tail = ipv4_to_int(tail)
+        ip = '%s:%x:%x' % (head, tail >> 16, tail & 0xffff)
+    if ip.count('::') > 1:
+        raise ValueError('%s is not a valid ipv6 address' % ip)
+    if '::' in ip:
+        left, right = ip.split('::')
+        left = left.split(':') if left else []
+        right = right.split(':') if right else []
+        missing = 8 - len(left) - len(right)
+        if missing < 1:
+            raise ValueError('%s is not a valid ipv6 address' % ip)
+        groups = left + ['0'] * missing + right
+    else:
+        groups = ip.split(':')
+    if len(groups) != 8:
+        raise ValueError('%s is not a valid ipv6 address' % ip)
+    result = 0
+    for group in groups:
+        if not 1 <= len(group) <= 4 or group.strip(string.hexdigits):
+            raise ValueError('%s is not a valid ipv6 address' % ip)
+        result = result << 16 | int(group, 16)
+    return result
+
+def int_to_ipv6(number):
+    """Converts 128-bit number into ipv6 address in the compressed form
+    (RFC 5952): leading zeros are omitted, the longest run of two or more
+    zero groups is replaced by '::'.
+    Input:
+      number - int
+    Output:
+      string, like '2001:db8::1'
+    """
+    groups = ['%x' % (number >> shift & 0xffff) for shift in range(112, -1, -16)]
+    best_start, best_length, start = None, 1, None
+    for index, group in enumerate(groups + ['end']):
+        if group == '0':
+            if start is None:
+                start = index
+        elif start is not None:
+            if index - start > best_length:
+                best_start, best_length = start, index - start
+            start = None
+    if best_start is None:
+        return ':'.join(groups)
+    return '%s::%s' % (':'.join(groups[:best_start]),
+                       ':'.join(groups[best_start + best_length:]))
+
+class WrongMaskError(Exception):
+    """Raise if netmask notation or desired view is wrong
+    """
+    pass
+
+def build_mask_tables():
+    """Precomputes every notation of the 33 valid ipv4 netmasks.
+    Input: None
+    Output: tuple of two elements:
+      dict, netmask in any notation -> (prefix length, notation)
+      list, prefix length -> dict with keys 'slash', 'decimal',
+            'binary', 'wildcard' and values - netmask in that notation
+    """
+    notations = {}
+    views = []
+    for prefixlen in range(33):
+        mask = PREFIX_MASKS[prefixlen]
+        binary = '{0:032b}'.format(mask)
+        view = {'slash': '/%d' % prefixlen,
+                'decimal': int_to_ipv4(mask),
+                'binary': '.'.join(binary[i:i + 8] for i in range(0, 32, 8)),
+                'wildcard': int_to_ipv4(ALL_ONES_IPV4 ^ mask)}
+        views.append(view)
+        for notation in 'slash', 'decimal', 'binary':
+            notations[view[notation]] = (prefixlen, notation)
+        notations[binary] = (prefixlen, 'binary')
+    return notations, views
+
+MASK_NOTATIONS, MASK_VIEWS = build_mask_tables()
+# notation returned by convert_mask if view is not specified
+DEFAULT_MASK_VIEW = {'slash': 'decimal', 'decimal': 'slash',
+                     'binary': 'decimal'}
 
 def convert_mask(netmask, view=None):
     """Converts netmask to the desired form specified by the
@@ -62,95 +280,510 @@ def convert_mask(netmask, view=None):
     in decimal form, or into decimal form otherwise.
     Input:
       netmask - string, mask needed to be converted
-      view - string, desired notation. Can be one of three:
-            'decimal', 'slash' or 'binary'
+      view - string, desired notation. Can be one of four:
+            'decimal', 'slash', 'binary' or 'wildcard'
     Output:
        string, netmask in the desired form
+    Raises WrongMaskError if netmask or view is wrong
     """
-    netmask = netmask.strip()
-    if '/' in netmask:
-        if view == 'slash':
-            return netmask
-        number_of_unities = int(netmask[1:])
-        bin_form = ['1' for n in range(number_of_unities)] + \
-                    ['0' for n in range(32 - number_of_unities)]
-        # insert '.' to show octets
-        for i in range(1, 4):
-            bin_form.insert(32 - 8 * i, '.')
-        bin_form = ''.join(bin_form)
-        return convert_mask(bin_form, view)
-
-    elif re.match('(([01]){8}\.){3}([01]){8}$', netmask):
-        if view == 'binary':
-            return netmask
-        elif view == 'slash':
-            count = 0
-            for symbol in netmask:
-                if symbol == '1':
-                    count += 1
-                elif symbol == '0':
-                    break
-            return '/%d' % count
-        elif not view or view == 'decimal':
-            octets = [str(int(octet, 2)) for octet in netmask.split('.')]
-            return '.'.join(octets)
-
-    elif re.match('^[01]{32}$', netmask):
-        netmask = list(netmask)
-        for i in range(1, 4):
-            netmask.insert(32 - 8 * i, '.')
-        netmask = ''.join(netmask)
-        if view == 'binary':
-            return netmask
-        elif view == 'slash':
-            count = 0
-            for symbol in netmask:
-                if symbol == '1':
-                    count += 1
-                elif symbol == '0':
-                    break
-            return '/%d' % count
-        elif not view or view == 'decimal':
-            octets = [str(int(octet, 2)) for octet in netmask.split('.')]
-            return '.'.join(octets)
-
-
-    elif re.match('(\d+\.){3}\d+$', netmask):
-        if view == 'decimal':
-            return netmask
-        octets = ['{0:08b}'.format(int(octet)) \
-                  for octet in netmask.split('.')]
-        bin_form = '.'.join(octets)
-        if view == 'binary':
-            return bin_form
-        elif not view or view == 'slash':
-            return convert_mask(bin_form, 'slash')
-    else:
-        print('wrong input')
-
-def summarize_subnets(subnets, view='decimal', smart=False):
-    pass
+    try:
+        prefixlen, notation = MASK_NOTATIONS[netmask.strip()]
+        return MASK_VIEWS[prefixlen][view or DEFAULT_MASK_VIEW[notation]]
+    except KeyError:
+        raise WrongMaskError('Wrong netmask %r or view %r'
+                             % (netmask, view))
+
+def summarize_subnets(subnets, view='decimal', smart=False, overcoverage=0.25):
+    """Summarizes networks into the minimal list of covering networks.
+    Networks are sorted, overlapping and adjacent ones are merged into
+    ranges, and each range is split into the largest aligned blocks,
+    so the whole summarization takes O(n log n).
+    Input:
+      subnets - iterable of Subnet or IPAddress instances or strings,
+            all of them either ipv4 or ipv6
+      view - string, notation of the mask in the result. Can be one of:
+            'decimal', 'slash', 'binary' or 'wildcard',
+            ipv6 networks are always shown in the slash notation
+      smart - boolean, if True, neighbouring networks are summarized
+            even if the summary covers addresses not in subnets
+      overcoverage - float, only for smart: the maximal share of the
+            summary which can consist of addresses not in subnets
+    Output:
+      list of strings, like '10.0.0.0 255.255.0.0' or '10.0.0.0/16'
+    """
+    ranges = []
+    version = None
+    for subnet in subnets:
+        if not isinstance(subnet, IPAddress):
+            subnet = Subnet(subnet, 'ipv6' if ':' in subnet else 'ipv4')
+        if version is not None and subnet.version != version:
+            raise Subnet.WrongSubnetError('Can not summarize ipv4 '
+                                          'and ipv6 networks together')
+        version = subnet.version
+        network = subnet.get_network()
+        ranges.append((network.ip_int, network.ip_int |
+                       (1 << network.bits - network.prefixlen) - 1))
+    ranges.sort()
+    bits = ADDRESS_BITS.get(version, 32)
+
+    blocks = []
+    index = 0
+    while index < len(ranges):
+        first, last = ranges[index]
+        index += 1
+        while index < len(ranges) and ranges[index][0] <= last + 1:
+            last = max(last, ranges[index][1])
+            index += 1
+        blocks.extend(range_to_prefixes(first, last, bits))
+
+    if smart:
+        blocks = merge_prefixes(blocks, overcoverage, bits)
+    if version == 'ipv6':
+        return ['%s/%d' % (int_to_ipv6(network), prefixlen)
+                for network, prefixlen in blocks]
+    separator = '' if view == 'slash' else ' '
+    try:
+        return ['%s%s%s' % (int_to_ipv4(network), separator,
+                            MASK_VIEWS[prefixlen][view])
+                for network, prefixlen in blocks]
+    except KeyError:
+        raise WrongMaskError('Wrong view %r' % view)
+
+def merge_prefixes(blocks, overcoverage, bits=32):
+    """Merges sorted non-overlapping prefixes into supernets while
+    addresses not covered by the original prefixes take not more than
+    overcoverage share of the supernet.
+    Input:
+      blocks - list of tuples (network as integer, prefix length)
+      overcoverage - float, from 0 to 1
+      bits - int, length of the address: 32 for ipv4, 128 for ipv6
+    Output: list of tuples (network as integer, prefix length)
+    """
+    # stack of merged prefixes, covered[i] is the number of original
+    # addresses in the first i + 1 prefixes of the stack
+    starts, prefixlens, covered = [], [], []
+    for network, prefixlen in blocks:
+        starts.append(network)
+        prefixlens.append(prefixlen)
+        covered.append((covered[-1] if covered else 0) +
+                       (1 << bits - prefixlen))
+        while len(starts) > 1:
+            # the smallest supernet of the two last prefixes
+            supernet_prefixlen = bits - (starts[-2] ^ starts[-1]).bit_length()
+            size = 1 << bits - supernet_prefixlen
+            supernet = starts[-1] & -size
+            first = bisect.bisect_left(starts, supernet)
+            total = covered[-1]
+            inside = total - (covered[first - 1] if first else 0)
+            if size - inside > overcoverage * size:
+                break
+            del starts[first:], prefixlens[first:], covered[first:]
+            starts.append(supernet)
+            prefixlens.append(supernet_prefixlen)
+            covered.append(total)
+    return list(zip(starts, prefixlens))
 
 def convert_to_wildcard(ip, view='decimal'):
     """Returns inverted ip address in the given notation.
     Input:
-      ip - ip address in binary form
+      ip - netmask in binary form
       view - string, desired notation. Can be one of three:
             'decimal', 'slash' or 'binary'
     Output:
       string - ip address in the given notation
     """
-    ip = int(ip.replace('.', ''), 2)
-    all_ones_mask = int(convert_mask("255.255.255.255", 'binary')
-                    .replace('.', ''), 2)
-    wildcard = bin(ip ^ all_ones_mask)[2:].zfill(32)
-    return convert_mask(wildcard, view)
+    wildcard = MASK_VIEWS[MASK_NOTATIONS[ip][0]]['wildcard']
+    if view == 'decimal':
+        return wildcard
+    return convert_ip(wildcard, view)
+
+def convert_ip(ip, view='decimal'):
+    """Shows ipv4 address, which is not necessarily a netmask,
+    in the given notation.
+    Input:
+      ip - string, ip address in the decimal form
+      view - string, desired notation. Can be one of three:
+            'decimal', 'slash' (number of leading ones) or 'binary'
+    Output:
+      string - ip address in the given notation
+    """
+    binary = '{0:032b}'.format(ipv4_to_int(ip))
+    if view == 'binary':
+        return '.'.join(binary[i:i + 8] for i in range(0, 32, 8))
+    elif view == 'slash':
+        return '/%d' % (len(binary) - len(binary.lstrip('1')))
+    return ip
+
+def range_to_prefixes(first, last, bits=32):
+    """Splits inclusive range of addresses into the minimal list of
+    prefixes covering exactly this range.
+    Input:
+      first - int, first address of the range
+      last - int, last address of the range
+      bits - int, length of the address: 32 for ipv4, 128 for ipv6
+    Output: generator of tuples (network as integer, prefix length)
+    """
+    while first <= last:
+        # the block has to be aligned on its size and fit into the range
+        host_bits = (first & -first).bit_length() - 1 if first else bits
+        host_bits = min(host_bits, (last - first + 1).bit_length() - 1)
+        yield first, bits - host_bits
+        first += 1 << host_bits
+
+
+class PrefixTrie(object):
+    """Path-compressed binary trie of network prefixes.
+    Gives the longest prefix match for an address in at most
+    `bits` steps no matter how many prefixes are stored.
+    Every prefix is stored as a pair of integers: network address
+    and prefix length.
+    """
+    __slots__ = ('bits', 'root', 'size')
+
+    class Node(object):
+        __slots__ = ('prefix', 'prefixlen', 'value', 'has_value', 'children')
+
+        def __init__(self, prefix, prefixlen):
+            self.prefix = prefix
+            self.prefixlen = prefixlen
+            self.value = None
+            self.has_value = False
+            self.children = [None, None]
+
+    def __init__(self, bits=32):
+        """Initializes an empty trie.
+        Input:
+          bits - int, length of the address: 32 for ipv4, 128 for ipv6
+        Output: None
+        """
+        self.bits = bits
+        self.root = PrefixTrie.Node(0, 0)
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def get_bit(self, address, position):
+        """Returns the bit of the address at position counting from
+        the most significant one"""
+        return address >> (self.bits - 1 - position) & 1
+
+    def network(self, address, prefixlen):
+        """Returns the address with host bits set to zero"""
+        host_bits = self.bits - prefixlen
+        return address >> host_bits << host_bits
+
+    def common_prefixlen(self, first, second, limit):
+        """Returns the length of the common prefix of two addresses,
+        but not more than limit"""
+        difference = first ^ second
+        if not difference:
+            return limit
+        return min(limit, self.bits - difference.bit_length())
+
+    def insert(self, prefix, prefixlen, value):
+        """Stores value for the prefix, replacing the previous value
+        if the prefix already exists.
+        Input:
+          prefix - int, network address
+          prefixlen - int, prefix length
+          value - any object
+        Output: None
+        """
+        prefix = self.network(prefix, prefixlen)
+        node = self.root
+        while node.prefixlen != prefixlen:
+            bit = self.get_bit(prefix, node.prefixlen)
+            child = node.children[bit]
+            if child is None:
+                child = node.children[bit] = PrefixTrie.Node(prefix, prefixlen)
+                node = child
+                break
+            common = self.common_prefixlen(child.prefix, prefix,
+                                           min(child.prefixlen, prefixlen))
+            if common == child.prefixlen:
+                node = child
+                continue
+            # new node is placed between node and its child
+            split = PrefixTrie.Node(self.network(prefix, common), common)
+            split.children[self.get_bit(child.prefix, common)] = child
+            node.children[bit] = split
+            node = split
+            if common != prefixlen:
+                leaf = PrefixTrie.Node(prefix, prefixlen)
+                split.children[self.get_bit(prefix, common)] = leaf
+                node = leaf
+            break
+        if not node.has_value:
+            self.size += 1
+        node.value = value
+        node.has_value = True
+
+    def get(self, prefix, prefixlen, default=None):
+        """Returns value stored exactly for the prefix
+        Input:
+          prefix - int, network address
+          prefixlen - int, prefix length
+          default - returned if prefix is not found
+        Output: stored value or default
+        """
+        node = self.root
+        while node is not None and node.prefixlen < prefixlen:
+            node = node.children[self.get_bit(prefix, node.prefixlen)]
+        if node is not None and node.has_value and \
+                node.prefixlen == prefixlen and node.prefix == prefix:
+            return node.value
+        return default
+
+    def longest_match(self, address):
+        """Finds the most specific prefix containing the address.
+        Input:
+          address - int
+        Output: tuple (network, prefix length, value) or None
+        """
+        best = None
+        node = self.root
+        bits = self.bits
+        while node is not None:
+            if (address ^ node.prefix) >> (bits - node.prefixlen):
+                break
+            if node.has_value:
+                best = node
+            if node.prefixlen == bits:
+                break
+            node = node.children[address >> (bits - 1 - node.prefixlen) & 1]
+        if best is not None:
+            return best.prefix, best.prefixlen, best.value
+        return None
+
+    def lookup(self, address, default=None):
+        """Returns value of the longest prefix containing the address
+        Input:
+          address - int
+          default - returned if nothing matches
+        Output: stored value or default
+        """
+        match = self.longest_match(address)
+        if match is None:
+            return default
+        return match[2]
+
+    def items(self):
+        """Returns all stored prefixes sorted by address and length
+        Input: None
+        Output: generator of tuples (network, prefix length, value)
+        """
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if node.has_value:
+                yield node.prefix, node.prefixlen, node.value
+            for child in reversed(node.children):
+                if child is not None:
+                    stack.append(child)
+
+# networks from ipv4[1] and ipv6[1] for the longest prefix match
+ipv4_networks = PrefixTrie(32)
+ipv6_networks = PrefixTrie(128)
+
+class ParseCache(object):
+    """Bounded LRU cache of parsed IPAddress and Subnet instances
+    by the string they were created from. Size 0 disables the cache.
+    """
+
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Returns cached instance or None"""
+        instance = self.entries.get(key)
+        if instance is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.entries.move_to_end(key)
+        return instance
+
+    def put(self, key, instance):
+        if self.maxsize <= 0:
+            return
+        self.entries[key] = instance
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def resize(self, maxsize):
+        """Changes the size of the cache, least recently used entries
+        are dropped if there are too many of them.
+        Input:
+          maxsize - int, maximal number of entries, 0 disables the cache
+        Output: None
+        """
+        self.maxsize = maxsize
+        while len(self.entries) > max(maxsize, 0):
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        """Drops all entries and resets statistics"""
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        """Returns dict with hits, misses, current size and maxsize"""
+        return {'hits': self.hits, 'misses': self.misses,
+                'size': len(self.entries), 'maxsize': self.maxsize}
+
+# cache used by IPAddress() and Subnet()
+parse_cache = ParseCache()
 
 def get_input_topology(path):
     with open(path) as f:
         topology = json.load(f)
     return topology
 
+def json_digest(value):
+    """Computes sha256 hex digest of the value in the normalized json form,
+    keys of objects are sorted.
+    """
+    text = json.dumps(value, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class JSONStream(object):
+    """Reads a json document from a file piece by piece, so large
+    arrays and objects can be walked without loading the whole document.
+    Values are decoded by json.JSONDecoder.raw_decode, only the containers
+    walked with items() and elements() are never decoded as a whole.
+    Malformed json raises ValueError.
+    """
+    decoder = json.JSONDecoder()
+    whitespace = re.compile(r'[ \t\n\r]*')
+
+    def __init__(self, f, chunk_size=65536):
+        """Initializes the stream.
+        Input:
+          f - file object opened in the text mode
+          chunk_size - int, number of characters read at once
+        Output: None
+        """
+        self.file = f
+        self.chunk_size = chunk_size
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        """Drops the consumed text and reads more, reads at least as much
+        as is left in the buffer, so a long value is retried only
+        a logarithmic number of times.
+        Output: boolean, False at the end of the file
+        """
+        if self.eof:
+            return False
+        text = self.file.read(max(self.chunk_size,
+                                  len(self.buffer) - self.pos))
+        self.buffer = self.buffer[self.pos:] + text
+        self.pos = 0
+        if not text:
+            self.eof = True
+        return bool(text)
+
+    def peek(self):
+        """Skips whitespace and returns the next character,
+        empty string at the end of the file"""
+        while True:
+            self.pos = self.whitespace.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.fill():
+                return ''
+
+    def expect(self, chars):
+        """Consumes the next character, which must be one of chars"""
+        char = self.peek()
+        if not char or char not in chars:
+            raise ValueError('Expected one of {!r} at {}'
+                             .format(chars, self.pos))
+        self.pos += 1
+        return char
+
+    def value(self):
+        """Decodes the next value as a whole"""
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+                # a number at the end of the buffer may continue in the file,
+                # also when only its part before '.' or the exponent was read
+                if self.eof or end < len(self.buffer) and not (
+                        isinstance(value, (int, float)) and
+                        not isinstance(value, bool) and
+                        self.buffer[end] in '.eE+-'):
+                    self.pos = end
+                    return value
+            except ValueError:
+                if self.eof:
+                    raise
+            self.fill()
+
+    def items(self):
+        """Walks the object at the current position.
+        Output: generator of keys, the value of every key must be read
+          with value(), items() or elements() before the next key
+        """
+        self.expect('{')
+        if self.peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            self.expect(':')
+            yield key
+            if self.expect(',}') == '}':
+                return
+
+    def elements(self):
+        """Walks the array at the current position.
+        Output: generator of decoded elements
+        """
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield self.value()
+            if self.expect(',]') == ']':
+                return
+
+
+def iter_topology(path, chunk_size=65536):
+    """Reads the topology file piece by piece, only one node or link
+    is decoded at a time.
+    Input:
+      path - string, path to the topology json file
+      chunk_size - int, number of characters read at once
+    Output:
+      generator of tuples (kind, json), where kind is one of
+      'options', 'node' or 'link', in the order of the file
+    """
+    with open(path) as f:
+        stream = JSONStream(f, chunk_size)
+        for key in stream.items():
+            if key == 'topology':
+                for section in stream.items():
+                    if section == 'nodes' or section == 'links':
+                        for item in stream.elements():
+                            yield section[:-1], item
+                    else:
+                        stream.value()
+            elif key == 'options':
+                yield 'options', stream.value()
+            else:
+                stream.value()
+
 class IPAddress(object):
     """Ip address model with a lot of helper functions,
     like: converting ip to the binary form,
@@ -158,67 +791,197 @@ class IPAddress(object):
     if ip address belongs to the network
     what network is associated with current ip address and mask
     and so on
-    * TODO: ipv6
+    The address and the prefix length are kept as integers for both
+    ipv4 and ipv6, string forms are only produced on demand.
     """
+    __slots__ = ('version', 'ip', 'ip_int', 'prefixlen')
+
     class WrongIPError(Exception):
         """Raise if input ip notation is wrong
         """
         pass
 
 
-    def __init__(self, ip_address, version='ipv4'):
-        """Initializes instance of IPAddress class.
+    def __new__(cls, ip_address, version='ipv4'):
+        """Returns instance of IPAddress class. Instances are immutable,
+        so the same instance is returned for the same string while it is
+        in parse_cache, and the string is not parsed again.
         Input:
           ip_address - string, for ipv4 one of three options:
             1.2.3.4
             1.2.3.4/24
             1.2.3.4 255.255.255.0
+            for ipv6 one of two options:
+            2001:db8::1
+            2001:db8::1/64
           version - string, one of two options:
             ipv4
-            ipv6 - not implemented yet
-        Output: None
+            ipv6
+        Output: IPAddress instance
+        """
+        key = (cls, ip_address, version)
+        instance = parse_cache.get(key)
+        if instance is None:
+            instance = cls.parse(ip_address, version)
+            parse_cache.put(key, instance)
+        return instance
+
+    @classmethod
+    def parse(cls, ip_address, version='ipv4'):
+        """Parses ip address bypassing parse_cache.
+        Input: the same as for IPAddress()
+        Output: instance of cls
         """
-        self.version = version
+        prefixlen = None
         if version == 'ipv4':
             match = re.match(IPV4_RE, ip_address.strip())
             if match:
-                self.ip = match.group(1)
-                self.ip_binary = self.get_binary_form()
-                if len(self.ip_binary) != 32:
+                ip = match.group(1)
+                try:
+                    ip_int = ipv4_to_int(ip)
+                except ValueError:
                     raise IPAddress.WrongIPError('This is not a '
                                                  'valid ipv4 address')
                 # if netmask is specified
                 if match.group(3):
-                    self.mask = convert_mask(match.group(3), 'decimal')
+                    prefixlen = IPAddress.parse_prefixlen(match.group(3))
             else:
                 raise IPAddress.WrongIPError('This is not a '
                                              'valid ipv4 address')
         elif version == 'ipv6':
-            # TODO
-            pass
+            match = re.match(IPV6_RE, ip_address.strip())
+            try:
+                ip_int = ipv6_to_int(match.group(1))
+            except (AttributeError, ValueError):
+                raise IPAddress.WrongIPError('This is not a '
+                                             'valid ipv6 address')
+            ip = int_to_ipv6(ip_int)
+            if match.group(2):
+                prefixlen = int(match.group(2)[1:])
+                if prefixlen > 128:
+                    raise IPAddress.WrongIPError('This is not a '
+                                                 'valid ipv6 prefix')
         else:
             raise IPAddress.WrongIPError('This is not a valid ip address')
+        return cls.create(version, ip, ip_int, prefixlen)
+
+    @classmethod
+    def from_int(cls, ip_int, prefixlen=None, version='ipv4'):
+        """Creates an instance directly from the integer form,
+        without parsing any strings.
+        Input:
+          ip_int - int, ip address
+          prefixlen - int or None, length of the network prefix
+          version - string, 'ipv4' or 'ipv6'
+        Output: instance of cls
+        """
+        bits = ADDRESS_BITS.get(version)
+        if bits is None or not 0 <= ip_int < 1 << bits:
+            raise IPAddress.WrongIPError('This is not a valid ip address')
+        if prefixlen is not None and not 0 <= prefixlen <= bits:
+            raise IPAddress.WrongIPError('This is not a valid mask')
+        if version == 'ipv4':
+            ip = int_to_ipv4(ip_int)
+        else:
+            ip = int_to_ipv6(ip_int)
+        return cls.create(version, ip, ip_int, prefixlen)
+
+    @classmethod
+    def create(cls, version, ip, ip_int, prefixlen):
+        """Creates an instance from already validated parts.
+        Input:
+          version - string, 'ipv4' or 'ipv6'
+          ip - string, ip address as it is shown
+          ip_int - int, ip address
+          prefixlen - int or None, length of the network prefix
+        Output: instance of cls
+        """
+        instance = object.__new__(cls)
+        object.__setattr__(instance, 'version', version)
+        object.__setattr__(instance, 'ip', ip)
+        object.__setattr__(instance, 'ip_int', ip_int)
+        object.__setattr__(instance, 'prefixlen', prefixlen)
+        return instance
+
+    @staticmethod
+    def parse_prefixlen(netmask):
+        """Converts the mask part of the ip notation into prefix length.
+        Input:
+          netmask - string, '/24', ' 255.255.255.0' or ' - 1.2.3.4'
+        Output: int, prefix length or None if netmask is an ip range
+        """
+        netmask = netmask.strip()
+        if netmask.startswith('-'):
+            return None
+        try:
+            return MASK_NOTATIONS[netmask][0]
+        except KeyError:
+            raise IPAddress.WrongIPError('This is not a valid ipv4 mask')
+
+    @property
+    def ip_binary(self):
+        return self.get_binary_form()
+
+    @property
+    def bits(self):
+        """Length of the address: 32 for ipv4, 128 for ipv6"""
+        return ADDRESS_BITS[self.version]
+
+    @property
+    def mask(self):
+        """Netmask if it was specified, None otherwise. For ipv4 the mask
+        is in the decimal form, for ipv6 - in the slash notation"""
+        if self.prefixlen is not None:
+            if self.version == 'ipv6':
+                return '/%d' % self.prefixlen
+            return int_to_ipv4(PREFIX_MASKS[self.prefixlen])
+
+    @property
+    def mask_int(self):
+        """Netmask (classful if not specified) as integer or None"""
+        prefixlen = self.get_prefixlen()
+        if prefixlen is not None:
+            return PREFIX_MASKS_BY_VERSION[self.version][prefixlen]
+
+    @property
+    def mask_binary(self):
+        """Netmask (classful if not specified) in the binary form
+        without dots or None"""
+        mask_int = self.mask_int
+        if mask_int is not None:
+            return '{0:0{1}b}'.format(mask_int, self.bits)
 
     def get_binary_form(self):
         """Shows ip address in the binary form without dots.
         Input: None
         Output:
-          string, 32-bit ip address in the binary form without dots
+          string, 32-bit (128-bit for ipv6) ip address in the binary form
+          without dots
         """
-        # careful, nevertheless ip address is not a mask
-        # function convert_mask is used
-        return convert_mask(self.ip, 'binary').replace('.', '')
+        return '{0:0{1}b}'.format(self.ip_int, self.bits)
 
     def get_class(self):
         """Defines ip address class if classful addressing is used,
         data is taken from the dictionary ip_to_class
         Input: None
         Output:
-          string, class of ip address, one of ['A', 'B', 'C', 'D', 'E']
+          string, class of ip address, one of ['A', 'B', 'C', 'D', 'E'],
+          None for ipv6
         """
-        for key in ip_to_class:
-            if self.ip_binary.startswith(key):
-                return ip_to_class[key]
+        if self.version == 'ipv4':
+            return CLASS_BY_FIRST_BITS[self.ip_int >> 28]
+
+    def get_prefixlen(self):
+        """Returns the prefix length for the given ip address. If ip address
+        was previously specified with mask, then it is returned,
+        classful prefix length - otherwise.
+        Input: None
+        Output: int, prefix length or None for classes D, E
+          and ipv6 addresses without prefix
+        """
+        if self.prefixlen is not None or self.version == 'ipv6':
+            return self.prefixlen
+        return CLASSFUL_PREFIXLEN.get(self.get_class())
 
     def get_mask(self):
         """Returns a subnet mask for the given ip address. If ip address was
@@ -228,24 +991,31 @@ class IPAddress(object):
         Output: string, netmask for the given ip.
         """
         if self.version == 'ipv4':
-            try:
+            if self.prefixlen is not None:
                 return self.mask
-            except AttributeError:
-                return class_info[self.get_class()][0]
+            return class_info[self.get_class()][0]
         elif self.version == 'ipv6':
-            pass
+            return self.mask
 
     def get_wildcard(self, view='decimal'):
         """Returns a wildcard for the mask of given ip address in the
         given view.
         If the ip address does not have mask, returns '0.0.0.0'
+        For ipv6 the wildcard is always shown as ipv6 address.
         Input:
           view - string, desired notation. Can be one of three:
           'decimal', 'slash' or 'binary'
         """
-        if not self.mask:
+        if self.version == 'ipv6':
+            if self.prefixlen is None:
+                return '::'
+            return int_to_ipv6(ALL_ONES_IPV6 >> self.prefixlen)
+        if self.prefixlen is None:
             return convert_mask('0.0.0.0', view)
-        return convert_to_wildcard(self.mask_binary, view)
+        wildcard = MASK_VIEWS[self.prefixlen]['wildcard']
+        if view == 'decimal':
+            return wildcard
+        return convert_ip(wildcard, view)
 
     def is_in_subnet(self, subnet):
         """Shows if ip belongs to the given subnet
@@ -253,8 +1023,8 @@ class IPAddress(object):
         Output: boolean
         """
         # host is in subnet if host address AND subnet mask = network address
-        return int(self.ip_binary, 2) & int(subnet.mask_binary, 2) == \
-                                        int(subnet.ip_binary, 2)
+        return self.version == subnet.version and \
+               self.ip_int & subnet.mask_int == subnet.ip_int
 
     def is_subnet(self):
         """Shows if ip with mask is subnet address
@@ -262,11 +1032,9 @@ class IPAddress(object):
         Output: boolean
         """
         # ip address is subnet if ip address AND mask = this ip address
-        mask = self.get_mask()
-        if mask:
-            mask_binary = convert_mask(mask, 'binary').replace('.', '')
-            return int(self.ip_binary, 2) & int(mask_binary, 2) == \
-                                        int(self.ip_binary, 2)
+        mask_int = self.mask_int
+        if mask_int is not None:
+            return self.ip_int & mask_int == self.ip_int
 
     def is_in_range(self, low, high):
         """Shows if ip belongs to the given ip address range (inclusive)
@@ -275,12 +1043,8 @@ class IPAddress(object):
           high, IPAddress class instance, high boundary
         Output: boolean
         """
-        ips = []
-        for ip in low, self, high:
-            ips.append(int(ip.ip_binary, 2))
-        # trick: if current ip is in specified range
-        # then this array is already sorted
-        return ips == sorted(ips)
+        return low.version == self.version == high.version and \
+               low.ip_int <= self.ip_int <= high.ip_int
 
     def get_description(self):
         """Shows additional description if specified in files ipv4.txt
@@ -291,12 +1055,11 @@ class IPAddress(object):
         if self.version == 'ipv4':
             description = ipv4[0].get(self.ip, '')
             if not description:
-                for key in ipv4[1]:
-                    if self.is_in_subnet(Subnet(key)):
-                        description = ipv4[1][key]
-                        break
+                description = ipv4_networks.lookup(self.ip_int, '')
         elif self.version == 'ipv6':
-            pass
+            description = ipv6[0].get(self.ip, '')
+            if not description:
+                description = ipv6_networks.lookup(self.ip_int, '')
         return description
 
     def get_summary(self):
@@ -310,7 +1073,8 @@ class IPAddress(object):
         mask = self.get_mask()
         if mask:
             summary.append(mask)
-        summary.append(class_info[self.get_class()][1])
+        if self.version == 'ipv4':
+            summary.append(class_info[self.get_class()][1])
         description = self.get_description()
         if description:
             summary.append(description)
@@ -322,15 +1086,10 @@ class IPAddress(object):
         Input: None
         Output: Subnet class instance
         """
-        mask = self.get_mask()
-        if mask:
-            mask_binary = convert_mask(mask, 'binary').replace('.', '')
-            network_binary = list(bin(int(self.ip_binary, 2) \
-                                  & int(mask_binary, 2))[2:].zfill(32))
-            for i in range(1, 4):
-                network_binary.insert(32 - 8 * i, '.')
-            network_address = convert_mask(''.join(network_binary))
-            return Subnet('%s %s' % (network_address, mask))
+        prefixlen = self.get_prefixlen()
+        if prefixlen is not None:
+            return Subnet.from_int(self.ip_int & self.mask_int,
+                                   prefixlen, self.version)
         return None
 
     def __eq__(self, other):
@@ -340,95 +1099,633 @@ class IPAddress(object):
         Output: Boolean, if two object are equal
         """
         try:
-            return self.ip == other.ip, self.get_mask() == other.get_mask()
-        except:
+            return self.ip_int == other.ip_int and \
+                   self.version == other.version and \
+                   self.get_prefixlen() == other.get_prefixlen()
+        except AttributeError:
             return False
 
+    def __hash__(self):
+        return hash((self.version, self.ip_int, self.get_prefixlen()))
+
+    def __setattr__(self, name, value):
+        raise AttributeError('%s is immutable' % type(self).__name__)
+
+    def __delattr__(self, name):
+        raise AttributeError('%s is immutable' % type(self).__name__)
+
+    def __reduce__(self):
+        return (type(self).create,
+                (self.version, self.ip, self.ip_int, self.prefixlen))
+
     def __str__(self):
         return self.ip
 
     def __add__(self, other):
-        new_ip = bin(int(self.ip_binary, 2) + other)[2:].zfill(32)
-        return IPAddress(convert_mask(new_ip))
+        return IPAddress.from_int(self.ip_int + other, version=self.version)
 
     def __sub__(self, other):
-        new_ip = bin(int(self.ip_binary, 2) - other)[2:].zfill(32)
-        return IPAddress(convert_mask(new_ip))
+        return IPAddress.from_int(self.ip_int - other, version=self.version)
 
 
 class Subnet(IPAddress):
     """Model of a subnet with a lot of helper functions,
     like: dividing subnet using VLSM, subnet summarization,
     getting first, last, broadcast ip addresses and many others
+    Subnet is created from the same strings as IPAddress, like
+    1.2.3.0/24, 1.2.3.0 255.255.255.0, 1.2.3.0 or 2001:db8::/32 for ipv6.
+    If the mask is not specified, the classful mask is used.
     """
+    __slots__ = ()
 
     class WrongSubnetError(Exception):
         """Raise if input ip is not a subnet
         """
         pass
 
-    def __init__(self, ip_address):
-        """Initializes Subnet instance based on IPAddress class
-        Input:
-          ip_address - string, one of three options:
-            1.2.3.4
-            1.2.3.4/24
-            1.2.3.4 255.255.255.0
-        Output: None
+    @classmethod
+    def create(cls, version, ip, ip_int, prefixlen):
+        """Creates a subnet from already validated parts, checks that
+        the address is a network address.
+        Input: the same as for IPAddress.create
+        Output: Subnet instance
         """
-        super(Subnet, self).__init__(ip_address)
-        if not self.is_subnet():
+        subnet = super(Subnet, cls).create(version, ip, ip_int, prefixlen)
+        if not subnet.is_subnet():
             raise Subnet.WrongSubnetError("This is not a valid "
                                           "network address")
-        self.mask = self.get_mask()
-        self.mask_binary = convert_mask(self.mask, 'binary').replace('.', '')
+        object.__setattr__(subnet, 'prefixlen', subnet.get_prefixlen())
+        return subnet
 
     def get_first_address(self):
         """Returns the first usable host address in the subnet.
-        If subnet is /32 returns exact ip address.
+        If subnet is /32 (/128) returns exact ip address.
         Input: None
         Output: IPAddress object"""
-        if (convert_mask(self.get_mask(), view="slash")) == '/32':
+        if self.prefixlen == self.bits:
             return self
         return self + 1
 
     def get_broadcast_address(self):
-        """Returns the broadcast address of the subnet.
-        If subnet is /32 returns exact ip address.
+        """Returns the broadcast address of the subnet, for ipv6 subnet
+        which does not have broadcast - the highest address.
+        If subnet is /32 (/128) returns exact ip address.
         Input: None
         Output: IPAddress object"""
-        if (convert_mask(self.get_mask(), view="slash")) == '/32':
+        if self.prefixlen == self.bits:
             return self
-        network_binary = int(self.ip_binary, 2)
-        all_ones_mask = int(convert_mask(self.get_wildcard(), 'binary')
-                        .replace('.', ''), 2)
-        broadcast_address = bin(network_binary | all_ones_mask)[2:].zfill(32)
-        return IPAddress(convert_mask(broadcast_address))
+        wildcard = (1 << self.bits - self.prefixlen) - 1
+        return IPAddress.from_int(self.ip_int | wildcard, version=self.version)
 
     def get_last_address(self):
         """Returns the last usable host address in the subnet.
-        If subnet is /32 returns exact ip address.
+        If subnet is /32 (/128) returns exact ip address.
         Input: None
         Output: IPAddress object"""
-        if (convert_mask(self.get_mask(), view="slash")) == '/32':
+        if self.prefixlen == self.bits:
             return self
+        if self.version == 'ipv6':
+            return self.get_broadcast_address()
         return self.get_broadcast_address() - 1
 
+    def divide(self, prefixlen, lazy=False):
+        """Divides the subnet into networks of the same size.
+        Input:
+          prefixlen - int, prefix length of the networks
+          lazy - boolean, if True, networks are generated one by one
+                 instead of building the whole list
+        Output: list or generator of Subnet instances
+        """
+        if not self.prefixlen <= prefixlen <= self.bits:
+            raise Subnet.WrongSubnetError("Can not divide /%d into /%d"
+                                          % (self.prefixlen, prefixlen))
+        step = 1 << self.bits - prefixlen
+        last = self.ip_int | (1 << self.bits - self.prefixlen) - 1
+        networks = (Subnet.from_int(network, prefixlen, self.version)
+                    for network in range(self.ip_int, last + 1, step))
+        if lazy:
+            return networks
+        return list(networks)
+
+    def allocate(self, host_counts):
+        """Divides the subnet using VLSM: every network gets the smallest
+        block fitting the required number of hosts. The biggest networks
+        are allocated first, so the space is not fragmented.
+        Input:
+          host_counts - list of int, number of hosts in every network
+        Output: list of Subnet instances in the order of host_counts
+        Raises SubnetAllocator.NoSpaceError if the subnet is too small
+        """
+        allocator = SubnetAllocator(self)
+        networks = [None] * len(host_counts)
+        order = sorted(range(len(host_counts)),
+                       key=lambda index: host_counts[index], reverse=True)
+        for index in order:
+            networks[index] = allocator.allocate_hosts(host_counts[index])
+        return networks
+
+
+class SubnetAllocator(object):
+    """Buddy allocator of networks inside a subnet. Free blocks are kept
+    in a heap per prefix length, a bigger block is split in halves only
+    when there is no free block of the requested size, and released
+    blocks are merged back with their free buddies. Every operation
+    takes O(32 log n), the parent subnet is never rescanned.
+    """
+
+    class NoSpaceError(Exception):
+        """Raise if there is no free block of the requested size
+        """
+        pass
+
+    def __init__(self, subnet):
+        """Initializes allocator with the whole subnet free
+        Input:
+          subnet - Subnet instance
+        Output: None
+        """
+        self.subnet = subnet
+        self.bits = subnet.bits
+        # heaps of free networks by prefix length, released blocks are
+        # removed from the heaps lazily, self.free_sets are up to date
+        self.free = [[] for _ in range(self.bits + 1)]
+        self.free_sets = [set() for _ in range(self.bits + 1)]
+        self.add_free_block(subnet.ip_int, subnet.prefixlen)
+
+    def add_free_block(self, network, prefixlen):
+        heapq.heappush(self.free[prefixlen], network)
+        self.free_sets[prefixlen].add(network)
+
+    def pop_free_block(self, prefixlen):
+        """Returns the lowest free network of the given size or None"""
+        heap = self.free[prefixlen]
+        while heap:
+            network = heapq.heappop(heap)
+            if network in self.free_sets[prefixlen]:
+                self.free_sets[prefixlen].remove(network)
+                return network
+        return None
+
+    def allocate(self, prefixlen):
+        """Allocates the lowest free network of the given size.
+        Input:
+          prefixlen - int, prefix length of the network
+        Output: Subnet instance
+        """
+        if not self.subnet.prefixlen <= prefixlen <= self.bits:
+            raise SubnetAllocator.NoSpaceError("/%d does not fit into %s/%d"
+                                               % (prefixlen, self.subnet.ip,
+                                                  self.subnet.prefixlen))
+        for length in range(prefixlen, self.subnet.prefixlen - 1, -1):
+            network = self.pop_free_block(length)
+            if network is not None:
+                break
+        else:
+            raise SubnetAllocator.NoSpaceError("No free /%d in %s/%d"
+                                               % (prefixlen, self.subnet.ip,
+                                                  self.subnet.prefixlen))
+        # the upper halves of the split block stay free
+        while length < prefixlen:
+            length += 1
+            self.add_free_block(network | 1 << self.bits - length, length)
+        return Subnet.from_int(network, prefixlen, self.subnet.version)
+
+    def allocate_hosts(self, hosts):
+        """Allocates the smallest network with enough addresses for hosts,
+        network and broadcast addresses.
+        Input:
+          hosts - int, number of hosts
+        Output: Subnet instance
+        """
+        return self.allocate(self.bits - (max(hosts, 1) + 1).bit_length())
+
+    def release(self, subnet):
+        """Returns previously allocated network to the allocator
+        Input:
+          subnet - Subnet instance
+        Output: None
+        """
+        network, prefixlen = subnet.ip_int, subnet.prefixlen
+        while prefixlen > self.subnet.prefixlen:
+            buddy = network ^ 1 << self.bits - prefixlen
+            if buddy not in self.free_sets[prefixlen]:
+                break
+            self.free_sets[prefixlen].remove(buddy)
+            network &= buddy
+            prefixlen -= 1
+        self.add_free_block(network, prefixlen)
+
+
+class TemplateRegistry(object):
+    """Config snippets from TEMPLATES_DIR, every file is read and
+    parsed once per process. Modification time of the file is checked
+    not more often than once in check_interval seconds, and the file
+    is read again only if it was changed.
+    """
+
+    class Template(object):
+        __slots__ = ('render', 'mtime', 'checked')
+
+    def __init__(self, directory=TEMPLATES_DIR, check_interval=1.0):
+        """Initializes an empty registry.
+        Input:
+          directory - string, path to the directory with templates
+          check_interval - float, seconds between mtime checks,
+                           None disables the checks
+        Output: None
+        """
+        self.directory = directory
+        self.check_interval = check_interval
+        self.templates = {}
+        self.reads = 0
+        self.hits = 0
+
+    def load(self, path, mtime):
+        """Reads the snippet and prepares it for rendering"""
+        with open(path) as f:
+            snippet = f.read()
+        self.reads += 1
+        template = TemplateRegistry.Template()
+        template.render = snippet.format
+        template.mtime = mtime
+        template.checked = time.monotonic()
+        self.templates[path] = template
+        return template
+
+    def get(self, vendor, name):
+        """Returns the template for the vendor.
+        Input:
+          vendor - string, like 'cisco'
+          name - string, file name without '.cfg', like 'ssh'
+        Output: TemplateRegistry.Template instance,
+          template.render(**fields) returns the rendered snippet
+        """
+        path = os.path.join(self.directory, vendor, name + '.cfg')
+        template = self.templates.get(path)
+        if template is None:
+            return self.load(path, os.stat(path).st_mtime)
+        if self.check_interval is not None:
+            now = time.monotonic()
+            if now - template.checked >= self.check_interval:
+                template.checked = now
+                mtime = os.stat(path).st_mtime
+                if mtime != template.mtime:
+                    return self.load(path, mtime)
+        self.hits += 1
+        return template
+
+    def render(self, vendor, name, **fields):
+        """Renders the template for the vendor with the given fields
+        Input:
+          vendor - string, like 'cisco'
+          name - string, file name without '.cfg', like 'ssh'
+          fields - values of the placeholders in the template
+        Output: string
+        """
+        return self.get(vendor, name).render(**fields)
+
+    def clear(self):
+        """Forgets all loaded templates and resets statistics"""
+        self.templates.clear()
+        self.reads = 0
+        self.hits = 0
+
+# templates used to build device configs
+templates = TemplateRegistry()
+
+
+class VlanSet(object):
+    """Set of vlans 1-4094 kept as a bitmap in one integer, bit n is set
+    if vlan n belongs to the set. Iteration gives vlans in the numeric
+    order, str() gives compressed ranges, like '1-10,20,500-600'.
+    """
+    __slots__ = ('bits',)
+    MAX_VLAN = 4094
+
+    class WrongVlanError(Exception):
+        """Raise if vlan number is not in range 1-4094
+        """
+        pass
+
+    def __init__(self, vlans=()):
+        """Initializes the set.
+        Input:
+          vlans - iterable of ints or string of ranges, like '1-10,20'
+        Output: None
+        """
+        self.bits = 0
+        if isinstance(vlans, VlanSet):
+            self.bits = vlans.bits
+        elif isinstance(vlans, str):
+            for part in vlans.split(','):
+                first, _, last = part.partition('-')
+                try:
+                    self.add_range(int(first), int(last or first))
+                except ValueError:
+                    raise VlanSet.WrongVlanError('This is not a valid '
+                                                 'vlan range: ' + part)
+        else:
+            self.update(vlans)
+
+    @staticmethod
+    def check(vlan):
+        if not isinstance(vlan, int) or not 1 <= vlan <= VlanSet.MAX_VLAN:
+            raise VlanSet.WrongVlanError('This is not a valid vlan: {}'
+                                         .format(vlan))
+
+    def add(self, vlan):
+        VlanSet.check(vlan)
+        self.bits |= 1 << vlan
+
+    def add_range(self, first, last):
+        """Adds vlans from first to last inclusive"""
+        VlanSet.check(first)
+        VlanSet.check(last)
+        if first <= last:
+            self.bits |= (1 << last + 1) - (1 << first)
+
+    def update(self, vlans):
+        for vlan in vlans:
+            self.add(vlan)
+
+    def discard(self, vlan):
+        if isinstance(vlan, int) and 0 <= vlan:
+            self.bits &= ~(1 << vlan)
+
+    def copy(self):
+        return VlanSet(self)
+
+    def ranges(self):
+        """Returns list of tuples (first, last) of consecutive vlans"""
+        result = []
+        for vlan in self:
+            if result and result[-1][1] == vlan - 1:
+                result[-1][1] = vlan
+            else:
+                result.append([vlan, vlan])
+        return [tuple(item) for item in result]
+
+    def split(self, length):
+        """Splits the compressed ranges into parts not longer than length
+        characters, to be written on separate lines.
+        Input:
+          length - int, maximum length of one part
+        Output: list of strings, ['none'] for the empty set
+        """
+        parts = []
+        for first, last in self.ranges():
+            item = str(first) if first == last else \
+                '{}-{}'.format(first, last)
+            if parts and len(parts[-1]) + 1 + len(item) <= length:
+                parts[-1] += ',' + item
+            else:
+                parts.append(item)
+        return parts or ['none']
+
+    def __contains__(self, vlan):
+        return isinstance(vlan, int) and 0 <= vlan and \
+            bool(self.bits >> vlan & 1)
+
+    def __iter__(self):
+        bits = self.bits
+        while bits:
+            lowest = bits & -bits
+            yield lowest.bit_length() - 1
+            bits ^= lowest
+
+    def __len__(self):
+        return bin(self.bits).count('1')
+
+    def __bool__(self):
+        return bool(self.bits)
+
+    def __eq__(self, other):
+        return isinstance(other, VlanSet) and self.bits == other.bits
+
+    def __ior__(self, other):
+        if isinstance(other, VlanSet):
+            self.bits |= other.bits
+        else:
+            self.update(other)
+        return self
+
+    def __or__(self, other):
+        result = self.copy()
+        result |= other
+        return result
+
+    def __sub__(self, other):
+        result = VlanSet()
+        result.bits = self.bits & ~VlanSet(other).bits
+        return result
+
+    def __str__(self):
+        return ','.join(self.split(0))
+
+    def __repr__(self):
+        return 'VlanSet({!r})'.format(str(self))
+
+
+class Flag(object):
+    """Boolean attribute kept as one bit of the integer flags attribute,
+    so slotted classes need one slot for all their flags.
+    The mask of the bit is available as Class.attribute.mask
+    """
+    __slots__ = ('mask',)
+
+    def __init__(self, bit):
+        self.mask = 1 << bit
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        return bool(instance.flags & self.mask)
+
+    def __set__(self, instance, value):
+        if value:
+            instance.flags |= self.mask
+        else:
+            instance.flags &= ~self.mask
+
+
+class Route(object):
+    """Route of a routing table: destination network, the protocol it was
+    learned from, next hop address and/or outgoing interface
+    """
+    __slots__ = ('network', 'protocol', 'distance', 'nexthop', 'interface')
+    # administrative distances of the protocols
+    DISTANCES = {'connected': 0, 'static': 1, 'eigrp': 90, 'ospf': 110}
+    CODES = {'connected': 'C', 'static': 'S', 'eigrp': 'D', 'ospf': 'O'}
+
+    def __init__(self, network, protocol, nexthop=None, interface=None):
+        """Initializes the route.
+        Input:
+          network - Subnet instance, destination
+          protocol - string, one of Route.DISTANCES keys
+          nexthop - IPAddress instance or None
+          interface - Interface instance or None, outgoing interface
+        Output: None
+        """
+        self.network = network
+        self.protocol = protocol
+        self.distance = Route.DISTANCES[protocol]
+        self.nexthop = nexthop
+        self.interface = interface
+
+    def __str__(self):
+        route = '{} {}/{}'.format(Route.CODES[self.protocol], self.network.ip,
+                                  self.network.prefixlen)
+        if self.nexthop is not None:
+            route += ' via {}'.format(self.nexthop)
+        elif self.interface is not None:
+            route += ' is directly connected'
+        if self.interface is not None:
+            route += ', {}'.format(self.interface)
+        return route
+
+
+class RoutingTable(object):
+    """Routing table (RIB) of one device. Routes are kept in a PrefixTrie
+    per ip version, so the longest prefix match takes at most 32 steps
+    for ipv4 (128 for ipv6) regardless of the number of routes.
+    Only the route with the lowest administrative distance is kept
+    for every network.
+    """
+    __slots__ = ('tries',)
+
+    def __init__(self, routes=()):
+        """Initializes the routing table.
+        Input:
+          routes - iterable of Route instances
+        Output: None
+        """
+        self.tries = {version: PrefixTrie(bits)
+                      for version, bits in ADDRESS_BITS.items()}
+        for route in routes:
+            self.add(route)
+
+    def __len__(self):
+        return sum(len(trie) for trie in self.tries.values())
+
+    def __iter__(self):
+        for version in sorted(self.tries):
+            for prefix, prefixlen, route in self.tries[version].items():
+                yield route
+
+    def add(self, route):
+        """Adds the route if there is no route to the same network with
+        lower or equal administrative distance.
+        Input:
+          route - Route instance
+        Output: boolean, if the route was added
+        """
+        network = route.network
+        trie = self.tries[network.version]
+        current = trie.get(network.ip_int, network.prefixlen)
+        if current is not None and current.distance <= route.distance:
+            return False
+        trie.insert(network.ip_int, network.prefixlen, route)
+        return True
+
+    def get(self, network):
+        """Returns the route to exactly this network
+        Input:
+          network - Subnet instance or string, like '10.0.0.0/8'
+        Output: Route instance or None
+        """
+        if not isinstance(network, IPAddress):
+            network = Subnet(network, 'ipv6' if ':' in network else 'ipv4')
+        return self.tries[network.version].get(network.ip_int,
+                                               network.prefixlen)
+
+    def lookup(self, address):
+        """Finds the route for the address by the longest prefix match
+        Input:
+          address - IPAddress instance or string, like '10.1.2.3'
+        Output: Route instance or None
+        """
+        if not isinstance(address, IPAddress):
+            address = IPAddress(address, 'ipv6' if ':' in address else 'ipv4')
+        return self.tries[address.version].lookup(address.ip_int)
+
+    def lookup_many(self, addresses):
+        """Finds routes for a lot of addresses, every distinct address
+        is looked up only once.
+        Input:
+          addresses - iterable of IPAddress instances or strings
+        Output: list of Route instances or None in the same order
+        """
+        found = {}
+        routes = []
+        for address in addresses:
+            if address not in found:
+                found[address] = self.lookup(address)
+            routes.append(found[address])
+        return routes
+
+    def resolve(self, address):
+        """Recursively resolves the next hop of routes without
+        the outgoing interface, like static routes via an ip address.
+        Input:
+          address - IPAddress instance or string
+        Output: tuple (outgoing Interface, next hop IPAddress or None
+          if the address is directly connected) or None if the address
+          is not reachable or recursion loops
+        """
+        if not isinstance(address, IPAddress):
+            address = IPAddress(address, 'ipv6' if ':' in address else 'ipv4')
+        nexthop = None
+        seen = set()
+        while True:
+            route = self.lookup(address)
+            if route is None or id(route) in seen:
+                return None
+            seen.add(id(route))
+            if route.nexthop is not None:
+                nexthop = address = route.nexthop
+            if route.interface is not None:
+                return route.interface, nexthop
+
 
 class NetworkDevice(object):
+    __slots__ = ('name', 'interfaces', 'interface_index', 'type',
+                 'domain_name', 'vendor', 'users', 'flags', 'static_routes',
+                 'eigrp_as', 'ospf_process', 'syslog_server', 'ntp_server',
+                 'ipsec_tunnels', 'next_acl_number', 'json',
+                 'interface_listeners', 'static_route_cache')
+    eigrp = Flag(0)
+    ospf = Flag(1)
+    ipv4_routing = Flag(2)
+
+    class StaticRouteError(Exception):
+        """Raise if static routes have a wrong prefix or next hop.
+        All problems are listed in the errors attribute.
+        """
+        def __init__(self, errors):
+            super(NetworkDevice.StaticRouteError, self).__init__(
+                '\n'.join(errors))
+            self.errors = errors
+
     def __init__(self, name):
+        self.flags = 0
         self.name = name
         self.interfaces = []
+        # full interface name -> Interface, kept by add_interface
+        # and remove_interface
+        self.interface_index = {}
+        # functions called as listener(interface, added) when
+        # an interface is added (added is True) or removed
+        self.interface_listeners = []
         self.type = None
         self.domain_name = "cisco.com"
         self.vendor = "cisco"
         self.users = {}
-        self.eigrp = False
-        self.ospf = False
         self.static_routes = []
+        # static routes as they were parsed last time and parsed routes:
+        # tuple of (prefix, nexthop) strings, list of (IPAddress, Route)
+        self.static_route_cache = ((), [])
         self.eigrp_as = None
         self.ospf_process = None
-        self.ipv4_routing = False
         self.syslog_server = ""
         self.ntp_server = ""
         self.ipsec_tunnels = []
@@ -439,9 +1736,12 @@ class NetworkDevice(object):
         return self.name
 
     def get_interface(self, name):
-        for interface in self.interfaces:
-            if interface.name == autocomplete_interface(name):
-                return interface
+        """Finds the interface by its name, which may be abbreviated.
+        Input:
+          name - string, like 'Ethernet0/0' or 'e0/0'
+        Output: Interface instance or None
+        """
+        return self.interface_index.get(autocomplete_interface(name))
 
     def set_domain_name(self, domain):
         if domain:
@@ -470,20 +1770,21 @@ class NetworkDevice(object):
             self.users[user['username']] = password
 
     def generate_json(self):
-        self.json["name"] = self.name
-        self.json["type"] = self.type
-        self.json["ipv4_routing"] = self.ipv4_routing
-        self.json["ospf"] = self.ospf
-        self.json["ospf_process"] = self.ospf_process
-        self.json["eigrp"] = self.eigrp
-        self.json["eigrp_as"] = self.eigrp_as
+        result = {}
+        result["name"] = self.name
+        result["type"] = self.type
+        result["ipv4_routing"] = self.ipv4_routing
+        result["ospf"] = self.ospf
+        result["ospf_process"] = self.ospf_process
+        result["eigrp"] = self.eigrp
+        result["eigrp_as"] = self.eigrp_as
         interfaces_json = []
         for interface in self.interfaces:
             interfaces_json.append(interface.generate_json())
-        self.json["interfaces"] = interfaces_json
+        result["interfaces"] = interfaces_json
         if self.static_routes:
-            self.json["static_routes"] = self.static_routes
-        return self.json
+            result["static_routes"] = self.static_routes
+        return result
 
 
     # def check_routing(self):
@@ -493,71 +1794,149 @@ class NetworkDevice(object):
     #                   if interface.routing == 'ospf']
 
     def generate_routing_config(self):
-        result = []
+        out = io.StringIO()
+        self.write_routing_config(out)
+        return out.getvalue()
+
+    def write_routing_config(self, out):
+        write = out.write
         if self.ipv4_routing and self.eigrp:
-            result.append("router eigrp {}".format(self.eigrp_as))
+            write("router eigrp {}\n".format(self.eigrp_as))
             for interface in self.interfaces:
                 if interface.eigrp:
-                    result.append(" network {} 0.0.0.0".format(interface.ip_address))
-            result.append(" passive-interface default")
+                    write(" network {} 0.0.0.0\n".format(interface.ip_address))
+            write(" passive-interface default\n")
             for interface in self.interfaces:
                 if interface.eigrp and interface.eigrp_not_passive:
-                    result.append(" no passive-interface {}".format(interface.name))
-            result.append("!")
+                    write(" no passive-interface {}\n".format(interface.name))
+            write("!\n")
         if self.ipv4_routing and self.ospf:
-            result.append("router ospf {}".format(self.ospf_process))
+            write("router ospf {}\n".format(self.ospf_process))
             for interface in self.interfaces:
                 if interface.ospf:
-                    result.append(" network {} 0.0.0.0 area {}".format(interface.ip_address,
-                                                                       interface.ospf_area))
-            result.append(" passive-interface default")
+                    write(" network {} 0.0.0.0 area {}\n".format(interface.ip_address,
+                                                                interface.ospf_area))
+            write(" passive-interface default\n")
             for interface in self.interfaces:
                 if interface.ospf and interface.ospf_not_passive:
-                    result.append(" no passive-interface {}".format(interface.name))
-            result.append("!")
-        result.append('\n')
-        return '\n'.join(result)
+                    write(" no passive-interface {}\n".format(interface.name))
+            write("!\n")
+        write('\n')
 
     def generate_ssh_config(self):
-        if self.vendor == 'cisco':
-            snippet_path = os.path.join(TEMPLATES_DIR, 'cisco/ssh.cfg')
-        with open(snippet_path) as f:
-            snippet = f.read()
-            return snippet.format(domain=self.domain_name)
+        return templates.render(self.vendor, 'ssh', domain=self.domain_name)
 
     def generate_static_routing_config(self):
-        config = []
-        for static_route in self.static_routes:
-            prefix = IPAddress(static_route.get("prefix"))
-            nexthop = static_route.get("nexthop")
-            config.append("ip route {} {} {}\n".format(prefix.ip,
-                                                      prefix.get_mask(),
-                                                      nexthop))
-        return ''.join(config)
+        out = io.StringIO()
+        self.write_static_routing_config(out)
+        return out.getvalue()
+
+    def write_static_routing_config(self, out):
+        for prefix, route in self.get_static_routes():
+            out.write("ip route {} {} {}\n".format(prefix.ip,
+                                                  prefix.get_mask(),
+                                                  route.nexthop or
+                                                  route.interface.name))
+
+    def get_static_routes(self):
+        """Parses static_routes, they are parsed again only if
+        static_routes were changed since the last call.
+        Input: None
+        Output: list of tuples (prefix as IPAddress instance,
+          Route instance)
+        Raises NetworkDevice.StaticRouteError with all found errors:
+        wrong prefix, prefix without mask and network (classes D and E),
+        next hop which is neither an ip address nor an interface
+        """
+        key = tuple((static_route.get("prefix"), static_route.get("nexthop"))
+                    for static_route in self.static_routes)
+        if key != self.static_route_cache[0]:
+            routes = []
+            errors = []
+            for prefix, nexthop in key:
+                error = '{}: static route {} via {}: '.format(self.name,
+                                                              prefix, nexthop)
+                try:
+                    prefix = IPAddress(str(prefix))
+                except IPAddress.WrongIPError:
+                    errors.append(error + 'wrong prefix')
+                    continue
+                network = prefix.get_network()
+                if network is None:
+                    errors.append(error + 'prefix has no mask')
+                    continue
+                try:
+                    route = Route(network, 'static',
+                                  nexthop=IPAddress(str(nexthop)))
+                except IPAddress.WrongIPError:
+                    # next hop may be an outgoing interface
+                    interface = None
+                    if re.match(r'^[a-zA-Z]+[0-9/]', str(nexthop)):
+                        interface = self.get_interface(nexthop)
+                    if interface is None:
+                        errors.append(error + 'wrong next hop')
+                        continue
+                    route = Route(network, 'static', interface=interface)
+                routes.append((prefix, route))
+            if errors:
+                raise NetworkDevice.StaticRouteError(errors)
+            self.static_route_cache = (key, routes)
+        return self.static_route_cache[1]
+
+    def build_routing_table(self):
+        """Builds the routing table from connected networks of the
+        interfaces which are up and static routes.
+        Input: None
+        Output: RoutingTable instance
+        """
+        table = RoutingTable()
+        for interface in self.interfaces:
+            address = interface.ip_address
+            if address is not None and interface.up:
+                network = address.get_network()
+                if network is not None:
+                    table.add(Route(network, 'connected',
+                                    interface=interface))
+        for prefix, route in self.get_static_routes():
+            table.add(route)
+        return table
 
     def build_config(self):
-        config = []
-        config.append("hostname {name}\n".format(name = self.name))
+        out = io.StringIO()
+        self.write_config(out)
+        return out.getvalue()
+
+    def write_config(self, out):
+        """Writes the config of the device piece by piece, without
+        building the whole config in memory.
+        Input:
+          out - file object or io.StringIO opened for writing text
+        Output: None
+        """
+        write = out.write
+        write("hostname {name}\n".format(name = self.name))
         for tunnel in self.ipsec_tunnels:
-            config.append(tunnel.build_configuration(self))
-        config.append(self.build_config_interfaces())
-        config.append(self.generate_routing_config())
-        config.append(self.generate_static_routing_config())
-        config.append(self.build_config_users())
+            write(tunnel.build_configuration(self))
+        self.write_config_interfaces(out)
+        self.write_routing_config(out)
+        self.write_static_routing_config(out)
+        self.write_config_users(out)
         if self.ntp_server:
             if self.vendor == 'cisco':
-                config.append("ntp server {}\n".format(self.ntp_server))
+                write("ntp server {}\n".format(self.ntp_server))
         if self.syslog_server:
             if self.vendor == 'cisco':
-                config.append("logging {}\n".format(self.syslog_server))
-        config.append(self.generate_ssh_config())
-        return ''.join(config)
+                write("logging {}\n".format(self.syslog_server))
+        write(self.generate_ssh_config())
 
     def add_interface(self, interface):
-        if interface in self.interfaces:
+        if interface.name in self.interface_index:
             print("%s already exists" % interface)
         else:
             self.interfaces.append(interface)
+            self.interface_index[interface.name] = interface
+            for listener in self.interface_listeners:
+                listener(interface, True)
             if self.type == "switch":
                 if interface.type == "access":
                     self.add_vlan_from_interface(interface)
@@ -565,27 +1944,47 @@ class NetworkDevice(object):
                     vlan_num = int(re.match("Vlan ?(\d+)", interface.name).group(1))
                     self.vlans.add(vlan_num)
 
+    def remove_interface(self, interface):
+        """Removes the interface from the device
+        Input:
+          interface - Interface instance
+        Output: None
+        """
+        self.interfaces.remove(interface)
+        del self.interface_index[interface.name]
+        for listener in self.interface_listeners:
+            listener(interface, False)
+
     def build_config_interfaces(self, native_vlan=0, vlan_list=None):
-        if vlan_list is None:
-            vlan_list = []
-        vlan_list = sorted([str(vlan) for vlan in vlan_list])
-        result = [interface.build_config(native_vlan, vlan_list)
-                  for interface in self.interfaces]
-        return '\n'.join(result) + '\n'
+        out = io.StringIO()
+        self.write_config_interfaces(out, native_vlan, vlan_list)
+        return out.getvalue()
+
+    def write_config_interfaces(self, out, native_vlan=0, vlan_list=None):
+        # the allowed vlans of trunks are formatted once for all interfaces
+        if not isinstance(vlan_list, VlanSet):
+            vlan_list = VlanSet(int(vlan) for vlan in vlan_list or [])
+        trunk_vlans = vlan_list.split(TRUNK_VLANS_LENGTH)
+        for interface in self.interfaces:
+            interface.write_config(out, native_vlan, trunk_vlans)
+        if not self.interfaces:
+            out.write('\n')
 
     def build_config_users(self):
-        if self.vendor == 'cisco':
-            snippet_path = os.path.join(TEMPLATES_DIR, 'cisco/users.cfg')
-        with open(snippet_path) as f:
-            snippet = f.read()
-            result = []
-            for user, password in self.users.items():
-                result.append(snippet.format(user=user, password=password))
-            result.append('')
-            return '\n'.join(result)
+        out = io.StringIO()
+        self.write_config_users(out)
+        return out.getvalue()
+
+    def write_config_users(self, out):
+        render = templates.get(self.vendor, 'users').render
+        for user, password in self.users.items():
+            out.write(render(user=user, password=password))
+            out.write('\n')
 
 
 class Router(NetworkDevice):
+    __slots__ = ()
+
     def __init__(self, name):
         super(Router, self).__init__(name)
         self.type = "router"
@@ -593,12 +1992,15 @@ class Router(NetworkDevice):
 
 
 class Switch(NetworkDevice):
+    __slots__ = ('vlans', 'native_vlan', 'l3_int_number', 'vtp_mode',
+                 'stp_mode')
+    routing = Flag(3)
+
     def __init__(self, name):
         super(Switch, self).__init__(name)
         self.type = "switch"
-        self.vlans = set()
-        self.routing = False
-        self.ipv4_routing = False
+        self.vlans = VlanSet()
+        self.native_vlan = None
         self.l3_int_number = 0
         self.vtp_mode = "transparent"
         self.stp_mode = "rapid-pvst"
@@ -616,74 +2018,106 @@ class Switch(NetworkDevice):
     #     self.set_vtp_mode("transparent")
     #     self.set_stp_mode("rapid-pvst")
 
-    def add_to_switch_group(self, switch_group):
-        switch_group.append(self)
+    def get_router_vlans(self):
+        """Returns vlans of router subinterfaces connected to the switch
+        Input: None
+        Output: generator of ints
+        """
         for interface in self.interfaces:
-            if interface.other_end:
-                if interface.other_end.device.type == 'switch':
-                    neighbor_switch = interface.other_end.device
-                    if neighbor_switch not in switch_group:
-                        neighbor_switch.add_to_switch_group(switch_group)
-                elif interface.other_end.device.type == 'router':
-                    for subif in interface.other_end.children:
-                        self.vlans.add(subif.dot1q)
-
+            other_end = interface.other_end
+            if other_end is not None and other_end.device.type == 'router':
+                for subif in other_end.children:
+                    if subif.dot1q:
+                        yield subif.dot1q
 
-    def build_config(self):
+    def add_to_switch_group(self, switch_group):
+        """Adds the switch and all switches connected to it through
+        switch-to-switch links to the group, vlans of router subinterfaces
+        connected to these switches are added to their vlans.
+        Input:
+          switch_group - list of Switch instances
+        Output: None
+        """
+        seen = set(switch_group)
+        stack = [self]
+        while stack:
+            switch = stack.pop()
+            if switch in seen:
+                continue
+            seen.add(switch)
+            switch_group.append(switch)
+            switch.vlans.update(switch.get_router_vlans())
+            neighbors = [interface.other_end.device
+                         for interface in switch.interfaces
+                         if interface.other_end is not None and
+                         interface.other_end.device.type == 'switch']
+            # reversed, so neighbors are visited in the order of interfaces
+            stack.extend(reversed(neighbors))
+
+
+    def write_config(self, out):
         #self.check_routing()
         #self.add_additional_settings()
-        config = []
-        config.append("hostname {}\n".format(self.name))
+        write = out.write
+        write("hostname {}\n".format(self.name))
         if self.stp_mode:
-            config.append("spanning-tree mode {}\n".format(self.stp_mode))
+            write("spanning-tree mode {}\n".format(self.stp_mode))
         if self.vtp_mode:
-            config.append("vtp mode {}\n".format(self.vtp_mode))
-        config.append(self.build_vlan_config())
-        config.append(self.build_config_interfaces(self.native_vlan, self.vlans))
+            write("vtp mode {}\n".format(self.vtp_mode))
+        self.write_vlan_config(out)
+        self.write_config_interfaces(out, self.native_vlan, self.vlans)
         if self.ipv4_routing:
-            config.append("ip routing\n")
-        config.append(self.generate_routing_config())
-        config.append(self.generate_static_routing_config())
-        config.append(self.build_config_users())
+            write("ip routing\n")
+        self.write_routing_config(out)
+        self.write_static_routing_config(out)
+        self.write_config_users(out)
         if self.ntp_server:
-            config.append("ntp server {}\n".format(self.ntp_server))
+            write("ntp server {}\n".format(self.ntp_server))
         if self.syslog_server:
-            config.append("logging {}\n".format(self.syslog_server))
-        config.append(self.generate_ssh_config())
-        return ''.join(config)
+            write("logging {}\n".format(self.syslog_server))
+        write(self.generate_ssh_config())
 
     def build_vlan_config(self):
-        config = []
+        out = io.StringIO()
+        self.write_vlan_config(out)
+        return out.getvalue()
+
+    def write_vlan_config(self, out):
+        write = out.write
         for vlan in sorted(self.vlans):
-            config.append("vlan {vlan_number}".format(vlan_number = vlan))
+            write("vlan {vlan_number}\n".format(vlan_number = vlan))
             if vlan == self.native_vlan:
-                config.append(" name Native")
-            config.append("!")
-        config.append('')
-        return '\n'.join(config)
+                write(" name Native\n")
+            write("!\n")
 
 
 class Interface(object):
+    __slots__ = ('name', 'flags', 'type', 'ip_address', 'ospf_area',
+                 'routing', 'device', 'crypto_map', 'dot1q', 'other_end',
+                 'line', 'parent', '_children', 'vlan')
+    up = Flag(0)
+    switchport = Flag(1)
+    ospf = Flag(2)
+    ospf_not_passive = Flag(3)
+    eigrp = Flag(4)
+    eigrp_not_passive = Flag(5)
+
     def __init__(self, name, ip_address=None, vlan=None, routing=None, device=None):
         self.name = autocomplete_interface(name)
-        self.up = True
+        self.flags = Interface.up.mask
         self.type = None
         self.ip_address = None
-        self.ospf = False
         self.ospf_area = None
-        self.ospf_not_passive = False
-        self.eigrp = False
-        self.eigrp_not_passive = False
         self.routing = routing
         self.device = device
         self.crypto_map = None
-        self.switchport = False
         self.dot1q = None
         self.other_end = None
         self.line = None
-        self.json = {}
         self.parent = None
-        self.children = []
+        # most interfaces have no subinterfaces, so the list is created
+        # on the first access
+        self._children = None
         self.vlan = None
         if ip_address:
             if self.device.type == 'switch':
@@ -696,62 +2130,108 @@ class Interface(object):
                 self.type = "access"
                 self.vlan = int(vlan)
 
+    @property
+    def children(self):
+        """List of subinterfaces"""
+        if self._children is None:
+            self._children = []
+        return self._children
+
+    @children.setter
+    def children(self, children):
+        self._children = children
+
+    def __getstate__(self):
+        # other_end leads to the next device, so pickling a long chain of
+        # devices would recurse through all of them, Topology pickles
+        # connected interfaces separately
+        return {slot: getattr(self, slot) for slot in Interface.__slots__
+                if slot != 'other_end' and hasattr(self, slot)}
+
+    def __setstate__(self, state):
+        self.other_end = None
+        for slot, value in state.items():
+            setattr(self, slot, value)
+
+    @property
+    def json(self):
+        """Json of the interface, built on every access"""
+        return self.generate_json()
+
     def generate_json(self):
-        self.json["name"] = self.name
-        self.json["up"] = self.up
-        self.json["switchport"] = self.switchport
+        result = {}
+        result["name"] = self.name
+        result["up"] = self.up
+        result["switchport"] = self.switchport
         if self.ip_address:
-            self.json["ip"] = "{}{}".format(self.ip_address.ip,
-                                            convert_mask(self.ip_address.get_mask(), 'slash'))
+            result["ip"] = "{}{}".format(self.ip_address.ip,
+                                         convert_mask(self.ip_address.get_mask(), 'slash'))
         else:
-            self.json["ip"] = None
-        self.json["ospf_enabled"] = self.ospf
-        self.json["ospf_area"] = self.ospf_area
-        self.json["ospf_not_passive"] = self.ospf_not_passive
-        self.json["eigrp_enabled"] = self.eigrp
-        self.json["eigrp_not_passive"] = self.eigrp_not_passive
+            result["ip"] = None
+        result["ospf_enabled"] = self.ospf
+        result["ospf_area"] = self.ospf_area
+        result["ospf_not_passive"] = self.ospf_not_passive
+        result["eigrp_enabled"] = self.eigrp
+        result["eigrp_not_passive"] = self.eigrp_not_passive
 
         if self.type == "trunk":
-            self.json["vlan"] = "trunk"
+            result["vlan"] = "trunk"
         elif self.type == "access":
-            self.json["vlan"] = self.vlan
-        self.json["dot1q"] = self.dot1q
+            result["vlan"] = self.vlan
+        result["dot1q"] = self.dot1q
 
-        return self.json
+        return result
 
     def build_config(self, native_vlan=None, vlan_list=[]):
-        config = ["interface {}".format(self.name)]
+        out = io.StringIO()
+        vlans = VlanSet(int(vlan) for vlan in vlan_list)
+        self.write_config(out, native_vlan, vlans.split(TRUNK_VLANS_LENGTH))
+        # the config of a single interface has no trailing newline
+        return out.getvalue()[:-1]
+
+    def write_config(self, out, native_vlan=None, trunk_vlans=('none',)):
+        """Writes the config of the interface, every line ends with newline
+        Input:
+          out - file object or io.StringIO opened for writing text
+          native_vlan - int or None, native vlan of trunks
+          trunk_vlans - list of strings, allowed vlans of trunks split
+                        in lines, like ['1-10,20', '30'], see VlanSet.split
+        Output: None
+        """
+        write = out.write
+        write("interface {}\n".format(self.name))
         if self.dot1q:
-            config.append(" encapsulation dot1q {}".format(self.dot1q))
+            write(" encapsulation dot1q {}\n".format(self.dot1q))
         if self.switchport:
             if self.type == "trunk":
-                config.append(" switchport trunk encapsulation dot1q")
-                config.append(" switchport mode trunk")
-                config.append(" switchport trunk allowed vlan {}"
-                              .format(','.join(vlan_list)))
+                write(" switchport trunk encapsulation dot1q\n")
+                write(" switchport mode trunk\n")
+                write(" switchport trunk allowed vlan {}\n"
+                      .format(trunk_vlans[0]))
+                for vlans in trunk_vlans[1:]:
+                    write(" switchport trunk allowed vlan add {}\n"
+                          .format(vlans))
                 if native_vlan:
-                    config.append(" switchport trunk native vlan {vlan}"
-                                  .format(vlan = native_vlan))
-                config.append(" switchport nonegotiate")
+                    write(" switchport trunk native vlan {vlan}\n"
+                          .format(vlan = native_vlan))
+                write(" switchport nonegotiate\n")
             elif self.type == "access":
-                config.append(" switchport mode access")
-                config.append(" switchport access vlan {}"
-                              .format(self.vlan))
-                config.append(" spanning-tree portfast")
-                config.append(" spanning-tree portfast bpduguard ")
+                write(" switchport mode access\n")
+                write(" switchport access vlan {}\n".format(self.vlan))
+                write(" spanning-tree portfast\n")
+                write(" spanning-tree portfast bpduguard \n")
         elif self.ip_address:
             if self.device.type == 'switch' and 'Ethernet' in self.name:
-                config.append(" no switchport")
-            config.append(" ip address {} {}".format(self.ip_address.ip,
-                                                     self.ip_address.get_mask()))
+                write(" no switchport\n")
+            write(" ip address {} {}\n".format(self.ip_address.ip,
+                                               self.ip_address.get_mask()))
             if self.crypto_map:
-                config.append(" crypto map {}".format(self.crypto_map))
+                write(" crypto map {}\n".format(self.crypto_map))
         if self.up:
-            config.append(" no shutdown")
+            write(" no shutdown\n")
         else:
-            config.append(" shutdown")
-        config.append("!")
-        return '\n'.join(config)
+            write(" shutdown\n")
+        write("!\n")
 
     def __str__(self):
         return self.name
@@ -760,13 +2240,18 @@ class Interface(object):
         return self.name == other.name
 
 class Tunnel(object):
-    def __init__(self, json, endpoints):
+    def __init__(self, json, endpoints, key=None):
         self.json = json
         self.endpoints = endpoints
-        self.key = generate_random_password()
+        self.key = key or generate_random_password()
         self.details = {}
         self.find_missing_parts()
 
+    @property
+    def name(self):
+        """Names of the endpoints, like 'R1,R2'"""
+        return ','.join(sorted(endpoint.name for endpoint in self.endpoints))
+
     def other(self, router):
         for endpoint in self.endpoints:
             if endpoint is not router:
@@ -787,71 +2272,573 @@ class Tunnel(object):
             router.next_acl_number += 1
             self.details[router.name] = details
 
+    def template_values(self, router):
+        """Returns everything the ipsec_vpn template of the router is
+        rendered from, including the values of the other endpoint.
+        Input:
+          router - Router instance, one of the endpoints
+        Output: dict, template variable -> string or int
+        """
+        details = self.details[router.name]
+        return {'tunnel_key': self.key,
+                'acl_num': details["acl_number"],
+                'tunnel_end_ip': str(details["tunnel_dst_int"].ip_address),
+                'src_ip': details["src_traffic"].ip,
+                'src_ip_wc': details["src_traffic"].get_wildcard(),
+                'dst_ip': details["dst_traffic"].ip,
+                'dst_ip_wc': details["dst_traffic"].get_wildcard()}
+
     def build_configuration(self, router):
-        if router.vendor == 'cisco':
-            snippet_path = os.path.join(TEMPLATES_DIR, 'cisco/ipsec_vpn.cfg')
-        with open(snippet_path) as f:
-            snippet = f.read()
-            return snippet.format(tunnel_key = self.key,
-                                  acl_num = self.details[router.name]["acl_number"],
-                                  tunnel_end_ip = self.details[router.name]["tunnel_dst_int"].ip_address,
-                                  src_ip = self.details[router.name]["src_traffic"].ip,
-                                  src_ip_wc = self.details[router.name]["src_traffic"].get_wildcard(),
-                                  dst_ip = self.details[router.name]["dst_traffic"].ip,
-                                  dst_ip_wc = self.details[router.name]["dst_traffic"].get_wildcard())
+        return templates.render(router.vendor, 'ipsec_vpn',
+                                **self.template_values(router))
+
+class BuildStats(object):
+    """Wall time of the stages of a topology build and counters of
+    created objects, template reads, cache hits and written bytes.
+    A disabled instance does nothing, so the build pays only for
+    a few attribute checks per stage.
+    """
+
+    class Stage(object):
+        """Context manager adding its wall time to the stage"""
+        __slots__ = ('stats', 'name', 'start')
+
+        def __init__(self, stats, name):
+            self.stats = stats
+            self.name = name
+
+        def __enter__(self):
+            if self.stats.profiler is not None:
+                self.stats.profiler.enable()
+            self.start = time.perf_counter()
+            return self
+
+        def __exit__(self, *exc_info):
+            self.stats.add_time(self.name, time.perf_counter() - self.start)
+            if self.stats.profiler is not None:
+                self.stats.profiler.disable()
+
+    class NullStage(object):
+        """Context manager of a disabled instance"""
+        __slots__ = ()
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc_info):
+            pass
+
+    null_stage = NullStage()
+
+    def __init__(self, enabled=True, profile=False):
+        """Initializes empty statistics.
+        Input:
+          enabled - boolean, if False, nothing is recorded
+          profile - boolean, if True, stages also run under cProfile,
+                    see profile_stats
+        Output: None
+        """
+        self.enabled = enabled
+        self.profiler = cProfile.Profile() if enabled and profile else None
+        self.timings = OrderedDict()
+        self.counters = OrderedDict()
+
+    def stage(self, name):
+        """Returns context manager measuring the stage, like:
+        with stats.stage('render'): ...
+        """
+        if not self.enabled:
+            return BuildStats.null_stage
+        return BuildStats.Stage(self, name)
+
+    def add_time(self, name, seconds):
+        if self.enabled:
+            self.timings[name] = self.timings.get(name, 0.0) + seconds
+
+    def count(self, name, value=1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def report(self):
+        """Returns the statistics as a dict:
+          {'stages': {stage: seconds}, 'total': seconds,
+           'counters': {counter: value}}
+        """
+        return {'stages': dict(self.timings),
+                'total': sum(self.timings.values()),
+                'counters': dict(self.counters)}
+
+    def to_json(self, indent=1):
+        return json.dumps(self.report(), indent=indent)
+
+    def profile_stats(self):
+        """Returns pstats.Stats of the profiled stages or None if
+        the profiling is not enabled"""
+        if self.profiler is not None:
+            return pstats.Stats(self.profiler)
+
+    def __getstate__(self):
+        # the profiler is not picklable and is not needed in workers
+        state = self.__dict__.copy()
+        state['profiler'] = None
+        return state
+
+
+class DisjointSet(object):
+    """Union-find over integers 0..size-1 with union by size and path
+    halving, all operations take nearly constant amortized time.
+    """
+
+    def __init__(self, size):
+        self.parent = list(range(size))
+        self.size = [1] * size
+
+    def find(self, item):
+        """Returns the representative of the set containing the item"""
+        parent = self.parent
+        while parent[item] != item:
+            parent[item] = parent[parent[item]]
+            item = parent[item]
+        return item
+
+    def union(self, first, second):
+        """Merges the sets containing two items
+        Output: int, representative of the merged set
+        """
+        first = self.find(first)
+        second = self.find(second)
+        if first == second:
+            return first
+        if self.size[first] < self.size[second]:
+            first, second = second, first
+        self.parent[second] = first
+        self.size[first] += self.size[second]
+        return first
+
+
+# topology rendered by a worker process of Topology.create_configs
+worker_topology = None
+
+def init_config_worker(topology):
+    """Keeps the topology in the worker process, so it is transferred
+    once per worker instead of once per rendered node.
+    Input:
+      topology - Topology instance
+    Output: None
+    """
+    global worker_topology
+    worker_topology = topology
+
+def render_node_configs(indexes):
+    """Renders configs of the nodes of worker_topology.
+    Input:
+      indexes - list, indexes in worker_topology.nodes
+    Output:
+      list of tuples (node name, config)
+    """
+    nodes = worker_topology.nodes
+    return [(nodes[index].name, nodes[index].build_config())
+            for index in indexes]
+
+def write_config_file(directory, name, config):
+    """Writes the config of one node into directory/name.cfg
+    Input:
+      directory - string, path to the directory
+      name - string, name of the node
+      config - string
+    Output: None
+    """
+    with open('{path}/{filename}.cfg'.format(path=directory,
+                                             filename=name), 'w') as f:
+        f.write(config)
+
 
 class Topology(object):
-    def __init__(self, json_file):
-        self.json = get_input_topology(json_file)
+
+    class LinkError(Exception):
+        """Raise if links of the topology refer to unknown nodes or
+        interfaces or use an interface more than once.
+        All problems are listed in the errors attribute.
+        """
+        def __init__(self, errors):
+            super(Topology.LinkError, self).__init__('\n'.join(errors))
+            self.errors = errors
+
+    def __init__(self, json_file, stream=False, seed=None, stats=None):
+        """Loads the topology and builds all devices.
+        Input:
+          json_file - string, path to the topology json file
+          stream - boolean, if True, the file is read piece by piece
+                   with iter_topology and the raw json is not kept:
+                   self.json is None and devices have empty json
+          seed - string, bytes or None, secret key of the topology.
+                 If specified, generated passwords, tunnel keys and
+                 native vlans are derived from it and the names of
+                 users, tunnels and switches, so the same input always
+                 gives the same configs. Random otherwise.
+          stats - BuildStats instance, True for a new BuildStats or None,
+                  time of the stages of loading and create_configs and
+                  counters are recorded in self.stats, see BuildStats
+        Output: None
+        """
+        if seed is not None and not isinstance(seed, bytes):
+            seed = str(seed).encode('utf-8')
+        self.key = seed
+        if not isinstance(stats, BuildStats):
+            stats = BuildStats(enabled=bool(stats))
+        self.stats = stats
+        parse_cache_hits = parse_cache.hits
+        parse_cache_misses = parse_cache.misses
+        self.json = None
         self.nodes = []
         self.broadcast_domains = []
         self.switches = []
-        self.links = self.json['topology'].get('links')
+        self.links = []
         self.index = {}
         self.ipsec_tunnels = []
-        users =  self.parse_users(self.json.get("options").get("users", []))
-        for node_json in self.json["topology"]["nodes"]:
-            if node_json['type'] == 'router':
-                node = Router(node_json['name'])
-            elif node_json['type'] == 'switch':
-                node = Switch(node_json['name'])
-                self.switches.append(node)
+        # json_digest of every node json, used by config_digest
+        self.node_digests = {}
+        options = {}
+        if stream:
+            items = iter_topology(json_file)
+        else:
+            with stats.stage('load'):
+                self.json = get_input_topology(json_file)
+            topology = self.json['topology']
+            items = [('options', self.json.get("options", {}))]
+            items.extend(('node', node_json)
+                         for node_json in topology['nodes'])
+            items.extend(('link', link) for link in topology.get('links', []))
+        # when streaming, reading the file is a part of this stage
+        with stats.stage('nodes'):
+            for kind, item in items:
+                if kind == 'node':
+                    self.add_node(item, keep_json=not stream)
+                elif kind == 'link':
+                    self.links.append(item)
+                else:
+                    options = item
+        # options may follow the nodes in the file, so they are applied
+        # when all nodes are built
+        self.options = options
+        with stats.stage('options'):
+            self.apply_options(options)
+        with stats.stage('links'):
+            self.resolve_links()
+        with stats.stage('calculate_topology'):
+            self.calculate_topology()
+        with stats.stage('tunnels'):
+            self.parse_ipsec_tunnels(options.get("ipsec_tunnel", []))
+        if stats.enabled:
+            stats.count('nodes', len(self.nodes))
+            stats.count('switches', len(self.switches))
+            stats.count('interfaces', sum(len(node.interfaces)
+                                          for node in self.nodes))
+            stats.count('links', len(self.links))
+            stats.count('broadcast_domains', len(self.broadcast_domains))
+            stats.count('ipsec_tunnels', len(self.ipsec_tunnels))
+            stats.count('parse_cache_hits', parse_cache.hits -
+                        parse_cache_hits)
+            stats.count('parse_cache_misses', parse_cache.misses -
+                        parse_cache_misses)
+
+    def add_node(self, node_json, keep_json=True):
+        """Builds the device and its interfaces from the node json
+        Input:
+          node_json - dict, one element of topology.nodes
+          keep_json - boolean, if True, node_json is kept in node.json
+        Output: Router or Switch instance
+        """
+        if node_json['type'] == 'router':
+            node = Router(node_json['name'])
+        elif node_json['type'] == 'switch':
+            node = Switch(node_json['name'])
+            self.switches.append(node)
+        if keep_json:
             node.json = node_json
-            for interface_json in node_json['interfaces']:
-                interface = Interface(name=interface_json['name'],
-                                      ip_address=interface_json.get('ip'),
-                                      vlan=interface_json.get('vlan'),
-                                      routing=interface_json.get('routing'),
-                                      device = node)
-                node.add_interface(interface)
+        node.static_routes = node_json.get('static_routes', [])
+        node.ipv4_routing = node_json.get('ipv4_routing', node.ipv4_routing)
+        node.ospf = node_json.get('ospf', False)
+        node.ospf_process = node_json.get('ospf_process')
+        node.eigrp = node_json.get('eigrp', False)
+        node.eigrp_as = node_json.get('eigrp_as')
+        for interface_json in node_json['interfaces']:
+            interface = Interface(name=interface_json['name'],
+                                  ip_address=interface_json.get('ip'),
+                                  vlan=interface_json.get('vlan'),
+                                  routing=interface_json.get('routing'),
+                                  device = node)
+            # interfaces saved as down are rendered with 'shutdown'
+            interface.up = interface_json.get('up', True)
+            interface.switchport = interface_json.get('switchport', False)
+            dot1q = interface_json.get('dot1q')
+            interface.dot1q = int(dot1q) if dot1q else None
+            interface.ospf = interface_json.get('ospf_enabled', False)
+            interface.ospf_area = interface_json.get('ospf_area')
+            interface.ospf_not_passive = interface_json.get('ospf_not_passive',
+                                                            False)
+            interface.eigrp = interface_json.get('eigrp_enabled', False)
+            interface.eigrp_not_passive = \
+                interface_json.get('eigrp_not_passive', False)
+            node.add_interface(interface)
+        for interface in node.interfaces:
+            if '.' in interface.name:
+                parent = node.interface_index.get(interface.name
+                                                  .split('.')[0])
+                if parent is not None:
+                    interface.parent = parent
+                    parent.children.append(interface)
+        # errors of static routes are found while loading, not rendering
+        node.get_static_routes()
+        self.nodes.append(node)
+        self.index[node.name] = node
+        self.node_digests[node.name] = json_digest(node_json)
+        return node
+
+    def apply_options(self, options):
+        """Sets users, domain name, ntp and syslog servers of all nodes
+        Input:
+          options - dict, options of the topology json
+        Output: None
+        """
+        self.users = users = self.parse_users(options.get("users", []))
+        for node in self.nodes:
             node.users = users
-            node.set_domain_name(self.json.get("options").get("domain_name"))
-            node.set_ntp_server(self.json.get("options").get("ntp_server"))
-            node.set_syslog_server(self.json.get("options").get("syslog_server"))
-            self.nodes.append(node)
-            self.index[node.name] = node
-        self.calculate_topology()
-        self.parse_ipsec_tunnels(self.json.get("options").get("ipsec_tunnel", []))
-        self.parse_users(self.json.get("options").get("users", []))
+            node.set_domain_name(options.get("domain_name"))
+            node.set_ntp_server(options.get("ntp_server"))
+            node.set_syslog_server(options.get("syslog_server"))
+
+    def __getstate__(self):
+        """Pickles the topology without Interface.other_end, connected
+        interfaces are stored as positions, so the depth of pickling
+        does not grow with the number of linked devices"""
+        state = self.__dict__.copy()
+        positions = {}
+        for number, node in enumerate(self.nodes):
+            for index, interface in enumerate(node.interfaces):
+                positions[id(interface)] = (number, index)
+        state['connections'] = [
+            positions[id(interface)] + positions[id(interface.other_end)]
+            for node in self.nodes for interface in node.interfaces
+            if interface.other_end is not None]
+        return state
+
+    def __setstate__(self, state):
+        connections = state.pop('connections')
+        self.__dict__.update(state)
+        for number, index, other_number, other_index in connections:
+            self.nodes[number].interfaces[index].other_end = \
+                self.nodes[other_number].interfaces[other_index]
+
+    def resolve_links(self):
+        """Connects interfaces of every link through Interface.other_end.
+        All links are checked first, interfaces are connected only
+        if there are no errors.
+        Input: None
+        Output: None
+        Raises Topology.LinkError with all found errors: unknown node or
+        interface, interface used by several links or linked to itself
+        """
+        errors = []
+        pairs = []
+        # interface -> number of the first link that uses it
+        used = {}
+        for number, link in enumerate(self.links, 1):
+            ends = []
+            for side in 'src', 'dst':
+                node_name = link.get(side + '_node')
+                interface_name = link.get(side + '_int')
+                node = self.index.get(node_name)
+                if node is None:
+                    errors.append('Link {}: unknown node {}'
+                                  .format(number, node_name))
+                    continue
+                try:
+                    interface = node.get_interface(interface_name)
+                except (AttributeError, TypeError):
+                    interface = None
+                if interface is None:
+                    errors.append('Link {}: unknown interface {} on {}'
+                                  .format(number, interface_name, node_name))
+                    continue
+                ends.append(interface)
+            if len(ends) < 2:
+                continue
+            if ends[0] is ends[1]:
+                errors.append('Link {}: {} {} is linked to itself'
+                              .format(number, ends[0].device, ends[0]))
+                continue
+            for interface in ends:
+                key = id(interface)
+                if key in used:
+                    errors.append('Link {}: {} {} is already used by link {}'
+                                  .format(number, interface.device,
+                                          interface, used[key]))
+                else:
+                    used[key] = number
+            pairs.append(ends)
+        if errors:
+            raise Topology.LinkError(errors)
+        for src_interface, dst_interface in pairs:
+            src_interface.other_end = dst_interface
+            dst_interface.other_end = src_interface
+
+    def calculate_broadcast_domains(self):
+        """Groups switches connected by switch-to-switch links into
+        broadcast domains and stores them in self.broadcast_domains
+        Input: None
+        Output: list of lists of Switch instances, in the order of
+          self.switches
+        """
+        domains = DisjointSet(len(self.switches))
+        position = {switch: number
+                    for number, switch in enumerate(self.switches)}
+        for number, switch in enumerate(self.switches):
+            for interface in switch.interfaces:
+                other_end = interface.other_end
+                if other_end is not None and \
+                        other_end.device.type == 'switch':
+                    domains.union(number, position[other_end.device])
+        groups = OrderedDict()
+        for number, switch in enumerate(self.switches):
+            groups.setdefault(domains.find(number), []).append(switch)
+        self.broadcast_domains = list(groups.values())
+        return self.broadcast_domains
+
+    def pick_native_vlan(self, domain, vlans):
+        """Chooses the native vlan from 500-1000 not used in vlans
+        Input:
+          domain - list of Switch instances, the broadcast domain
+          vlans - VlanSet, vlans of the domain
+        Output: int
+        """
+        free_vlans = [vlan for vlan in range(500, 1001) if vlan not in vlans]
+        if self.key is None:
+            return random.choice(free_vlans)
+        name = min(switch.name for switch in domain)
+        return free_vlans[derive_number(self.key, 'native_vlan', name) %
+                          len(free_vlans)]
+
+    def generate_password(self, *identifiers):
+        """Returns a password derived from the seed of the topology and
+        identifiers, random password if the topology is not seeded.
+        Input:
+          identifiers - strings, like 'user', 'admin'
+        Output: string
+        """
+        if self.key is None:
+            return generate_random_password()
+        return derive_password(self.key, *identifiers)
 
     def calculate_topology(self):
-        vlans = set()
-        vlans.add(1)
-        for switch in self.switches:
-            vlans |= switch.vlans
-        vlan_range = set(range(500, 1001)) - vlans
-        native_vlan = random.sample(vlan_range, 1)[0]
-        vlans.add(native_vlan)
-        for switch in self.switches:
-            switch.native_vlan = native_vlan
-            switch.vlans = vlans
-            if switch.l3_int_number > 1:
-                switch.routing = True
+        """Computes vlans of every broadcast domain: vlans of all its
+        switches and of router subinterfaces connected to them, plus
+        vlan 1 and a native vlan chosen for the domain.
+        Input: None
+        Output: None
+        """
+        for domain in self.calculate_broadcast_domains():
+            vlans = VlanSet([1])
+            for switch in domain:
+                vlans |= switch.vlans
+                vlans.update(switch.get_router_vlans())
+            native_vlan = self.pick_native_vlan(domain, vlans)
+            vlans.add(native_vlan)
+            for switch in domain:
+                switch.native_vlan = native_vlan
+                switch.vlans = vlans
+                if switch.l3_int_number > 1:
+                    switch.routing = True
+
+    def validate_addresses(self):
+        """Checks ip addresses of all interfaces. Every interface network
+        (IPAddress.get_network) is put into a sorted index, so the check
+        takes O(n log n) for n interfaces.
+        Input: None
+        Output: list of strings, found problems, empty if there are none:
+          duplicate ip addresses,
+          overlapping subnets (different networks, one inside the other),
+          mismatched masks or subnets on both ends of a link
+        """
+        problems = []
+        entries = []
+        for node in self.nodes:
+            for interface in node.interfaces:
+                address = interface.ip_address
+                if address is not None:
+                    network = address.get_network()
+                    if network is not None:
+                        entries.append((address, network, interface))
+
+        def describe(interface):
+            return '{} {}'.format(interface.device, interface)
+
+        def address_key(entry):
+            return entry[0].version, entry[0].ip_int
+
+        entries.sort(key=address_key)
+        start = 0
+        for end in range(1, len(entries) + 1):
+            if end == len(entries) or \
+                    address_key(entries[end]) != address_key(entries[start]):
+                if end - start > 1:
+                    problems.append('Duplicate ip {}: {}'.format(
+                        entries[start][0].ip,
+                        ', '.join(describe(entry[2])
+                                  for entry in entries[start:end])))
+                start = end
+        # interfaces of every network, networks are sorted by the first
+        # address and then the bigger network goes first
+        networks = OrderedDict()
+        for address, network, interface in entries:
+            key = (network.version, network.ip_int, network.prefixlen)
+            networks.setdefault(key, (network, []))[1].append(interface)
+        # networks containing the current one, the innermost is the last
+        stack = []
+        for key in sorted(networks):
+            version, first, prefixlen = key
+            last = first + (1 << ADDRESS_BITS[version] - prefixlen) - 1
+            while stack and (stack[-1][0] != version or
+                             stack[-1][1] < first):
+                stack.pop()
+            network, interfaces = networks[key]
+            if stack:
+                outer, outer_interfaces = networks[stack[-1][2]]
+                problems.append('Overlapping subnets {}/{} ({}) and {}/{} ({})'
+                                .format(outer.ip, outer.prefixlen,
+                                        ', '.join(map(describe,
+                                                      outer_interfaces)),
+                                        network.ip, network.prefixlen,
+                                        ', '.join(map(describe, interfaces))))
+            stack.append((version, last, key))
+        checked = set()
+        for address, network, interface in entries:
+            other_end = interface.other_end
+            if other_end is None or id(other_end) in checked or \
+                    other_end.ip_address is None:
+                continue
+            checked.add(id(interface))
+            other_address = other_end.ip_address
+            other_network = other_address.get_network()
+            if other_network is None:
+                continue
+            if network.prefixlen != other_network.prefixlen:
+                problem = 'Mismatched masks'
+            elif network != other_network:
+                problem = 'Different subnets'
+            else:
+                continue
+            problems.append('{} on link {} - {}: {}/{} and {}/{}'.format(
+                problem, describe(interface), describe(other_end),
+                address.ip, network.prefixlen,
+                other_address.ip, other_network.prefixlen))
+        return problems
 
     def parse_ipsec_tunnels(self, json):
         for tunnel_json in json:
             endpoints = [self.index[router] for router in tunnel_json.keys()]
-            tunnel = Tunnel(tunnel_json, endpoints)
+            key = self.generate_password('tunnel', *sorted(tunnel_json))
+            tunnel = Tunnel(tunnel_json, endpoints, key)
             self.ipsec_tunnels.append(tunnel)
 
     def parse_users(self, users):
@@ -859,19 +2846,588 @@ class Topology(object):
         for user in users:
             password = user.get('password')
             if not password:
-                password = generate_random_password()
+                password = self.generate_password('user', user['username'])
             d[user['username']] = password
         return d
 
     def __str__(self):
         return self.json.dumps()
 
-    def create_configs(self):
-        directory = "configs"
-        shutil.rmtree(directory, ignore_errors=True)
-        os.makedirs(directory)
-        for node in self.nodes:
-            with  open('{path}/{filename}.cfg'
-                       .format(path=directory,
-                               filename = node.name), 'w') as f:
-                f.write(node.build_config())
+    def restore_generated_values(self, manifest):
+        """Reuses passwords, native vlan and tunnel keys generated for
+        the previous run, so the configs which are not rewritten stay
+        consistent with the new ones.
+        Input:
+          manifest - dict, contents of MANIFEST_FILE
+        Output: None
+        """
+        passwords = manifest.get("users", {})
+        for user in self.options.get("users", []):
+            if not user.get('password') and user['username'] in passwords:
+                self.users[user['username']] = passwords[user['username']]
+        native_vlans = manifest.get("native_vlans", {})
+        for domain in self.broadcast_domains:
+            stored = [native_vlans[switch.name] for switch in domain
+                      if switch.name in native_vlans]
+            vlans = domain[0].vlans
+            if stored and stored[0] not in vlans:
+                vlans.discard(domain[0].native_vlan)
+                vlans.add(stored[0])
+                for switch in domain:
+                    switch.native_vlan = stored[0]
+        keys = manifest.get("tunnel_keys", {})
+        for tunnel in self.ipsec_tunnels:
+            tunnel.key = keys.get(tunnel.name, tunnel.key)
+
+    def config_digest(self, node):
+        """Computes the hash of everything the config of the node is built
+        from: its json, global options, generated passwords, vlans of the
+        switches, ipsec tunnels including the addresses of the other
+        endpoints and the templates.
+        Input:
+          node - NetworkDevice instance
+        Output: string, sha256 hex digest
+        """
+        options = dict(self.options)
+        options.pop("ipsec_tunnel", None)
+        names = ['users', 'ssh']
+        inputs = {'node': self.node_digests[node.name], 'options': options,
+                  'users': node.users,
+                  'tunnels': [tunnel.template_values(node)
+                              for tunnel in node.ipsec_tunnels]}
+        if node.ipsec_tunnels:
+            names.append('ipsec_vpn')
+        if node.type == 'switch':
+            inputs['vlans'] = sorted(node.vlans)
+            inputs['native_vlan'] = node.native_vlan
+        inputs['templates'] = [templates.get(node.vendor, name).mtime
+                               for name in names]
+        return json_digest(inputs)
+
+    def create_configs(self, directory="configs", workers=None,
+                       incremental=False):
+        """Builds configs of all nodes and writes them into the directory,
+        one file per node, and MANIFEST_FILE with hashes of their inputs.
+        Random values (passwords, native vlan, tunnel keys) are all chosen
+        while the topology is loaded, rendering itself is deterministic,
+        so the files are the same for any number of workers.
+        Input:
+          directory - string, path to the directory
+          workers - int or None, if more than 1, configs are rendered in
+                    that many processes and written by that many threads
+          incremental - boolean, if True, the directory is not recreated,
+                        only configs of the nodes whose inputs changed since
+                        the previous run are written, configs of removed
+                        nodes are deleted
+        Output: None
+        """
+        stats = self.stats
+        template_reads = templates.reads
+        template_hits = templates.hits
+        manifest_path = os.path.join(directory, MANIFEST_FILE)
+        manifest = {}
+        if incremental:
+            try:
+                with open(manifest_path) as f:
+                    manifest = json.load(f)
+            except (OSError, ValueError):
+                pass
+            # values derived from the seed are the same for every run
+            if self.key is None:
+                self.restore_generated_values(manifest)
+            os.makedirs(directory, exist_ok=True)
+        else:
+            shutil.rmtree(directory, ignore_errors=True)
+            os.makedirs(directory)
+        with stats.stage('digests'):
+            digests = OrderedDict((node.name, self.config_digest(node))
+                                  for node in self.nodes)
+        previous = manifest.get("nodes", {})
+        for name in previous:
+            if name not in digests:
+                try:
+                    os.remove('{path}/{filename}.cfg'.format(path=directory,
+                                                             filename=name))
+                except OSError:
+                    pass
+        indexes = [index for index, node in enumerate(self.nodes)
+                   if previous.get(node.name) != digests[node.name] or
+                   not os.path.exists('{path}/{filename}.cfg'
+                                      .format(path=directory,
+                                              filename=node.name))]
+        self.write_configs(directory, indexes, workers)
+        if stats.enabled:
+            stats.count('configs_written', len(indexes))
+            stats.count('configs_unchanged', len(self.nodes) - len(indexes))
+            stats.count('bytes_written', sum(
+                os.path.getsize('{path}/{filename}.cfg'
+                                .format(path=directory,
+                                        filename=self.nodes[index].name))
+                for index in indexes))
+            # templates of worker processes are not counted
+            stats.count('template_reads', templates.reads - template_reads)
+            stats.count('template_hits', templates.hits - template_hits)
+        manifest = {"nodes": digests,
+                    "users": self.users,
+                    "native_vlans": {switch.name: switch.native_vlan
+                                     for switch in self.switches},
+                    "tunnel_keys": {tunnel.name: tunnel.key
+                                    for tunnel in self.ipsec_tunnels}}
+        with open(manifest_path + '.tmp', 'w') as f:
+            json.dump(manifest, f, indent=1)
+        os.replace(manifest_path + '.tmp', manifest_path)
+
+    def write_configs(self, directory, indexes, workers=None):
+        """Builds and writes configs of the given nodes.
+        Input:
+          directory - string, path to the existing directory
+          indexes - list of indexes in self.nodes
+          workers - int or None, see create_configs
+        Output: None
+        """
+        stats = self.stats
+        if stats.enabled and (not workers or workers < 2):
+            # rendered into memory first to time rendering and writing apart
+            for index in indexes:
+                node = self.nodes[index]
+                with stats.stage('render'):
+                    config = node.build_config()
+                with stats.stage('write'):
+                    write_config_file(directory, node.name, config)
+            return
+        if not workers or workers < 2:
+            for index in indexes:
+                node = self.nodes[index]
+                with open('{path}/{filename}.cfg'
+                          .format(path=directory, filename=node.name),
+                          'w') as f:
+                    node.write_config(f)
+            return
+        # every process gets a few chunks of nodes to balance the load
+        # without sending one task per node
+        chunk = -(-len(indexes) // (workers * 4)) or 1
+        chunks = [indexes[start:start + chunk]
+                  for start in range(0, len(indexes), chunk)]
+        with ProcessPoolExecutor(workers, initializer=init_config_worker,
+                                 initargs=(self,)) as processes, \
+                ThreadPoolExecutor(workers) as threads:
+            # writes overlap with rendering, the write stage is the time
+            # spent waiting for writes after all configs are rendered
+            with stats.stage('render'):
+                writes = [threads.submit(write_config_file, directory, name,
+                                         config)
+                          for configs in processes.map(render_node_configs,
+                                                       chunks)
+                          for name, config in configs]
+            with stats.stage('write'):
+                for write in writes:
+                    write.result()
+
+
+class ReachabilitySimulator(object):
+    """Offline ip reachability check of the topology with resolved links.
+    Every device forwards packets using connected networks of its
+    interfaces, static routes and routes learned by OSPF and EIGRP from
+    the interfaces enabled in the routing config (see
+    NetworkDevice.write_routing_config), the longest prefix wins and then
+    the lowest administrative distance.
+    Dynamic routes follow the shortest path in hops to the router which
+    advertises the network. Shortest path trees are computed once per
+    advertising router and reused by all queries.
+    The simulator works with the topology as it was when the simulator
+    was created.
+    """
+    REACHABLE = 'reachable'
+    NO_ROUTE = 'no route'
+    LOOP = 'loop'
+
+    def __init__(self, topology):
+        """Builds layer 3 segments, routing adjacencies and advertised
+        networks of the topology.
+        Input:
+          topology - Topology instance
+        Output: None
+        """
+        self.topology = topology
+        # device name -> RoutingTable of connected and static routes
+        self.tables = {}
+        # device name -> set of (version, ip_int) of its interfaces
+        self.local = {}
+        # id(interface) -> segment key
+        self.segment_of = {}
+        # segment key -> {(version, ip_int): interface}
+        self.segments = {}
+        # protocol instance -> device name -> list of tuples
+        # (local interface, neighbor interface)
+        self.adjacency = {}
+        # (protocol instance, device name) -> component number
+        self.component = {}
+        # (protocol instance, component number) -> PrefixTrie per version
+        # of networks and names of devices advertising them
+        self.advertised = {}
+        # (protocol instance, advertising device name) -> shortest path
+        # tree, device name -> (hops, local interface, neighbor interface)
+        self.trees = {}
+        # (device name, version, ip_int) -> (status, hops) of packets
+        # forwarded by the device, they are also valid for packets sent
+        # by the device
+        self.results = {}
+        # the same for packets sent by devices which do not forward
+        # packets of other devices, so their results are not valid
+        # when they are in the middle of the path
+        self.source_results = {}
+        self.dynamic_routes = {}
+        domain_of = {}
+        for number, domain in enumerate(topology.broadcast_domains):
+            for switch in domain:
+                domain_of[switch.name] = number
+        for node in topology.nodes:
+            local = self.local[node.name] = set()
+            for interface in node.interfaces:
+                address = interface.ip_address
+                if address is None or not self.is_up(interface):
+                    continue
+                local.add((address.version, address.ip_int))
+                segment = self.find_segment(interface, domain_of)
+                if segment is not None:
+                    self.segment_of[id(interface)] = segment
+                    self.segments.setdefault(segment, {})[
+                        (address.version, address.ip_int)] = interface
+        self.find_adjacencies()
+
+    @staticmethod
+    def is_up(interface):
+        """Shows if the interface and its parent interface are up"""
+        return interface.up and (interface.parent is None or
+                                 interface.parent.up)
+
+    @staticmethod
+    def forwards(device):
+        """Shows if the device routes packets of other devices"""
+        return device.ipv4_routing or \
+            device.type == 'switch' and device.routing
+
+    def find_segment(self, interface, domain_of):
+        """Finds the layer 2 segment of the interface with ip address.
+        Input:
+          interface - Interface instance
+          domain_of - dict, switch name -> number of the broadcast domain
+        Output: hashable segment key, the same for all interfaces
+          of the segment, or None if the interface is not connected
+        """
+        device = interface.device
+        if device.type == 'switch' and interface.name.startswith('Vlan'):
+            return ('vlan', domain_of[device.name],
+                    int(interface.name[len('Vlan'):]))
+        physical = interface.parent or interface
+        other_end = physical.other_end
+        if other_end is None or not other_end.up:
+            return None
+        if other_end.device.type == 'switch' and other_end.switchport:
+            if other_end.type == 'access' and not interface.dot1q:
+                vlan = other_end.vlan
+            elif other_end.type == 'trunk':
+                vlan = interface.dot1q or other_end.device.native_vlan or 1
+            else:
+                return None
+            return ('vlan', domain_of[other_end.device.name], vlan)
+        return ('link', min(id(physical), id(other_end)),
+                max(id(physical), id(other_end)), interface.dot1q)
+
+    def protocols(self, device, interface):
+        """Returns routing protocol instances enabled on the interface.
+        Input:
+          device - NetworkDevice instance
+          interface - Interface instance of the device
+        Output: list of tuples, ('ospf',) or ('eigrp', autonomous system)
+        """
+        instances = []
+        if device.ipv4_routing and interface.ip_address is not None and \
+                self.is_up(interface):
+            if device.ospf and interface.ospf:
+                instances.append(('ospf',))
+            if device.eigrp and interface.eigrp:
+                instances.append(('eigrp', device.eigrp_as))
+        return instances
+
+    def find_adjacencies(self):
+        """Finds routing protocol neighbors: not passive interfaces of
+        the same segment and subnet, also the same area for OSPF, then
+        groups the routers in connected components and collects networks
+        advertised in every component.
+        Input: None
+        Output: None
+        """
+        for segment in self.segments.values():
+            interfaces = list(segment.values())
+            for first in interfaces:
+                for second in interfaces:
+                    if first.device is second.device or \
+                            first.ip_address.get_network() != \
+                            second.ip_address.get_network():
+                        continue
+                    for instance in self.protocols(first.device, first):
+                        if instance not in self.protocols(second.device,
+                                                          second):
+                            continue
+                        if instance == ('ospf',):
+                            if first.ospf_area != second.ospf_area or \
+                                    not first.ospf_not_passive or \
+                                    not second.ospf_not_passive:
+                                continue
+                        elif not first.eigrp_not_passive or \
+                                not second.eigrp_not_passive:
+                            continue
+                        self.adjacency.setdefault(instance, {}).setdefault(
+                            first.device.name, []).append((first, second))
+        for node in self.topology.nodes:
+            for interface in node.interfaces:
+                for instance in self.protocols(node, interface):
+                    key = (instance, node.name)
+                    if key not in self.component:
+                        self.mark_component(instance, node.name,
+                                            len(self.component))
+                    tries = self.advertised.setdefault(
+                        (instance, self.component[key]),
+                        {version: PrefixTrie(bits)
+                         for version, bits in ADDRESS_BITS.items()})
+                    network = interface.ip_address.get_network()
+                    if network is None:
+                        continue
+                    trie = tries[network.version]
+                    advertisers = trie.get(network.ip_int, network.prefixlen)
+                    if advertisers is None:
+                        advertisers = []
+                        trie.insert(network.ip_int, network.prefixlen,
+                                    advertisers)
+                    if node.name not in advertisers:
+                        advertisers.append(node.name)
+
+    def mark_component(self, instance, name, number):
+        """Marks all routers reachable through adjacencies of the
+        protocol instance from the router with the component number"""
+        adjacency = self.adjacency.get(instance, {})
+        self.component[(instance, name)] = number
+        stack = [name]
+        while stack:
+            for local, neighbor in adjacency.get(stack.pop(), ()):
+                key = (instance, neighbor.device.name)
+                if key not in self.component:
+                    self.component[key] = number
+                    stack.append(neighbor.device.name)
+
+    def shortest_path_tree(self, instance, name):
+        """Returns the shortest path tree to the router, it is computed
+        by BFS on the first call and cached.
+        Input:
+          instance - tuple, routing protocol instance
+          name - string, name of the advertising router
+        Output: dict, device name -> tuple (hops, interface towards
+          the router, neighbor interface towards the router or None
+          for the router itself)
+        """
+        key = (instance, name)
+        tree = self.trees.get(key)
+        if tree is None:
+            adjacency = self.adjacency.get(instance, {})
+            tree = self.trees[key] = {name: (0, None, None)}
+            queue = [name]
+            for current in queue:
+                hops = tree[current][0] + 1
+                for local, neighbor in adjacency.get(current, ()):
+                    other = neighbor.device.name
+                    if other not in tree:
+                        tree[other] = (hops, neighbor, local)
+                        queue.append(other)
+        return tree
+
+    def get_table(self, device):
+        """Returns the cached routing table of connected and static
+        routes of the device"""
+        table = self.tables.get(device.name)
+        if table is None:
+            table = self.tables[device.name] = device.build_routing_table()
+        return table
+
+    def best_route(self, device, address):
+        """Finds the route the device uses for the address.
+        Input:
+          device - NetworkDevice instance
+          address - IPAddress instance
+        Output: Route instance or None
+        """
+        best = self.get_table(device).tries[address.version] \
+            .longest_match(address.ip_int)
+        best_key = None
+        if best is not None:
+            best_key = (best[1], -best[2].distance)
+        for instance in ('ospf',), ('eigrp', device.eigrp_as):
+            component = self.component.get((instance, device.name))
+            if component is None:
+                continue
+            match = self.advertised[(instance, component)][
+                address.version].longest_match(address.ip_int)
+            if match is None or device.name in match[2]:
+                continue
+            key = (match[1], -Route.DISTANCES[instance[0]])
+            if best_key is None or key > best_key:
+                route = self.dynamic_route(device, instance, match)
+                if route is not None:
+                    best, best_key = (match[0], match[1], route), key
+        if best is not None:
+            return best[2]
+
+    def dynamic_route(self, device, instance, match):
+        """Returns the route learned by the routing protocol instance
+        through the nearest router advertising the network.
+        Input:
+          device - NetworkDevice instance
+          instance - tuple, routing protocol instance
+          match - tuple (network, prefix length, advertising routers)
+        Output: Route instance or None
+        """
+        prefix, prefixlen, advertisers = match
+        key = (device.name, instance, prefix, prefixlen)
+        if key not in self.dynamic_routes:
+            route = None
+            nearest = None
+            for name in advertisers:
+                path = self.shortest_path_tree(instance, name).get(
+                    device.name)
+                if path is not None and (nearest is None or
+                                         path[0] < nearest[0]):
+                    nearest = path
+            if nearest is not None:
+                hops, local, neighbor = nearest
+                network = local.ip_address.get_network()
+                route = Route(Subnet.from_int(prefix, prefixlen,
+                                              network.version),
+                              instance[0], nexthop=neighbor.ip_address,
+                              interface=local)
+            self.dynamic_routes[key] = route
+        return self.dynamic_routes[key]
+
+    def forward(self, device, address):
+        """Finds where the device sends packets to the address,
+        next hops of routes are resolved recursively.
+        Input:
+          device - NetworkDevice instance
+          address - IPAddress instance
+        Output: tuple (outgoing Interface, IPAddress to send packets to)
+          or None if there is no route
+        """
+        target = address
+        seen = set()
+        while True:
+            route = self.best_route(device, address)
+            if route is None or id(route) in seen:
+                return None
+            seen.add(id(route))
+            if route.nexthop is not None:
+                target = address = route.nexthop
+            if route.interface is not None:
+                return route.interface, target
+
+    def trace(self, source, destination):
+        """Follows packets from the source device to the destination.
+        Input:
+          source - string, device name, or NetworkDevice instance
+          destination - string, ip address, or IPAddress instance
+        Output: tuple (status, hops):
+          status - string, one of REACHABLE, NO_ROUTE (some device has no
+            route or the next hop is not found) or LOOP
+          hops - list of names of devices the packets go through,
+            for LOOP the first repeated device is the last one
+        """
+        if not isinstance(source, NetworkDevice):
+            source = self.topology.index[source]
+        if not isinstance(destination, IPAddress):
+            destination = IPAddress(destination, 'ipv6' if ':' in destination
+                                    else 'ipv4')
+        target = (destination.version, destination.ip_int)
+        device = source
+        hops = []
+        visited = set()
+        status = None
+        result = self.source_results.get((source.name,) + target)
+        if result is not None:
+            return result
+        while status is None:
+            result = self.results.get((device.name,) + target)
+            if result is not None:
+                status = result[0]
+                hops.extend(result[1])
+                break
+            hops.append(device.name)
+            if target in self.local[device.name]:
+                status = ReachabilitySimulator.REACHABLE
+            elif device.name in visited:
+                status = ReachabilitySimulator.LOOP
+            elif device is not source and not self.forwards(device):
+                status = ReachabilitySimulator.NO_ROUTE
+            else:
+                visited.add(device.name)
+                step = self.forward(device, destination)
+                segment = step and self.segment_of.get(id(step[0]))
+                if segment is None:
+                    status = ReachabilitySimulator.NO_ROUTE
+                    break
+                nexthop = step[1]
+                neighbor = self.segments[segment].get((nexthop.version,
+                                                       nexthop.ip_int))
+                if neighbor is None or neighbor is step[0]:
+                    status = ReachabilitySimulator.NO_ROUTE
+                else:
+                    device = neighbor.device
+        if self.forwards(source) or \
+                status == ReachabilitySimulator.REACHABLE and len(hops) == 1:
+            self.results[(source.name,) + target] = (status, hops)
+        else:
+            self.source_results[(source.name,) + target] = (status, hops)
+        if status == ReachabilitySimulator.REACHABLE:
+            # packets from any device on the path take the rest of it
+            for number in range(1, len(hops)):
+                self.results.setdefault((hops[number],) + target,
+                                        (status, hops[number:]))
+        return status, hops
+
+    def is_reachable(self, source, destination):
+        """Shows if packets from the source device reach the destination
+        Input: the same as for trace
+        Output: boolean
+        """
+        return self.trace(source, destination)[0] == \
+            ReachabilitySimulator.REACHABLE
+
+    def trace_many(self, queries):
+        """Traces a lot of source -> destination pairs.
+        Input:
+          queries - iterable of tuples (source, destination), see trace
+        Output: list of tuples (status, hops) in the same order
+        """
+        return [self.trace(source, destination)
+                for source, destination in queries]
+
+    def all_pairs(self, sources=None, destinations=None):
+        """Checks reachability from every source to every destination.
+        Input:
+          sources - list of device names, all routers if None
+          destinations - list of ip address strings, addresses of all
+                         interfaces which are up if None
+        Output: OrderedDict, (source, destination) -> boolean
+        """
+        if sources is None:
+            sources = [node.name for node in self.topology.nodes
+                       if node.type == 'router']
+        if destinations is None:
+            destinations = [interface.ip_address.ip
+                            for node in self.topology.nodes
+                            for interface in node.interfaces
+                            if interface.ip_address is not None and
+                            self.is_up(interface)]
+        reachable = OrderedDict()
+        for source in sources:
+            for destination in destinations:
+                reachable[(source, destination)] = \
+                    self.is_reachable(source, destination)
+        return reachable
@@ -0,0 +1,354 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# this module contains vectorized versions of nhelper ip address helpers,
+# they work on whole numpy.uint32 arrays of ipv4 addresses at once
+# instead of building IPAddress for every address. Requires numpy.
+import numpy
+
+from nhelper import IPAddress, Interface, Subnet, PREFIX_MASKS, ipv4_to_int
+
+# PREFIX_MASK_ARRAY[n] is the netmask of /n
+PREFIX_MASK_ARRAY = numpy.array(PREFIX_MASKS, dtype=numpy.uint32)
+# classify returns indexes in this array
+CLASS_NAMES = numpy.array(['A', 'B', 'C', 'D', 'E'])
+# class index by the first four bits of ip address, see nhelper.ip_to_class
+CLASS_BY_FIRST_BITS = numpy.array([0] * 8 + [1] * 4 + [2] * 2 + [3] + [4],
+                                  dtype=numpy.uint8)
+# characters after the octets of one address in the text parsed by parse_ipv4
+OCTET_ENDS = numpy.frombuffer(b'...,', dtype=numpy.uint8)
+
+def area_to_int(area):
+    """Converts ospf area, like 1, '1' or '0.0.0.1', into an integer,
+    areas in the dotted decimal form are 32-bit numbers
+    """
+    if isinstance(area, str) and '.' in area:
+        return ipv4_to_int(area)
+    return int(area)
+
+def parse_ipv4(addresses):
+    """Converts ipv4 addresses in the decimal form into integers.
+    All addresses are joined into one byte buffer and every octet is
+    computed from at most three digits before its end, so no Python
+    code runs per address.
+    Input:
+      addresses - sequence or numpy array of strings, like '192.168.1.1'
+    Output:
+      numpy.uint32 array
+    Raises IPAddress.WrongIPError if any address is not valid
+    """
+    addresses = list(addresses)
+    if not addresses:
+        return numpy.zeros(0, dtype=numpy.uint32)
+    error = IPAddress.WrongIPError('Not every address is a valid '
+                                   'ipv4 address')
+    try:
+        # addresses are separated by commas, two leading commas make
+        # the digits before the first octet exist
+        text = (',,' + ','.join(addresses) + ',').encode('ascii')
+    except (TypeError, UnicodeEncodeError):
+        raise error
+    buffer = numpy.frombuffer(text, dtype=numpy.uint8)
+    is_end = (buffer == ord('.')) | (buffer == ord(','))
+    ends = numpy.flatnonzero(is_end)[1:]
+    lengths = numpy.diff(ends) - 1
+    ends = ends[1:]
+    digits = buffer.astype(numpy.int32) - ord('0')
+    if len(ends) != 4 * len(addresses) or \
+            not ((digits >= 0) & (digits <= 9) | is_end).all() or \
+            not (buffer[ends].reshape(-1, 4) == OCTET_ENDS).all():
+        raise error
+    if lengths.min() < 1 or lengths.max() > 3:
+        raise error
+    octets = digits[ends - 1] + (lengths >= 2) * 10 * digits[ends - 2] + \
+        (lengths >= 3) * 100 * digits[ends - 3]
+    if octets.max() > 255:
+        raise error
+    octets = octets.astype(numpy.uint32).reshape(-1, 4)
+    return octets[:, 0] << 24 | octets[:, 1] << 16 | \
+        octets[:, 2] << 8 | octets[:, 3]
+
+def format_ipv4(addresses):
+    """Converts integers into ipv4 addresses in the decimal form.
+    Input:
+      addresses - numpy.uint32 array
+    Output:
+      list of strings
+    """
+    addresses = numpy.asarray(addresses, dtype=numpy.uint32)
+    octets = numpy.stack([addresses >> 24, addresses >> 16 & 255,
+                          addresses >> 8 & 255, addresses & 255], axis=1)
+    return ['%d.%d.%d.%d' % tuple(row) for row in octets.tolist()]
+
+def to_subnet(subnet):
+    """Returns Subnet instance for a string or Subnet"""
+    if isinstance(subnet, IPAddress):
+        return subnet
+    return Subnet(subnet)
+
+def contains(subnet, addresses):
+    """Shows which addresses belong to the subnet.
+    Input:
+      subnet - Subnet instance or string, like '10.0.0.0/8'
+      addresses - numpy.uint32 array
+    Output:
+      numpy boolean array
+    """
+    subnet = to_subnet(subnet)
+    addresses = numpy.asarray(addresses, dtype=numpy.uint32)
+    return addresses & numpy.uint32(subnet.mask_int) == \
+        numpy.uint32(subnet.ip_int)
+
+def in_range(addresses, low, high):
+    """Shows which addresses belong to the range (inclusive).
+    Input:
+      addresses - numpy.uint32 array
+      low, high - IPAddress instances, boundaries of the range
+    Output:
+      numpy boolean array
+    """
+    addresses = numpy.asarray(addresses, dtype=numpy.uint32)
+    return (addresses >= numpy.uint32(low.ip_int)) & \
+        (addresses <= numpy.uint32(high.ip_int))
+
+def network_of(addresses, prefixlens):
+    """Computes network address of every address.
+    Input:
+      addresses - numpy.uint32 array
+      prefixlens - int or numpy integer array of the same length,
+                   prefix length of every address
+    Output:
+      numpy.uint32 array
+    """
+    addresses = numpy.asarray(addresses, dtype=numpy.uint32)
+    return addresses & PREFIX_MASK_ARRAY[numpy.asarray(prefixlens)]
+
+def broadcast_of(addresses, prefixlens):
+    """Computes broadcast address of the network of every address.
+    Input:
+      addresses - numpy.uint32 array
+      prefixlens - int or numpy integer array of the same length
+    Output:
+      numpy.uint32 array
+    """
+    addresses = numpy.asarray(addresses, dtype=numpy.uint32)
+    return addresses | ~PREFIX_MASK_ARRAY[numpy.asarray(prefixlens)]
+
+def classify(addresses):
+    """Defines class of every ip address if classful addressing is used.
+    Input:
+      addresses - numpy.uint32 array
+    Output:
+      numpy.uint8 array of indexes in CLASS_NAMES:
+      0 - 'A', 1 - 'B', 2 - 'C', 3 - 'D', 4 - 'E'
+    """
+    addresses = numpy.asarray(addresses, dtype=numpy.uint32)
+    return CLASS_BY_FIRST_BITS[addresses >> 28]
+
+
+class InterfaceStore(object):
+    """Columns of all interfaces of a topology in numpy arrays, so
+    queries over the whole topology run vectorized, like:
+      store.interfaces(store.select(ospf=True, ospf_area=0))
+      store.select(access=True, vlan=20).sum()
+      store.select(subnet='10.0.0.0/8')
+    Row n of every column describes store.rows[n]. The store is kept
+    in sync with interfaces added or removed through
+    NetworkDevice.add_interface and remove_interface, removed rows stay
+    in the columns but are excluded from all queries. Values are taken
+    when the interface is added, refresh() reads them again.
+    """
+    # flags column bits, Interface flags are copied as is
+    FLAGS = {'up': Interface.up.mask,
+             'switchport': Interface.switchport.mask,
+             'ospf': Interface.ospf.mask,
+             'ospf_not_passive': Interface.ospf_not_passive.mask,
+             'eigrp': Interface.eigrp.mask,
+             'eigrp_not_passive': Interface.eigrp_not_passive.mask,
+             'access': 1 << 6,
+             'trunk': 1 << 7}
+    # column name -> (dtype, value of an empty cell)
+    COLUMNS = {'device': (numpy.int32, -1),
+               'name': (numpy.int32, -1),
+               'ip': (numpy.uint32, 0),
+               'prefixlen': (numpy.int8, -1),
+               'vlan': (numpy.int16, 0),
+               'dot1q': (numpy.int16, 0),
+               'ospf_area': (numpy.int64, -1),
+               'flags': (numpy.uint8, 0),
+               'valid': (numpy.bool_, False)}
+
+    def __init__(self, topology=None, capacity=1024):
+        """Creates the store and fills it with all interfaces of
+        the topology.
+        Input:
+          topology - Topology instance or None
+          capacity - int, initial number of rows
+        Output: None
+        """
+        self.size = 0
+        self.columns = {name: numpy.full(capacity, empty, dtype=dtype)
+                        for name, (dtype, empty) in self.COLUMNS.items()}
+        self.rows = []
+        # id of Interface -> row, interfaces are not hashable
+        self.row_index = {}
+        self.devices = []
+        self.device_ids = {}
+        self.names = []
+        self.name_ids = {}
+        if topology is not None:
+            for device in topology.nodes:
+                self.attach(device)
+
+    def __getattr__(self, name):
+        """Columns are available as attributes, like store.ip,
+        only filled rows are returned"""
+        try:
+            columns = self.__dict__['columns']
+        except KeyError:
+            raise AttributeError(name)
+        if name not in columns:
+            raise AttributeError(name)
+        return columns[name][:self.size]
+
+    def __len__(self):
+        return int(self.valid.sum())
+
+    def attach(self, device):
+        """Adds all interfaces of the device and follows its changes"""
+        self.device_ids[id(device)] = len(self.devices)
+        self.devices.append(device)
+        device.interface_listeners.append(self.on_change)
+        for interface in device.interfaces:
+            self.add(interface)
+
+    def close(self):
+        """Stops following changes of the devices"""
+        for device in self.devices:
+            if self.on_change in device.interface_listeners:
+                device.interface_listeners.remove(self.on_change)
+
+    def on_change(self, interface, added):
+        """Listener of NetworkDevice.add_interface and remove_interface"""
+        if added:
+            self.add(interface)
+        else:
+            self.remove(interface)
+
+    def grow(self):
+        """Doubles the capacity of all columns"""
+        for name, (dtype, empty) in self.COLUMNS.items():
+            column = self.columns[name]
+            grown = numpy.full(max(2 * len(column), 16), empty, dtype=dtype)
+            grown[:len(column)] = column
+            self.columns[name] = grown
+
+    def add(self, interface):
+        """Appends the row of the interface
+        Output: int, the row
+        """
+        row = self.size
+        if row == len(self.columns['valid']):
+            self.grow()
+        self.size += 1
+        self.rows.append(interface)
+        self.row_index[id(interface)] = row
+        self.fill(row, interface)
+        return row
+
+    def fill(self, row, interface):
+        """Writes values of the interface into the row"""
+        columns = self.columns
+        name_id = self.name_ids.get(interface.name)
+        if name_id is None:
+            name_id = self.name_ids[interface.name] = len(self.names)
+            self.names.append(interface.name)
+        columns['device'][row] = self.device_ids.get(id(interface.device), -1)
+        columns['name'][row] = name_id
+        address = interface.ip_address
+        if address is not None and address.version == 'ipv4':
+            columns['ip'][row] = address.ip_int
+            columns['prefixlen'][row] = address.get_prefixlen()
+        columns['vlan'][row] = interface.vlan or 0
+        columns['dot1q'][row] = interface.dot1q or 0
+        if interface.ospf_area is not None:
+            columns['ospf_area'][row] = area_to_int(interface.ospf_area)
+        flags = interface.flags
+        if interface.type == 'access':
+            flags |= self.FLAGS['access']
+        elif interface.type == 'trunk':
+            flags |= self.FLAGS['trunk']
+        columns['flags'][row] = flags
+        columns['valid'][row] = True
+
+    def remove(self, interface):
+        """Excludes the row of the interface from queries"""
+        row = self.row_index.pop(id(interface), None)
+        if row is not None:
+            self.columns['valid'][row] = False
+            self.rows[row] = None
+
+    def refresh(self):
+        """Reads values of all interfaces again"""
+        for name, (dtype, empty) in self.COLUMNS.items():
+            self.columns[name][:self.size] = empty
+        for row, interface in enumerate(self.rows):
+            if interface is not None:
+                self.fill(row, interface)
+
+    def select(self, subnet=None, device=None, **conditions):
+        """Finds rows matching all conditions.
+        Input:
+          subnet - Subnet instance or string, rows with ipv4 address
+                   in the subnet
+          device - string, name of the device
+          conditions - flag=boolean for flags in FLAGS, like ospf=True,
+                       or column=value, like vlan=20 or ospf_area=0,
+                       ospf_area may be dotted, like '0.0.0.1'
+        Output: numpy boolean array with a value for every row
+        """
+        mask = self.valid.copy()
+        if subnet is not None:
+            mask &= contains(subnet, self.ip) & (self.prefixlen >= 0)
+        if device is not None:
+            ids = [number for number, item in enumerate(self.devices)
+                   if item.name == device]
+            mask &= numpy.isin(self.device, ids)
+        for name, value in conditions.items():
+            if name in self.FLAGS:
+                has_flag = (self.flags & self.FLAGS[name]) != 0
+                mask &= has_flag if value else ~has_flag
+            elif name == 'ospf_area':
+                mask &= self.ospf_area == area_to_int(value)
+            elif name in self.COLUMNS:
+                mask &= getattr(self, name) == value
+            else:
+                raise KeyError('Unknown column: ' + name)
+        return mask
+
+    def interfaces(self, mask=None):
+        """Returns Interface instances of the rows selected by the mask"""
+        if mask is None:
+            mask = self.valid
+        return [self.rows[row] for row in numpy.flatnonzero(mask)]
+
+    def count_by_device(self, mask=None):
+        """Counts selected rows of every device.
+        Output: dict, device name -> number of rows
+        """
+        if mask is None:
+            mask = self.valid
+        counts = numpy.bincount(self.device[mask & (self.device >= 0)],
+                                minlength=len(self.devices))
+        return {device.name: int(count)
+                for device, count in zip(self.devices, counts)}
+
+    def count_by(self, column, mask=None):
+        """Counts selected rows of every value of the column.
+        Output: dict, value -> number of rows
+        """
+        if mask is None:
+            mask = self.valid
+        values, counts = numpy.unique(getattr(self, column)[mask],
+                                      return_counts=True)
+        return dict(zip(values.tolist(), counts.tolist()))
@@ -53,7 +53,8 @@ class MyWindow(QtGui.QWidget, form_ui.Ui_Form):
                 item.setFlag(QtGui.QGraphicsItem.ItemIsMovable, False)
         else:
             if self.current_node and self.current_node.device.interfaces:
-                self.current_node.device.interfaces.pop()
+                device = self.current_node.device
+                device.remove_interface(device.interfaces[-1])
                 self.current_node = None
             for item in self.scene.items():
                 item.setFlag(QtGui.QGraphicsItem.ItemIsMovable, True)
@@ -178,7 +179,7 @@ class GraphicsItem(QtGui.QGraphicsPixmapItem):
             if self.form.current_node == self:
                 self.form.current_node = None
                 if self.device.interfaces:
-                    self.device.interfaces.pop()
+                    self.device.remove_interface(self.device.interfaces[-1])
             else:
                 dialog = AddLinkDialog(self.form, self)
                 for interface in nhelper.INTERFACES:
@@ -2,9 +2,20 @@
 # -*- coding: utf-8 -*-
 
 # unit tests for nhelper.py
+import io
+import json
+import multiprocessing
+import os
+import pickle
+import shutil
+import tempfile
 import unittest
+from concurrent.futures import ProcessPoolExecutor
 from nhelper import *
 
+def setUpModule():
+    load_ip_address_description()
+
 class TestNetworkTools(unittest.TestCase):
     def test_convert_mask_with_slash(self):
         self.assertEqual(convert_mask('/4'), '240.0.0.0')
@@ -41,12 +52,80 @@ class TestNetworkTools(unittest.TestCase):
         self.assertEqual(convert_mask('11111111.11111111.11111111.11111100',
                                       'slash'), '/30')
 
+    def test_convert_mask_with_wildcard_view(self):
+        self.assertEqual(convert_mask('/27', 'wildcard'), '0.0.0.31')
+        self.assertEqual(convert_mask('255.255.0.0', 'wildcard'),
+                         '0.0.255.255')
+        self.assertEqual(convert_mask('11111111111111111111111111111100'),
+                         '255.255.255.252')
+        self.assertEqual(convert_to_wildcard('11111111111111111111111100000000'),
+                         '0.0.0.255')
+
+    def test_convert_mask_wrong_input(self):
+        self.assertRaises(WrongMaskError, convert_mask, '/33')
+        self.assertRaises(WrongMaskError, convert_mask, '255.0.255.0')
+        self.assertRaises(WrongMaskError, convert_mask, '1.2.3')
+        self.assertRaises(WrongMaskError, convert_mask, '/24', 'hex')
+
+    def test_summarize_subnets(self):
+        subnets = ['192.168.0.0/24', '192.168.1.0/24', '192.168.2.0/24',
+                   '192.168.3.0/25', '10.0.0.0/8', '10.1.0.0/16']
+        self.assertEqual(summarize_subnets(subnets),
+                         ['10.0.0.0 255.0.0.0', '192.168.0.0 255.255.254.0',
+                          '192.168.2.0 255.255.255.0',
+                          '192.168.3.0 255.255.255.128'])
+        self.assertEqual(summarize_subnets(subnets, 'slash'),
+                         ['10.0.0.0/8', '192.168.0.0/23',
+                          '192.168.2.0/24', '192.168.3.0/25'])
+        self.assertEqual(summarize_subnets([Subnet('172.16.0.0/25'),
+                                            Subnet('172.16.0.128/25')],
+                                           'wildcard'),
+                         ['172.16.0.0 0.0.0.255'])
+        self.assertEqual(summarize_subnets([]), [])
+
+    def test_summarize_subnets_smart(self):
+        subnets = ['192.168.0.0/24', '192.168.1.0/24', '192.168.2.0/24']
+        self.assertEqual(summarize_subnets(subnets, 'slash', smart=True),
+                         ['192.168.0.0/22'])
+        self.assertEqual(summarize_subnets(subnets, 'slash', smart=True,
+                                           overcoverage=0.2),
+                         ['192.168.0.0/23', '192.168.2.0/24'])
+        self.assertEqual(summarize_subnets(subnets, 'slash', smart=True,
+                                           overcoverage=0),
+                         summarize_subnets(subnets, 'slash'))
+
     def test_load_ip_address_description(self):
         self.assertEqual(ipv4[0].get('224.0.0.19'), \
                         'IS-IS over IP')
         self.assertEqual(ipv4[1].get('203.0.113.0/24'), \
                         'TEST-NET-3')
 
+    def test_PrefixTrie_longest_match(self):
+        trie = PrefixTrie()
+        trie.insert(IPAddress('10.0.0.0').ip_int, 8, 'ten')
+        trie.insert(IPAddress('10.1.0.0').ip_int, 16, 'ten-one')
+        trie.insert(IPAddress('10.1.2.0').ip_int, 24, 'ten-one-two')
+        trie.insert(0, 0, 'default')
+        self.assertEqual(len(trie), 4)
+        self.assertEqual(trie.lookup(IPAddress('10.1.2.3').ip_int),
+                         'ten-one-two')
+        self.assertEqual(trie.lookup(IPAddress('10.1.3.3').ip_int), 'ten-one')
+        self.assertEqual(trie.lookup(IPAddress('10.2.0.1').ip_int), 'ten')
+        self.assertEqual(trie.lookup(IPAddress('11.0.0.1').ip_int), 'default')
+        self.assertEqual(trie.longest_match(IPAddress('10.1.2.3').ip_int),
+                         (IPAddress('10.1.2.0').ip_int, 24, 'ten-one-two'))
+        self.assertEqual(trie.get(IPAddress('10.1.0.0').ip_int, 16), 'ten-one')
+        self.assertIsNone(trie.get(IPAddress('10.1.0.0').ip_int, 17))
+        self.assertEqual([prefixlen for _, prefixlen, _ in trie.items()],
+                         [0, 8, 16, 24])
+
+    def test_range_to_prefixes(self):
+        first = IPAddress('10.0.0.1').ip_int
+        last = IPAddress('10.0.0.8').ip_int
+        self.assertEqual(list(range_to_prefixes(first, last)),
+                         [(first, 32), (first + 1, 31),
+                          (first + 3, 30), (last, 32)])
+
     def test_IPAddress_class_wrong_ip(self):
         self.assertRaises(IPAddress.WrongIPError,
                           IPAddress, '300.300.300.300/24')
@@ -124,12 +203,731 @@ class TestNetworkTools(unittest.TestCase):
                           % ('10.10.20.0', '255.0.0.0',
                              'Class A', 'Private-Use Networks'))
 
+    def test_IPAddress_class_ipv6(self):
+        test_ip = IPAddress('2001:0DB8:0000:0000:0001:0000:0000:0001/64',
+                            version='ipv6')
+        self.assertEqual(test_ip.ip, '2001:db8::1:0:0:1')
+        self.assertEqual(test_ip.get_mask(), '/64')
+        self.assertIsNone(test_ip.get_class())
+        self.assertEqual(test_ip.get_network(),
+                         Subnet('2001:db8::/64', version='ipv6'))
+        self.assertTrue(test_ip.is_in_subnet(Subnet('2001:db8::/32',
+                                                    version='ipv6')))
+        self.assertFalse(test_ip.is_in_subnet(Subnet('2002::/16',
+                                                     version='ipv6')))
+        self.assertFalse(IPAddress('0.0.0.1').is_in_subnet(
+            Subnet('::/96', version='ipv6')))
+        self.assertEqual(test_ip.get_description(), 'Documentation')
+        self.assertEqual(IPAddress('ff02::5', version='ipv6').get_description(),
+                         'OSPFv3 All SPF routers')
+        self.assertEqual(IPAddress('::ffff:192.168.1.1', version='ipv6').ip,
+                         '::ffff:c0a8:101')
+        self.assertEqual((IPAddress('::ffff', version='ipv6') + 1).ip,
+                         '::1:0')
+        for wrong_ip in '1::2::3', '12345::', 'g::', '1:2:3:4:5:6:7:8:9', \
+                        '1:2:3:4:5:6:7::8', '2001:db8::/129':
+            self.assertRaises(IPAddress.WrongIPError,
+                              IPAddress, wrong_ip, 'ipv6')
+
+    def test_Subnet_class_ipv6(self):
+        test_subnet = Subnet('2001:db8::/64', version='ipv6')
+        self.assertEqual(test_subnet.get_first_address().ip, '2001:db8::1')
+        self.assertEqual(test_subnet.get_last_address().ip,
+                         '2001:db8::ffff:ffff:ffff:ffff')
+        self.assertEqual(test_subnet.get_wildcard(), '::ffff:ffff:ffff:ffff')
+        self.assertEqual(test_subnet.divide(66)[3],
+                         Subnet('2001:db8::c000:0:0:0/66', version='ipv6'))
+        self.assertEqual(summarize_subnets(['2001:db8::/65',
+                                            '2001:db8:0:0:8000::/65']),
+                         ['2001:db8::/64'])
+        self.assertRaises(Subnet.WrongSubnetError,
+                          Subnet, '2001:db8::1/64', 'ipv6')
+
     def test_Subnet_class_wrong_network_address(self):
         self.assertRaises(Subnet.WrongSubnetError,
                           Subnet, '10.10.10.1/24')
         self.assertRaises(Subnet.WrongSubnetError,
                           Subnet, '192.168.1.0/23')
 
+    def test_Subnet_class_addresses(self):
+        test_subnet = Subnet('192.168.1.0/27')
+        self.assertEqual(test_subnet.get_first_address().ip, '192.168.1.1')
+        self.assertEqual(test_subnet.get_last_address().ip, '192.168.1.30')
+        self.assertEqual(test_subnet.get_broadcast_address().ip,
+                         '192.168.1.31')
+        self.assertEqual(test_subnet.get_wildcard(), '0.0.0.31')
+        test_subnet = Subnet('10.0.0.1/32')
+        self.assertEqual(test_subnet.get_first_address(), test_subnet)
+        self.assertEqual(test_subnet.get_broadcast_address(), test_subnet)
+
+    def test_IPAddress_from_int(self):
+        test_ip = IPAddress.from_int(3232235779, 30)
+        self.assertEqual(test_ip, IPAddress('192.168.1.3/30'))
+        self.assertEqual(test_ip.ip, '192.168.1.3')
+        self.assertEqual(test_ip.get_mask(), '255.255.255.252')
+        self.assertEqual(test_ip.get_binary_form(),
+                         '11000000101010000000000100000011')
+        self.assertNotEqual(test_ip, IPAddress('192.168.1.3/24'))
+        self.assertEqual((test_ip + 1).ip, '192.168.1.4')
+        self.assertEqual((test_ip - 4).ip, '192.168.0.255')
+        self.assertRaises(IPAddress.WrongIPError,
+                          IPAddress.from_int, 2 ** 32)
+        self.assertRaises(Subnet.WrongSubnetError,
+                          Subnet.from_int, 3232235779, 24)
+        self.assertRaises(IPAddress.WrongIPError,
+                          IPAddress, '1.2.3.4 255.0.255.0')
+
+    def test_Subnet_divide(self):
+        networks = Subnet('192.168.0.0/24').divide(26)
+        self.assertEqual([network.ip for network in networks],
+                         ['192.168.0.0', '192.168.0.64',
+                          '192.168.0.128', '192.168.0.192'])
+        self.assertEqual(networks[1], Subnet('192.168.0.64/26'))
+        networks = Subnet('10.0.0.0/8').divide(30, lazy=True)
+        self.assertEqual(next(networks), Subnet('10.0.0.0/30'))
+        self.assertEqual(next(networks), Subnet('10.0.0.4/30'))
+        self.assertRaises(Subnet.WrongSubnetError,
+                          Subnet('10.0.0.0/24').divide, 23)
+
+    def test_Subnet_allocate(self):
+        networks = Subnet('192.168.0.0/24').allocate([2, 50, 100, 10])
+        self.assertEqual(networks, [Subnet('192.168.0.208/30'),
+                                    Subnet('192.168.0.128/26'),
+                                    Subnet('192.168.0.0/25'),
+                                    Subnet('192.168.0.192/28')])
+        self.assertRaises(SubnetAllocator.NoSpaceError,
+                          Subnet('192.168.0.0/24').allocate, [100, 100, 1])
+
+    def test_SubnetAllocator_release(self):
+        allocator = SubnetAllocator(Subnet('10.0.0.0/24'))
+        networks = [allocator.allocate(26) for _ in range(4)]
+        self.assertEqual(networks[3], Subnet('10.0.0.192/26'))
+        self.assertRaises(SubnetAllocator.NoSpaceError,
+                          allocator.allocate, 32)
+        allocator.release(networks[1])
+        self.assertEqual(allocator.allocate(27), Subnet('10.0.0.64/27'))
+        allocator.release(Subnet('10.0.0.64/27'))
+        for network in networks[0], networks[2], networks[3]:
+            allocator.release(network)
+        self.assertEqual(allocator.allocate(24), Subnet('10.0.0.0/24'))
+
+    def test_IPAddress_is_immutable_and_hashable(self):
+        test_ip = IPAddress('192.168.1.3/30')
+        with self.assertRaises(AttributeError):
+            test_ip.ip = '192.168.1.4'
+        self.assertEqual(len({test_ip, IPAddress('192.168.1.3 255.255.255.252'),
+                              IPAddress.from_int(test_ip.ip_int, 30)}), 1)
+        test_subnet = Subnet('10.0.0.0/8')
+        self.assertEqual(pickle.loads(pickle.dumps(test_subnet)), test_subnet)
+        self.assertIsInstance(pickle.loads(pickle.dumps(test_subnet)), Subnet)
+
+    def test_parse_cache(self):
+        maxsize = parse_cache.maxsize
+        try:
+            parse_cache.resize(2)
+            parse_cache.clear()
+            first = IPAddress('10.1.1.1/24')
+            self.assertIs(IPAddress('10.1.1.1/24'), first)
+            self.assertIsNot(Subnet('10.1.1.0/24'), IPAddress('10.1.1.0/24'))
+            self.assertEqual(parse_cache.stats(), {'hits': 1, 'misses': 3,
+                                                   'size': 2, 'maxsize': 2})
+            self.assertIsNot(IPAddress('10.1.1.1/24'), first)
+            parse_cache.resize(0)
+            self.assertIsNot(IPAddress('10.1.1.1/24'),
+                             IPAddress('10.1.1.1/24'))
+            self.assertEqual(parse_cache.stats()['size'], 0)
+        finally:
+            parse_cache.resize(maxsize)
+
+    def test_TemplateRegistry(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        os.makedirs(os.path.join(directory, 'cisco'))
+        path = os.path.join(directory, 'cisco', 'motd.cfg')
+        with open(path, 'w') as f:
+            f.write('banner motd #{text}#')
+        registry = TemplateRegistry(directory, check_interval=0)
+        self.assertEqual(registry.render('cisco', 'motd', text='hi'),
+                         'banner motd #hi#')
+        self.assertEqual(registry.render('cisco', 'motd', text='hello'),
+                         'banner motd #hello#')
+        self.assertEqual((registry.reads, registry.hits), (1, 1))
+        with open(path, 'w') as f:
+            f.write('banner login #{text}#')
+        os.utime(path, (0, 0))
+        self.assertEqual(registry.render('cisco', 'motd', text='hi'),
+                         'banner login #hi#')
+        self.assertEqual(registry.reads, 2)
+
+    def test_NetworkDevice_templates(self):
+        router = Router('R1')
+        router.users = {'admin': 'secret'}
+        self.assertEqual(router.build_config_users(),
+                         'username admin password secret\n')
+        self.assertTrue(router.generate_ssh_config()
+                        .startswith('ip domain-name cisco.com\n'))
+
+    def test_Topology_create_configs_workers(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        topology = Topology('topology.json')
+        serial = os.path.join(directory, 'serial')
+        parallel = os.path.join(directory, 'parallel')
+        topology.create_configs(serial)
+        topology.create_configs(parallel, workers=2)
+        self.assertEqual(sorted(os.listdir(serial)),
+                         ['.manifest.json', 'R1.cfg', 'R2.cfg', 'R3.cfg',
+                          'R4.cfg', 'SW1.cfg'])
+        for filename in os.listdir(serial):
+            with open(os.path.join(serial, filename)) as f, \
+                    open(os.path.join(parallel, filename)) as g:
+                self.assertEqual(f.read(), g.read())
+
+    def test_Topology_pickle_chain(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        nodes = []
+        links = []
+        for number in range(3000):
+            nodes.append({'name': 'R{}'.format(number), 'type': 'router',
+                          'interfaces': [{'name': 'e0/0'},
+                                         {'name': 'e0/1'}]})
+            if number:
+                links.append({'src_node': 'R{}'.format(number - 1),
+                              'src_int': 'e0/1',
+                              'dst_node': 'R{}'.format(number),
+                              'dst_int': 'e0/0'})
+        path = os.path.join(directory, 'chain.json')
+        with open(path, 'w') as f:
+            json.dump({'topology': {'nodes': nodes, 'links': links}}, f)
+        topology = Topology(path, seed='chain')
+        copy = pickle.loads(pickle.dumps(topology))
+        first, second = copy.nodes[0], copy.nodes[1]
+        self.assertIs(first.get_interface('e0/1').other_end,
+                      second.get_interface('e0/0'))
+        self.assertIs(second.get_interface('e0/0').other_end.device, first)
+        self.assertIsNone(first.get_interface('e0/0').other_end)
+        # spawn and forkserver send the topology to workers by pickling
+        with ProcessPoolExecutor(
+                1, mp_context=multiprocessing.get_context('spawn'),
+                initializer=init_config_worker,
+                initargs=(topology,)) as processes:
+            configs = list(processes.map(render_node_configs, [[0, 2999]]))
+        self.assertEqual(configs, [[('R0', topology.nodes[0].build_config()),
+                                    ('R2999',
+                                     topology.nodes[2999].build_config())]])
+
+    def test_Topology_create_configs_incremental(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        Topology('topology.json').create_configs(directory)
+        configs = {}
+        for filename in ['R1.cfg', 'R2.cfg', 'R3.cfg', 'SW1.cfg']:
+            path = os.path.join(directory, filename)
+            os.utime(path, (0, 0))
+            with open(path) as f:
+                configs[filename] = f.read()
+        topology_json = get_input_topology('topology.json')
+        nodes = topology_json['topology']['nodes']
+        nodes[:] = [node for node in nodes if node['name'] != 'R4']
+        links = topology_json['topology']['links']
+        links[:] = [link for link in links if 'R4' not in
+                    (link['src_node'], link['dst_node'])]
+        for node in nodes:
+            if node['name'] == 'R3':
+                node['interfaces'][0]['ip'] = '10.0.23.30/24'
+        path = os.path.join(directory, 'topology.json')
+        with open(path, 'w') as f:
+            json.dump(topology_json, f)
+        Topology(path).create_configs(directory, incremental=True)
+        self.assertNotIn('R4.cfg', os.listdir(directory))
+        for filename in ['R1.cfg', 'R2.cfg', 'SW1.cfg']:
+            path = os.path.join(directory, filename)
+            self.assertEqual(os.stat(path).st_mtime, 0)
+            with open(path) as f:
+                self.assertEqual(f.read(), configs[filename])
+        with open(os.path.join(directory, 'R3.cfg')) as f:
+            self.assertIn('10.0.23.30', f.read())
+
+    def test_Topology_create_configs_incremental_tunnel(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        topology_json = get_input_topology('topology.json')
+        topology_json['options']['ipsec_tunnel'] = [
+            {'R1': {'tunnel_int': 'e0/1', 'encrypted_traffic': '1.1.1.1/32'},
+             'R4': {'tunnel_int': 'e0/1',
+                    'encrypted_traffic': '4.4.4.4/32'}}]
+        path = os.path.join(directory, 'topology.json')
+        with open(path, 'w') as f:
+            json.dump(topology_json, f)
+        configs = os.path.join(directory, 'configs')
+        Topology(path, seed='tunnel').create_configs(configs)
+        with open(os.path.join(configs, 'R1.cfg')) as f:
+            self.assertIn('set peer 10.0.1.4\n', f.read())
+        for node in topology_json['topology']['nodes']:
+            if node['name'] == 'R4':
+                node['interfaces'][0]['ip'] = '10.0.1.99/24'
+        with open(path, 'w') as f:
+            json.dump(topology_json, f)
+        topology = Topology(path, seed='tunnel')
+        topology.create_configs(configs, incremental=True)
+        with open(os.path.join(configs, 'R1.cfg')) as f:
+            config = f.read()
+        self.assertIn('set peer 10.0.1.99\n', config)
+        self.assertEqual(config, topology.index['R1'].build_config())
+
+    def test_Topology_interface_down(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        topology_json = get_input_topology('topology.json')
+        for node in topology_json['topology']['nodes']:
+            if node['name'] == 'R4':
+                node['interfaces'][0]['up'] = False
+        path = os.path.join(directory, 'topology.json')
+        with open(path, 'w') as f:
+            json.dump(topology_json, f)
+        router = Topology(path).index['R4']
+        self.assertFalse(router.get_interface('e0/1').up)
+        self.assertIn('interface Ethernet0/1\n'
+                      ' ip address 10.0.1.4 255.255.255.0\n'
+                      ' shutdown\n!\n', router.build_config())
+        self.assertIn(' no shutdown\n',
+                      Topology('topology.json').index['R4'].build_config())
+
+    def test_Topology_stream(self):
+        topology = Topology('topology.json')
+        streamed = Topology('topology.json', stream=True)
+        self.assertIsNone(streamed.json)
+        self.assertEqual(streamed.links, topology.links)
+        self.assertEqual(streamed.node_digests, topology.node_digests)
+        self.assertEqual([node.name for node in streamed.nodes],
+                         ['R1', 'SW1', 'R2', 'R3', 'R4'])
+        streamed.users = topology.users
+        streamed.switches[0].native_vlan = topology.switches[0].native_vlan
+        streamed.switches[0].vlans = topology.switches[0].vlans
+        for node in streamed.nodes:
+            node.users = topology.users
+            self.assertEqual(node.build_config(),
+                             topology.index[node.name].build_config())
+        items = list(iter_topology('topology.json', chunk_size=7))
+        self.assertEqual([kind for kind, item in items],
+                         ['options'] + ['link'] * 4 + ['node'] * 5)
+
+    def test_JSONStream(self):
+        document = '{"a": [1, 23456, {"b": "}]"}], "c": {}, "d": [] }'
+        stream = JSONStream(io.StringIO(document), chunk_size=2)
+        result = {}
+        for key in stream.items():
+            result[key] = list(stream.elements()) if key != 'c' \
+                else stream.value()
+        self.assertEqual(result, json.loads(document))
+        # numbers split after '.' or the exponent at every chunk size
+        document = '[1.5, 2e3, 10, -0.25E-2, 7E+1, true, 3.0]'
+        for chunk_size in range(1, len(document) + 1):
+            stream = JSONStream(io.StringIO(document), chunk_size=chunk_size)
+            self.assertEqual(list(stream.elements()), json.loads(document))
+        stream = JSONStream(io.StringIO('{"a": [1, 2}'), chunk_size=3)
+        with self.assertRaises(ValueError):
+            for key in stream.items():
+                list(stream.elements())
+
+    def test_NetworkDevice_interfaces(self):
+        router = Router('R1')
+        ethernet = Interface('e0/0')
+        router.add_interface(ethernet)
+        router.add_interface(Interface('Loopback0'))
+        router.add_interface(Interface('Ethernet0/0'))
+        self.assertEqual(len(router.interfaces), 2)
+        self.assertIs(router.get_interface('Eth0/0'), ethernet)
+        self.assertIs(router.get_interface('Ethernet0/0'), ethernet)
+        self.assertIsNone(router.get_interface('Ethernet0/1'))
+        router.remove_interface(ethernet)
+        self.assertIsNone(router.get_interface('e0/0'))
+        self.assertEqual([str(interface) for interface in router.interfaces],
+                         ['Loopback0'])
+
+    def test_Topology_resolve_links(self):
+        topology = Topology('topology.json')
+        r1 = topology.index['R1']
+        sw1 = topology.index['SW1']
+        self.assertIs(r1.get_interface('e0/0').other_end,
+                      sw1.get_interface('e0/0'))
+        self.assertIs(sw1.get_interface('e0/0').other_end,
+                      r1.get_interface('e0/0'))
+        self.assertIsNone(r1.get_interface('Loopback0').other_end)
+        topology.links = [
+            {'src_node': 'R1', 'src_int': 'e0/0',
+             'dst_node': 'R9', 'dst_int': 'e0/0'},
+            {'src_node': 'R1', 'src_int': 'e0/7',
+             'dst_node': 'R2', 'dst_int': 'e0/0'},
+            {'src_node': 'R2', 'src_int': 'e0/0',
+             'dst_node': 'R2', 'dst_int': 'Ethernet0/0'},
+            {'src_node': 'R3', 'src_int': 'e0/0',
+             'dst_node': 'R2', 'dst_int': 'e0/0'},
+        ]
+        with self.assertRaises(Topology.LinkError) as context:
+            topology.resolve_links()
+        self.assertEqual(context.exception.errors, [
+            'Link 1: unknown node R9',
+            'Link 2: unknown interface e0/7 on R1',
+            'Link 3: R2 Ethernet0/0 is linked to itself',
+        ])
+        topology.links.pop(0)
+        topology.links.append({'src_node': 'R1', 'src_int': 'e0/0',
+                               'dst_node': 'R3', 'dst_int': 'e0/0'})
+        with self.assertRaises(Topology.LinkError) as context:
+            topology.resolve_links()
+        self.assertEqual(context.exception.errors[-1],
+                         'Link 4: R3 Ethernet0/0 is already used by link 3')
+
+    def test_Switch_add_to_switch_group(self):
+        switches = [Switch('SW{}'.format(number)) for number in range(5000)]
+        for first, second in zip(switches, switches[1:]):
+            uplink = Interface('e0/1', device=first)
+            downlink = Interface('e0/0', device=second)
+            first.add_interface(uplink)
+            second.add_interface(downlink)
+            uplink.other_end, downlink.other_end = downlink, uplink
+        group = []
+        switches[0].add_to_switch_group(group)
+        self.assertEqual(group, switches)
+
+    def test_Topology_broadcast_domains(self):
+        def interface(name, vlan=None, dot1q=None, ip=None):
+            return {'name': name, 'vlan': vlan, 'switchport': bool(vlan),
+                    'dot1q': dot1q, 'ip': ip}
+        def switch(name, *interfaces):
+            return {'name': name, 'type': 'switch',
+                    'interfaces': list(interfaces)}
+        def link(src_node, src_int, dst_node, dst_int):
+            return {'src_node': src_node, 'src_int': src_int,
+                    'dst_node': dst_node, 'dst_int': dst_int}
+        topology_json = {'options': {}, 'topology': {'nodes': [
+            switch('SW1', interface('e0/0', 'trunk'), interface('e0/1', 10)),
+            switch('SW2', interface('e0/0', 'trunk'),
+                   interface('e0/1', 'trunk')),
+            switch('SW3', interface('e0/0', 30)),
+            {'name': 'R1', 'type': 'router', 'interfaces': [
+                interface('e0/0'),
+                interface('e0/0.20', dot1q=20, ip='10.0.20.1/24'),
+                interface('e0/0.40', dot1q='40', ip='10.0.40.1/24'),
+                interface('e0/0.50', ip='10.0.50.1/24')]},
+        ], 'links': [link('SW1', 'e0/0', 'SW2', 'e0/0'),
+                     link('R1', 'e0/0', 'SW2', 'e0/1')]}}
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'topology.json')
+        with open(path, 'w') as f:
+            json.dump(topology_json, f)
+        topology = Topology(path)
+        self.assertEqual([[switch.name for switch in domain]
+                          for domain in topology.broadcast_domains],
+                         [['SW1', 'SW2'], ['SW3']])
+        sw1, sw2, sw3 = topology.switches
+        self.assertIs(sw1.vlans, sw2.vlans)
+        self.assertEqual(set(sw1.vlans) - {sw1.native_vlan},
+                         {1, 10, 20, 40})
+        self.assertEqual(set(sw3.vlans) - {sw3.native_vlan}, {1, 30})
+        self.assertTrue(500 <= sw3.native_vlan <= 1000)
+        router = topology.index['R1']
+        self.assertEqual(router.get_interface('e0/0').children,
+                         [router.get_interface('e0/0.20'),
+                          router.get_interface('e0/0.40'),
+                          router.get_interface('e0/0.50')])
+        self.assertEqual(router.get_interface('e0/0.40').dot1q, 40)
+        self.assertEqual(list(sw2.get_router_vlans()), [20, 40])
+        sw2.vlans = VlanSet()
+        group = []
+        sw1.add_to_switch_group(group)
+        self.assertEqual(group, [sw1, sw2])
+        self.assertEqual(list(sw2.vlans), [20, 40])
+
+    def test_DisjointSet(self):
+        sets = DisjointSet(6)
+        sets.union(0, 1)
+        sets.union(2, 3)
+        sets.union(1, 3)
+        self.assertEqual(len({sets.find(item) for item in range(4)}), 1)
+        self.assertNotEqual(sets.find(4), sets.find(5))
+        self.assertNotEqual(sets.find(0), sets.find(5))
+
+    def test_Topology_seed(self):
+        topology_json = get_input_topology('topology.json')
+        options = topology_json['options']
+        options['users'].append({'username': 'operator'})
+        options['ipsec_tunnel'] = [{
+            'R1': {'tunnel_int': 'e0/1', 'encrypted_traffic': '1.1.1.1/32'},
+            'R4': {'tunnel_int': 'e0/1', 'encrypted_traffic': '4.4.4.4/32'},
+        }]
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'topology.json')
+        with open(path, 'w') as f:
+            json.dump(topology_json, f)
+        first = Topology(path, seed='lab')
+        second = Topology(path, stream=True, seed=b'lab')
+        for node in first.nodes:
+            self.assertEqual(node.build_config(),
+                             second.index[node.name].build_config())
+        self.assertEqual(first.users['operator'],
+                         derive_password(b'lab', 'user', 'operator'))
+        self.assertEqual(first.ipsec_tunnels[0].key,
+                         derive_password(b'lab', 'tunnel', 'R1', 'R4'))
+        other = Topology(path, seed='other')
+        self.assertNotEqual(other.users['operator'], first.users['operator'])
+        self.assertEqual(len(other.users['operator']), 20)
+        self.assertTrue(500 <= other.switches[0].native_vlan <= 1000)
+
+    def test_NetworkDevice_write_config(self):
+        topology = Topology('topology.json')
+        for node in topology.nodes:
+            out = io.StringIO()
+            node.write_config(out)
+            self.assertEqual(out.getvalue(), node.build_config())
+        trunk = topology.index['SW1'].get_interface('e0/0')
+        self.assertEqual(trunk.build_config(None, ['1', '12']).split('\n')[3],
+                         ' switchport trunk allowed vlan 1,12')
+        self.assertTrue(trunk.build_config().endswith(' no shutdown\n!'))
+
+    def test_VlanSet(self):
+        vlans = VlanSet([20, 3, 1, 2, 9, 10, 4094])
+        self.assertEqual(list(vlans), [1, 2, 3, 9, 10, 20, 4094])
+        self.assertEqual(str(vlans), '1-3,9-10,20,4094')
+        self.assertEqual(VlanSet('1-3,9-10,20,4094'), vlans)
+        self.assertEqual(len(vlans), 7)
+        self.assertIn(9, vlans)
+        self.assertNotIn(8, vlans)
+        vlans |= VlanSet('4-8')
+        vlans.discard(20)
+        self.assertEqual(vlans.ranges(), [(1, 10), (4094, 4094)])
+        self.assertEqual(str(vlans - [4094]), '1-10')
+        self.assertEqual(VlanSet().split(10), ['none'])
+        self.assertEqual(VlanSet(range(1, 40, 2)).split(16),
+                         ['1,3,5,7,9,11,13', '15,17,19,21,23', '25,27,29,31,33',
+                          '35,37,39'])
+        for wrong_vlans in [0], [4095], '1-x', ['10']:
+            self.assertRaises(VlanSet.WrongVlanError, VlanSet, wrong_vlans)
+
+    def test_Interface_trunk_vlans(self):
+        switch = Switch('SW1')
+        trunk = Interface('e0/0', vlan='trunk', device=switch)
+        trunk.switchport = True
+        switch.add_interface(trunk)
+        config = switch.build_config_interfaces(600, VlanSet(range(2, 4000,
+                                                                   3)))
+        lines = [line for line in config.split('\n') if 'allowed' in line]
+        self.assertEqual(lines[0], ' switchport trunk allowed vlan '
+                         '2,5,8,11,14,17,20,23,26,29,32,35,38,41,44,47')
+        self.assertTrue(all(line.startswith(' switchport trunk allowed vlan '
+                                            'add ') and len(line) <= 80
+                            for line in lines[1:]))
+        self.assertEqual(VlanSet(','.join(line.split()[-1] for line in lines)),
+                         VlanSet(range(2, 4000, 3)))
+        self.assertIn(' switchport trunk allowed vlan 9-10\n',
+                      trunk.build_config(None, ['10', '9']) + '\n')
+
+    def test_Topology_stats(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        topology = Topology('topology.json', stats=True)
+        topology.create_configs(directory)
+        report = json.loads(topology.stats.to_json())
+        self.assertEqual(list(report['stages']),
+                         ['load', 'nodes', 'options', 'links',
+                          'calculate_topology', 'tunnels', 'digests',
+                          'render', 'write'])
+        self.assertAlmostEqual(report['total'],
+                               sum(report['stages'].values()))
+        counters = report['counters']
+        self.assertEqual((counters['nodes'], counters['interfaces'],
+                          counters['links'], counters['configs_written']),
+                         (5, 13, 4, 5))
+        self.assertEqual(counters['bytes_written'],
+                         sum(os.path.getsize(os.path.join(directory, name))
+                             for name in os.listdir(directory)
+                             if name.endswith('.cfg')))
+        self.assertIsNone(topology.stats.profile_stats())
+        topology = Topology('topology.json')
+        topology.create_configs(directory, incremental=True)
+        self.assertEqual(topology.stats.report(),
+                         {'stages': {}, 'total': 0, 'counters': {}})
+        stats = BuildStats(profile=True)
+        Topology('topology.json', stream=True, stats=stats)
+        self.assertNotIn('load', stats.report()['stages'])
+        self.assertGreater(stats.profile_stats().total_calls, 0)
+
+    def test_Interface_slots(self):
+        router = Router('R1')
+        interface = Interface('e0/0', ip_address='10.0.0.1/24',
+                              device=router)
+        interface.ospf = True
+        interface.ospf_area = 0
+        self.assertFalse(hasattr(interface, '__dict__'))
+        self.assertFalse(hasattr(router, '__dict__'))
+        self.assertEqual(interface.flags,
+                         Interface.up.mask | Interface.ospf.mask)
+        interface.up = False
+        self.assertFalse(interface.up)
+        self.assertTrue(interface.ospf)
+        self.assertEqual(interface.generate_json(), {
+            'name': 'Ethernet0/0', 'up': False, 'switchport': False,
+            'ip': '10.0.0.1/24', 'ospf_enabled': True, 'ospf_area': 0,
+            'ospf_not_passive': False, 'eigrp_enabled': False,
+            'eigrp_not_passive': False, 'dot1q': None})
+        router.add_interface(interface)
+        router.ospf = True
+        self.assertEqual((router.ipv4_routing, router.ospf, router.eigrp),
+                         (True, True, False))
+        self.assertEqual(router.generate_json()['interfaces'],
+                         [interface.json])
+        switch = Switch('SW1')
+        switch.routing = True
+        self.assertEqual((switch.routing, switch.ipv4_routing), (True, False))
+        self.assertRaises(AttributeError, setattr, interface, 'speed', 100)
+
+    def test_Topology_validate_addresses(self):
+        topology = Topology('topology.json')
+        self.assertEqual(topology.validate_addresses(), [])
+        r2, r3, r4 = [topology.index[name] for name in ('R2', 'R3', 'R4')]
+        r3.get_interface('Loopback0').ip_address = IPAddress('2.2.2.2/32')
+        r4.get_interface('e0/1').ip_address = IPAddress('10.0.1.4/25')
+        loopback = Interface('Loopback1', ip_address='10.0.12.128/25',
+                             device=r4)
+        r4.add_interface(loopback)
+        self.assertEqual(topology.validate_addresses(), [
+            'Duplicate ip 2.2.2.2: R2 Loopback0, R3 Loopback0',
+            'Overlapping subnets 10.0.1.0/24 (R1 Ethernet0/1) and '
+            '10.0.1.0/25 (R4 Ethernet0/1)',
+            'Overlapping subnets 10.0.12.0/24 (R1 Ethernet0/0.12, '
+            'R2 Ethernet0/1.12) and 10.0.12.128/25 (R4 Loopback1)',
+            'Mismatched masks on link R1 Ethernet0/1 - R4 Ethernet0/1: '
+            '10.0.1.1/24 and 10.0.1.4/25',
+        ])
+        r4.get_interface('e0/1').ip_address = IPAddress('10.0.2.4/24')
+        r4.remove_interface(loopback)
+        self.assertEqual(topology.validate_addresses()[1:], [
+            'Different subnets on link R1 Ethernet0/1 - R4 Ethernet0/1: '
+            '10.0.1.1/24 and 10.0.2.4/24',
+        ])
+
+    def test_RoutingTable(self):
+        router = Router('R1')
+        for name, ip in ('e0/0', '10.0.0.1/24'), ('e0/1', '10.0.1.1/30'), \
+                        ('Loopback0', '1.1.1.1/32'):
+            router.add_interface(Interface(name, ip_address=ip,
+                                           device=router))
+        router.get_interface('e0/1').up = False
+        router.static_routes = [
+            {'prefix': '0.0.0.0/0', 'nexthop': '10.0.0.2'},
+            {'prefix': '10.0.0.0/24', 'nexthop': '10.0.0.3'},
+            {'prefix': '172.16.0.0/12', 'nexthop': 'e0/0'},
+            {'prefix': '192.168.0.0/16', 'nexthop': '172.16.0.1'},
+        ]
+        table = router.build_routing_table()
+        self.assertEqual([str(route) for route in table], [
+            'S 0.0.0.0/0 via 10.0.0.2',
+            'C 1.1.1.1/32 is directly connected, Loopback0',
+            'C 10.0.0.0/24 is directly connected, Ethernet0/0',
+            'S 172.16.0.0/12 is directly connected, Ethernet0/0',
+            'S 192.168.0.0/16 via 172.16.0.1',
+        ])
+        self.assertEqual(str(table.lookup('10.0.1.2')),
+                         'S 0.0.0.0/0 via 10.0.0.2')
+        self.assertIsNone(RoutingTable().lookup(IPAddress('10.0.0.1')))
+        self.assertEqual([route.protocol for route in table.lookup_many(
+            ['10.0.0.7', '1.1.1.1', '10.0.0.7'])],
+            ['connected', 'connected', 'connected'])
+        interface, nexthop = table.resolve('192.168.5.5')
+        self.assertEqual((interface.name, nexthop.ip),
+                         ('Ethernet0/0', '172.16.0.1'))
+        self.assertIsNone(table.resolve('2001:db8::1'))
+        self.assertIs(table.get('10.0.0.0/24').interface,
+                      router.get_interface('e0/0'))
+        self.assertIs(router.get_static_routes(), router.get_static_routes())
+        router.static_routes = router.static_routes[:1]
+        self.assertEqual(router.generate_static_routing_config(),
+                         'ip route 0.0.0.0 0.0.0.0 10.0.0.2\n')
+        router.static_routes = [
+            {'prefix': '224.0.0.0', 'nexthop': '10.0.0.2'},
+            {'prefix': '10.1.2', 'nexthop': '10.0.0.2'},
+            {'prefix': '10.9.0.0/16', 'nexthop': 'gi9/9'},
+            {'prefix': '10.8.0.0/16'},
+            {'prefix': '10.7.0.0/16', 'nexthop': 'e0/0'},
+        ]
+        with self.assertRaises(NetworkDevice.StaticRouteError) as context:
+            router.build_routing_table()
+        self.assertEqual(context.exception.errors, [
+            'R1: static route 224.0.0.0 via 10.0.0.2: prefix has no mask',
+            'R1: static route 10.1.2 via 10.0.0.2: wrong prefix',
+            'R1: static route 10.9.0.0/16 via gi9/9: wrong next hop',
+            'R1: static route 10.8.0.0/16 via None: wrong next hop',
+        ])
+        self.assertRaises(NetworkDevice.StaticRouteError,
+                          router.generate_static_routing_config)
+
+    def test_ReachabilitySimulator(self):
+        topology = Topology('topology.json')
+        self.assertEqual((topology.index['R2'].ospf,
+                          topology.index['R2'].ospf_process,
+                          topology.index['R4'].ospf), (True, 1, False))
+        simulator = ReachabilitySimulator(topology)
+        reachable = simulator.all_pairs()
+        self.assertEqual(len(reachable), 4 * 9)
+        self.assertTrue(all(reachable.values()))
+        self.assertEqual(simulator.trace('R3', '10.0.1.4'),
+                         ('reachable', ['R3', 'R2', 'R1', 'R4']))
+        self.assertEqual(str(simulator.best_route(topology.index['R3'],
+                                                  IPAddress('1.1.1.1'))),
+                         'O 1.1.1.1/32 via 10.0.23.2, Ethernet0/0')
+        self.assertEqual(simulator.trace_many([('R4', '8.8.8.8'),
+                                               ('SW1', '3.3.3.3')]),
+                         [('no route', ['R4', 'R1']), ('no route', ['SW1'])])
+        self.assertEqual(len(simulator.trees), 3)
+        topology.index['R1'].static_routes = [{'prefix': '0.0.0.0/0',
+                                               'nexthop': '10.0.1.4'}]
+        topology.index['R2'].get_interface('e0/0').up = False
+        simulator = ReachabilitySimulator(topology)
+        self.assertEqual(simulator.trace('R4', '8.8.8.8'),
+                         ('loop', ['R4', 'R1', 'R4']))
+        self.assertFalse(simulator.is_reachable('R1', '3.3.3.3'))
+        self.assertTrue(simulator.is_reachable('R3', '3.3.3.3'))
+
+    def test_ReachabilitySimulator_query_order(self):
+        def router(name, interfaces, static_routes, ipv4_routing=True):
+            return {'name': name, 'type': 'router',
+                    'ipv4_routing': ipv4_routing,
+                    'interfaces': [{'name': interface, 'ip': ip}
+                                   for interface, ip in interfaces],
+                    'static_routes': [{'prefix': '10.9.9.0/24',
+                                       'nexthop': nexthop}
+                                      for nexthop in static_routes]}
+        topology_json = {'options': {}, 'topology': {'nodes': [
+            router('H', [('e0/0', '10.0.12.1/24'), ('e0/1', '10.0.13.1/24')],
+                   ['10.0.13.3'], ipv4_routing=False),
+            router('R1', [('e0/0', '10.0.13.3/24'),
+                          ('Loopback0', '10.9.9.1/24')], []),
+            router('R2', [('e0/0', '10.0.12.2/24')], ['10.0.12.1']),
+        ], 'links': [
+            {'src_node': 'R2', 'src_int': 'e0/0',
+             'dst_node': 'H', 'dst_int': 'e0/0'},
+            {'src_node': 'H', 'src_int': 'e0/1',
+             'dst_node': 'R1', 'dst_int': 'e0/0'},
+        ]}}
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'topology.json')
+        with open(path, 'w') as f:
+            json.dump(topology_json, f)
+        topology = Topology(path)
+        queries = [('H', '10.9.9.1'), ('R2', '10.9.9.1')]
+        expected = [('reachable', ['H', 'R1']), ('no route', ['R2', 'H'])]
+        self.assertEqual(ReachabilitySimulator(topology).trace_many(queries),
+                         expected)
+        self.assertEqual(ReachabilitySimulator(topology).trace_many(
+            queries[::-1]), expected[::-1])
+        simulator = ReachabilitySimulator(topology)
+        self.assertEqual(simulator.trace_many(queries * 2), expected * 2)
+
     # TODO: add more tests
 
 if __name__ == '__main__':
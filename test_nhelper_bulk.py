@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# unit tests for nhelper_bulk.py
+import unittest
+from nhelper import IPAddress, Interface, Subnet, Topology
+
+try:
+    import numpy
+    import nhelper_bulk
+except ImportError:
+    numpy = None
+
+@unittest.skipIf(numpy is None, 'numpy is not installed')
+class TestBulkTools(unittest.TestCase):
+    def setUp(self):
+        self.strings = ['192.168.1.3', '10.0.0.1', '224.0.0.9',
+                        '255.255.255.255', '172.16.5.4']
+        self.addresses = nhelper_bulk.parse_ipv4(self.strings)
+
+    def test_parse_ipv4(self):
+        self.assertEqual(self.addresses.dtype, numpy.uint32)
+        self.assertEqual(self.addresses.tolist(),
+                         [IPAddress(ip).ip_int for ip in self.strings])
+        self.assertEqual(nhelper_bulk.format_ipv4(self.addresses),
+                         self.strings)
+        self.assertEqual(len(nhelper_bulk.parse_ipv4([])), 0)
+
+    def test_parse_ipv4_wrong_ip(self):
+        for wrong_ips in ['1.2.3'], ['1.2.3.256'], ['1.2.3.-4'], \
+                         ['1..2.3'], ['1.2.3.4 '], ['1.2.3.4.5', '6.7.8']:
+            self.assertRaises(IPAddress.WrongIPError,
+                              nhelper_bulk.parse_ipv4, wrong_ips)
+
+    def test_contains(self):
+        self.assertEqual(nhelper_bulk.contains('192.168.0.0/16',
+                                               self.addresses).tolist(),
+                         [True, False, False, False, False])
+        self.assertEqual(nhelper_bulk.contains(Subnet('0.0.0.0 0.0.0.0'),
+                                               self.addresses).tolist(),
+                         [True] * 5)
+        self.assertEqual(nhelper_bulk.in_range(self.addresses,
+                                               IPAddress('10.0.0.0'),
+                                               IPAddress('192.168.1.3'))
+                         .tolist(), [True, True, False, False, True])
+
+    def test_network_of(self):
+        networks = nhelper_bulk.network_of(self.addresses, 24)
+        self.assertEqual(nhelper_bulk.format_ipv4(networks),
+                         ['192.168.1.0', '10.0.0.0', '224.0.0.0',
+                          '255.255.255.0', '172.16.5.0'])
+        networks = nhelper_bulk.network_of(self.addresses,
+                                           numpy.array([30, 8, 4, 0, 12]))
+        self.assertEqual(nhelper_bulk.format_ipv4(networks),
+                         ['192.168.1.0', '10.0.0.0', '224.0.0.0',
+                          '0.0.0.0', '172.16.0.0'])
+        broadcasts = nhelper_bulk.broadcast_of(self.addresses, 30)
+        self.assertEqual(nhelper_bulk.format_ipv4(broadcasts)[0],
+                         '192.168.1.3')
+
+    def test_classify(self):
+        classes = nhelper_bulk.classify(self.addresses)
+        self.assertEqual(nhelper_bulk.CLASS_NAMES[classes].tolist(),
+                         [IPAddress(ip).get_class() for ip in self.strings])
+
+
+@unittest.skipIf(numpy is None, 'numpy is not installed')
+class TestInterfaceStore(unittest.TestCase):
+    def setUp(self):
+        self.topology = Topology('topology.json')
+        self.store = nhelper_bulk.InterfaceStore(self.topology, capacity=2)
+        self.addCleanup(self.store.close)
+
+    def names(self, mask):
+        return ['{} {}'.format(interface.device, interface)
+                for interface in self.store.interfaces(mask)]
+
+    def test_select(self):
+        store = self.store
+        self.assertEqual(len(store), 13)
+        self.assertEqual(self.names(store.select(ospf=True, ospf_area=1)),
+                         ['R2 Ethernet0/0', 'R3 Ethernet0/0', 'R3 Loopback0'])
+        self.assertEqual(self.names(store.select(subnet='10.0.12.0/24')),
+                         ['R1 Ethernet0/0.12', 'R2 Ethernet0/1.12'])
+        self.assertEqual(self.names(store.select(trunk=True)),
+                         ['SW1 Ethernet0/1', 'SW1 Ethernet0/0'])
+        self.assertEqual(self.names(store.select(device='R1', dot1q=12)),
+                         ['R1 Ethernet0/0.12'])
+        self.assertEqual(store.count_by_device(store.select(ospf=False)),
+                         {'R1': 1, 'SW1': 2, 'R2': 1, 'R3': 0, 'R4': 1})
+        self.assertEqual(store.count_by('ospf_area'), {-1: 5, 0: 5, 1: 3})
+        self.assertRaises(KeyError, store.select, speed=100)
+
+    def test_dotted_ospf_area(self):
+        router = self.topology.index['R4']
+        interface = router.get_interface('e0/1')
+        interface.ospf = True
+        interface.ospf_area = '0.0.0.1'
+        store = nhelper_bulk.InterfaceStore(self.topology)
+        self.addCleanup(store.close)
+        self.assertEqual(['{} {}'.format(interface.device, interface)
+                          for interface in store.interfaces(
+                              store.select(ospf_area='0.0.0.1'))],
+                         ['R2 Ethernet0/0', 'R3 Ethernet0/0', 'R3 Loopback0',
+                          'R4 Ethernet0/1'])
+        self.assertEqual(store.select(ospf_area='1').sum(), 4)
+        self.assertEqual(nhelper_bulk.area_to_int('0.0.1.0'), 256)
+
+    def test_sync(self):
+        store = self.store
+        switch = self.topology.index['SW1']
+        access = Interface('e1/0', vlan='20', device=switch)
+        access.switchport = True
+        switch.add_interface(access)
+        self.assertEqual(self.names(store.select(access=True, vlan=20)),
+                         ['SW1 Ethernet1/0'])
+        switch.remove_interface(access)
+        self.assertEqual(store.select(vlan=20).sum(), 0)
+        self.assertEqual(len(store), 13)
+        router = self.topology.index['R4']
+        router.get_interface('e0/1').ospf = True
+        self.assertEqual(store.select(device='R4', ospf=True).sum(), 0)
+        store.refresh()
+        self.assertEqual(store.select(device='R4', ospf=True).sum(), 1)
+        store.close()
+        router.add_interface(Interface('Loopback0'))
+        self.assertEqual(len(store), 13)
+
+if __name__ == '__main__':
+    unittest.main()